@@ -33,9 +33,14 @@ import os
 # import sys
 # import inspect
 
-from qgis.core import QgsProcessingAlgorithm, QgsApplication
+from PyQt5.QtCore import QCoreApplication
+from PyQt5.QtWidgets import QAction, QLabel
+from qgis.core import (QgsProcessingAlgorithm, QgsApplication,
+                       QgsMapLayer, QgsWkbTypes)
 import os.path
 from .Climb_provider import ClimbProvider
+from .Climb_live import LiveClimb
+from .Climb_expressions import register_functions, unregister_functions
 
 # cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
 # if cmd_folder not in sys.path:
@@ -44,11 +49,83 @@ from .Climb_provider import ClimbProvider
 
 class Climb(object):
 
-    def __init__(self):
+    def __init__(self, iface=None):
+        self.iface = iface
         self.provider = ClimbProvider()
+        self.liveaction = None
+        self.livelabel = None
+        self.live = None
 
     def initGui(self):
         QgsApplication.processingRegistry().addProvider(self.provider)
+        # climb(), descent(), min_elevation() and max_elevation()
+        register_functions()
+        if self.iface is None:
+            return
+        # Live climb totals for the active layer
+        self.liveaction = QAction(self.tr('Live climb totals'),
+                                  self.iface.mainWindow())
+        self.liveaction.setCheckable(True)
+        self.liveaction.toggled.connect(self.toggleLive)
+        self.iface.addPluginToVectorMenu(self.tr('Climb'),
+                                         self.liveaction)
 
     def unload(self):
         QgsApplication.processingRegistry().removeProvider(self.provider)
+        unregister_functions()
+        if self.liveaction is not None:
+            self.stopLive()
+            self.iface.removePluginVectorMenu(self.tr('Climb'),
+                                              self.liveaction)
+            self.liveaction = None
+
+    def toggleLive(self, checked):
+        """
+        Starts (for the active layer) or stops the live climb
+        totals.
+        """
+        if not checked:
+            self.stopLive()
+            return
+        layer = self.iface.activeLayer()
+        if (layer is None or layer.type() != QgsMapLayer.VectorLayer or
+                layer.geometryType() != QgsWkbTypes.LineGeometry or
+                not QgsWkbTypes.hasZ(layer.wkbType())):
+            self.iface.messageBar().pushWarning(
+                self.tr('Climb'),
+                self.tr('Live climb totals need an active line layer '
+                        'with Z values'))
+            self.liveaction.setChecked(False)
+            return
+        self.live = LiveClimb(layer)
+        self.livelabel = QLabel()
+        self.iface.mainWindow().statusBar().addPermanentWidget(
+            self.livelabel)
+        self.live.totalsChanged.connect(self.showTotals)
+        layer.willBeDeleted.connect(self.liveLayerRemoved)
+        self.showTotals(*self.live.totals())
+
+    def stopLive(self):
+        if self.live is not None:
+            self.live.layer.willBeDeleted.disconnect(self.liveLayerRemoved)
+            self.live.stop()
+            self.live = None
+        if self.livelabel is not None:
+            self.iface.mainWindow().statusBar().removeWidget(
+                self.livelabel)
+            self.livelabel.deleteLater()
+            self.livelabel = None
+
+    def liveLayerRemoved(self):
+        self.liveaction.setChecked(False)
+
+    def showTotals(self, climb, descent, minelevation, maxelevation):
+        self.livelabel.setText(
+            self.live.layer.name() + ': ' +
+            self.tr('climb') + ' ' + str(round(climb, 1)) + ', ' +
+            self.tr('descent') + ' ' + str(round(descent, 1)) + ', ' +
+            self.tr('min') + ' ' + str(round(minelevation, 1)) + ', ' +
+            self.tr('max') + ' ' + str(round(maxelevation, 1)))
+
+    def tr(self, string):
+        return QCoreApplication.translate('Climb', string)
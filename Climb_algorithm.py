@@ -29,21 +29,50 @@ __copyright__ = '(C) 2019 by Håvard Tveite'
 
 __revision__ = '$Format:%H$'
 
-import math
 from PyQt5.QtCore import QCoreApplication, QVariant
 from qgis.core import (QgsProcessing,
-                       QgsFeatureSink,
                        QgsProcessingAlgorithm,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterFeatureSink,
                        QgsProcessingParameterRasterLayer,
+                       QgsProcessingParameterMultipleLayers,
+                       QgsProcessingParameterString,
                        QgsProcessingParameterBand,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterField,
+                       QgsProcessingParameterFileDestination,
+                       QgsProcessingParameterDefinition,
                        QgsProcessingOutputNumber,
-                       QgsWkbTypes,
+                       QgsFeatureRequest,
+                       QgsFeature,
+                       QgsGeometry,
+                       QgsFeatureSink,
                        QgsFields,
-                       QgsField)
+                       QgsField,
+                       QgsCoordinateReferenceSystem,
+                       QgsMemoryProviderUtils,
+                       QgsProcessingFeedback,
+                       QgsProcessingException,
+                       QgsWkbTypes)
 from qgis.utils import Qgis
+import re
 import processing
+from .Climb_kernel import (decode_wkb_batch, climb_statistics,
+                           concatenate_statistics, wkb_statistics,
+                           median_vertex_spacing, ClimbTotals,
+                           GroupTotals, VertexBatch)
+from .Climb_dem import (DemSampler, NEAREST, BILINEAR, TRAVERSE,
+                        TILESIZE, CACHESIZE, file_identity,
+                        coordinate_transform, coordinate_operation,
+                        transform_coordinates)
+from .Climb_index import GridIndex
+from .Climb_parallel import ChunkPool
+from .Climb_writer import ClimbWriter
+from .Climb_cache import ResultCache, MAXENTRIES
+from .Climb_profile import ProfileStore
+from .Climb_metrics import RunMetrics, ProgressThrottle
 
 
 class ClimbAlgorithm(QgsProcessingAlgorithm):
@@ -61,6 +90,28 @@ class ClimbAlgorithm(QgsProcessingAlgorithm):
     INPUT = 'INPUT'
     DEMFORZ = 'DEMFORZ'
     BANDDEM = 'BANDDEM'
+    DEMSAMPLING = 'DEMSAMPLING'
+    DEMTILESIZE = 'DEMTILESIZE'
+    DEMCACHESIZE = 'DEMCACHESIZE'
+    DEMMEMMAP = 'DEMMEMMAP'
+    GRIDINDEX = 'GRIDINDEX'
+    DEMDEDUPLICATE = 'DEMDEDUPLICATE'
+    DEMSNAP = 'DEMSNAP'
+    DEMRESOLUTION = 'DEMRESOLUTION'
+    DEMTOLERANCE = 'DEMTOLERANCE'
+    WORKERS = 'WORKERS'
+    CHUNKSIZE = 'CHUNKSIZE'
+    FIELDS = 'FIELDS'
+    RESULTCACHE = 'RESULTCACHE'
+    RESULTCACHEENTRIES = 'RESULTCACHEENTRIES'
+    EXTRADEMS = 'EXTRADEMS'
+    EXTRABANDS = 'EXTRABANDS'
+    GRADES = 'GRADES'
+    GRADECLASSES = 'GRADECLASSES'
+    PROFILES = 'PROFILES'
+    GROUPBY = 'GROUPBY'
+    GROUPOUTPUT = 'GROUPOUTPUT'
+    METRICS = 'METRICS'
     TOTALCLIMB = 'TOTALCLIMB'
     TOTALDESCENT = 'TOTALDESCENT'
     MINELEVATION = 'MINELEVATION'
@@ -69,15 +120,41 @@ class ClimbAlgorithm(QgsProcessingAlgorithm):
     DESCENTATTRIBUTE = 'descent'
     MINELEVATTRIBUTE = 'minelev'
     MAXELEVATTRIBUTE = 'maxelev'
+    FEATURESATTRIBUTE = 'features'
+    MAXGRADEATTRIBUTE = 'maxgrade'
+    MEANGRADEATTRIBUTE = 'meangrade'
+    # Default number of features that are handled together by the
+    # (vectorised) climb calculation
+    BATCHSIZE = 1000
+    # DEM sampling methods (DEMSAMPLING)
+    NEAREST = 0
+    BILINEAR = 1
+    DRAPE = 2
+    TRAVERSE = 3
+    # DEM resolution options (DEMRESOLUTION)
+    FULLRESOLUTION = 0
+    OVERVIEWTOLERANCE = 1
+    OVERVIEWSPACING = 2
+    # Number of features used to find the median vertex spacing
+    SPACINGSAMPLE = 1000
 
     # Override checking of parameters
     def checkParameterValues(self, parameters, context):
         super().checkParameterValues(parameters, context)
+        badbands = [band for band in self.extraBands(parameters, context)
+                    if not band.isdigit() or int(band) < 1]
+        if badbands:
+            return [False, 'The bands of the DEMs to compare must be ' +
+                    'band numbers (1, 2, ...) separated by commas, ' +
+                    'not ' + ', '.join(badbands)]
         source = self.parameterAsSource(parameters, self.INPUT, context)
         # Check for Z values
         hasZ = QgsWkbTypes.hasZ(source.wkbType())
+        sampling = self.parameterAsEnum(parameters, self.DEMSAMPLING,
+                                        context)
         if not hasZ:
-            if Qgis.QGIS_VERSION_INT < 30405:
+            if (sampling == self.DRAPE and
+                    Qgis.QGIS_VERSION_INT < 30405):
                 return [False, 'The line layer has no Z values, ' +
                         'so a DEM is needed, but extracting Z ' +
                         'values from the DEM requires QGIS ' +
@@ -129,11 +206,262 @@ class ClimbAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        # How to get the z values from the DEM
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.DEMSAMPLING,
+                self.tr('DEM sampling method'),
+                self.samplingMethods(),
+                defaultValue=self.NEAREST
+            )
+        )
+
+        # Size of the blocks read from the DEM
+        tilesize = QgsProcessingParameterNumber(
+            self.DEMTILESIZE,
+            self.tr('DEM block size (cells)'),
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=TILESIZE,
+            minValue=16
+        )
+        tilesize.setFlags(tilesize.flags() |
+                          QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(tilesize)
+
+        # Maximum size of the DEM block cache
+        cachesize = QgsProcessingParameterNumber(
+            self.DEMCACHESIZE,
+            self.tr('DEM block cache size (MB)'),
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=CACHESIZE,
+            minValue=1
+        )
+        cachesize.setFlags(cachesize.flags() |
+                           QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(cachesize)
+
+        # Memory map uncompressed DEMs
+        memmap = QgsProcessingParameterBoolean(
+            self.DEMMEMMAP,
+            self.tr('Memory map uncompressed DEMs'),
+            defaultValue=True
+        )
+        memmap.setFlags(memmap.flags() |
+                        QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(memmap)
+
+        # Sample the DEM at full resolution or an overview
+        resolution = QgsProcessingParameterEnum(
+            self.DEMRESOLUTION,
+            self.tr('DEM resolution'),
+            self.resolutionOptions(),
+            defaultValue=self.FULLRESOLUTION
+        )
+        resolution.setFlags(resolution.flags() |
+                            QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(resolution)
+
+        # Largest acceptable DEM cell size when using overviews
+        tolerance = QgsProcessingParameterNumber(
+            self.DEMTOLERANCE,
+            self.tr('DEM cell size tolerance (for overviews)'),
+            QgsProcessingParameterNumber.Double,
+            defaultValue=0.0,
+            minValue=0.0
+        )
+        tolerance.setFlags(tolerance.flags() |
+                           QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(tolerance)
+
+        # Sample each unique vertex of a chunk once
+        deduplicate = QgsProcessingParameterBoolean(
+            self.DEMDEDUPLICATE,
+            self.tr('Sample each unique vertex once'),
+            defaultValue=True
+        )
+        deduplicate.setFlags(deduplicate.flags() |
+                             QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(deduplicate)
+
+        # Snapping tolerance for finding unique vertices
+        snap = QgsProcessingParameterNumber(
+            self.DEMSNAP,
+            self.tr('Snapping tolerance for unique vertices'),
+            QgsProcessingParameterNumber.Double,
+            defaultValue=0.0,
+            minValue=0.0
+        )
+        snap.setFlags(snap.flags() |
+                      QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(snap)
+
+        # Process the features cell by cell of a grid index
+        gridindex = QgsProcessingParameterBoolean(
+            self.GRIDINDEX,
+            self.tr('Process the lines by DEM block (grid index)'),
+            defaultValue=False
+        )
+        gridindex.setFlags(gridindex.flags() |
+                           QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(gridindex)
+
+        # Number of worker processes (0: one per CPU)
+        workers = QgsProcessingParameterNumber(
+            self.WORKERS,
+            self.tr('Worker processes (0: one per CPU)'),
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=0
+        )
+        workers.setFlags(workers.flags() |
+                         QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(workers)
+
+        # Number of features handled together
+        chunksize = QgsProcessingParameterNumber(
+            self.CHUNKSIZE,
+            self.tr('Features per chunk'),
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=self.BATCHSIZE,
+            minValue=1
+        )
+        chunksize.setFlags(chunksize.flags() |
+                           QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(chunksize)
+
+        # The input fields to copy to the output layer
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.FIELDS,
+                self.tr('Fields to copy (default: all)'),
+                None,
+                self.INPUT,
+                QgsProcessingParameterField.Any,
+                allowMultiple=True,
+                optional=True
+            )
+        )
+
+        # Persistent cache of the results for each feature
+        resultcache = QgsProcessingParameterFileDestination(
+            self.RESULTCACHE,
+            self.tr('Result cache file'),
+            self.tr('SQLite files (*.sqlite)'),
+            optional=True,
+            createByDefault=False
+        )
+        resultcache.setFlags(resultcache.flags() |
+                             QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(resultcache)
+
+        # Maximum number of features in the result cache
+        cacheentries = QgsProcessingParameterNumber(
+            self.RESULTCACHEENTRIES,
+            self.tr('Maximum number of features in the result cache'),
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=MAXENTRIES,
+            minValue=1
+        )
+        cacheentries.setFlags(cacheentries.flags() |
+                              QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(cacheentries)
+
+        # More DEMs to compare, sampled in the same pass
+        extradems = QgsProcessingParameterMultipleLayers(
+            self.EXTRADEMS,
+            self.tr('More DEMs to compare'),
+            QgsProcessing.TypeRaster,
+            optional=True
+        )
+        extradems.setFlags(extradems.flags() |
+                           QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(extradems)
+
+        # The bands of the extra DEMs to sample
+        extrabands = QgsProcessingParameterString(
+            self.EXTRABANDS,
+            self.tr('Bands of the DEMs to compare (comma separated)'),
+            defaultValue='1',
+            optional=True
+        )
+        extrabands.setFlags(extrabands.flags() |
+                            QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(extrabands)
+
+        # Grade statistics for each feature
+        grades = QgsProcessingParameterBoolean(
+            self.GRADES,
+            self.tr('Calculate grade statistics'),
+            defaultValue=False
+        )
+        grades.setFlags(grades.flags() |
+                        QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(grades)
+
+        # The limits of the grade classes
+        gradeclasses = QgsProcessingParameterString(
+            self.GRADECLASSES,
+            self.tr('Grade class limits (percent, comma separated)'),
+            defaultValue='3,6,10',
+            optional=True
+        )
+        gradeclasses.setFlags(gradeclasses.flags() |
+                              QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(gradeclasses)
+
+        # Store of the elevation profiles of the features
+        profiles = QgsProcessingParameterFileDestination(
+            self.PROFILES,
+            self.tr('Profile store'),
+            self.tr('NumPy files (*.npz)'),
+            optional=True,
+            createByDefault=False
+        )
+        profiles.setFlags(profiles.flags() |
+                          QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(profiles)
+
+        # Report of the time used by each stage and the counters
+        metricsreport = QgsProcessingParameterFileDestination(
+            self.METRICS,
+            self.tr('Run metrics report'),
+            self.tr('JSON files (*.json)'),
+            optional=True,
+            createByDefault=False
+        )
+        metricsreport.setFlags(metricsreport.flags() |
+                               QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(metricsreport)
+
+        # The field used to group the features for the group totals
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.GROUPBY,
+                self.tr('Group by field'),
+                None,
+                self.INPUT,
+                QgsProcessingParameterField.Any,
+                optional=True
+            )
+        )
+
         # We add a feature sink in which to store our processed features.
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT,
-                self.tr('Climb layer')
+                self.tr('Climb layer'),
+                optional=True
+            )
+        )
+
+        # Table with the totals for each group (GROUPBY)
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.GROUPOUTPUT,
+                self.tr('Group totals'),
+                QgsProcessing.TypeVector,
+                optional=True,
+                createByDefault=False
             )
         )
 
@@ -173,145 +501,856 @@ class ClimbAlgorithm(QgsProcessingAlgorithm):
         """
         Here is where the processing itself takes place.
         """
-        # Get the feature source
-        source = self.parameterAsSource(parameters, self.INPUT, context)
-        # Get the number of features (for the progress bar)
-        fcount = source.featureCount()
-        # Check for Z values
-        hasZ = QgsWkbTypes.hasZ(source.wkbType())
-        # Get the DEM
-        demraster = self.parameterAsRasterLayer(parameters,
-                                                self.DEMFORZ,
+        # Time used by each stage, and counters
+        metrics = RunMetrics()
+        # Resources that are closed when the run ends (also after an
+        # error or when cancelled)
+        extras = []
+        profilestore = None
+        sampler = None
+        pool = None
+        cache = None
+        try:
+            # Get the feature source
+            source = self.parameterAsSource(parameters, self.INPUT, context)
+            # Get the number of features (for the progress bar)
+            fcount = source.featureCount()
+            # Check for Z values
+            hasZ = QgsWkbTypes.hasZ(source.wkbType())
+            # Get the DEM
+            demraster = self.parameterAsRasterLayer(parameters,
+                                                    self.DEMFORZ,
+                                                    context)
+            # More DEMs (and bands) to compare, as (suffix, sampler)
+            extras = self.extraSamplers(parameters, context, source,
+                                        feedback)
+            # Fields of the output layer: the input fields to copy (all
+            # by default), followed by new fields for climb, descent,
+            # minimum elevation and maximum elevation (then the grade
+            # statistics, and the same for each extra DEM, with a suffix)
+            copyfields = None
+            if parameters.get(self.FIELDS):
+                copyfields = self.parameterAsFields(parameters, self.FIELDS,
+                                                    context)
+            newfields = [self.CLIMBATTRIBUTE, self.DESCENTATTRIBUTE,
+                         self.MINELEVATTRIBUTE, self.MAXELEVATTRIBUTE]
+            # Grade statistics and profiles, calculated together with
+            # the climb
+            options = {}
+            if self.parameterAsBool(parameters, self.GRADES, context):
+                options['gradebounds'] = self.gradeBounds(parameters, context,
+                                                          feedback)
+                newfields = newfields + self.gradeFields(
+                    options['gradebounds'])
+            profilefile = self.parameterAsFileOutput(parameters,
+                                                     self.PROFILES, context)
+            if profilefile:
+                options['profiles'] = True
+                profilestore = ProfileStore(profilefile)
+            for suffix, extrasampler in extras:
+                newfields = newfields + [self.CLIMBATTRIBUTE + '_' + suffix,
+                                         self.DESCENTATTRIBUTE + '_' + suffix,
+                                         self.MINELEVATTRIBUTE + '_' + suffix,
+                                         self.MAXELEVATTRIBUTE + '_' + suffix]
+            writer = ClimbWriter(source.fields(), newfields, copyfields,
+                                 feedback)
+
+            # If a DEM is provided, use it to extract z values
+            if demraster:
+                # Get the raster band with the z value
+                demband = self.parameterAsString(parameters,
+                                                 self.BANDDEM,
+                                                 context)
+                sampling = self.parameterAsEnum(parameters,
+                                                self.DEMSAMPLING,
                                                 context)
-        # Add fields to the output layer
-        # Add fields from the input layer
-        thefields = QgsFields()
-        climbindex = -1
-        descentindex = -1
-        fieldnumber = 0
-        # Skip fields with names that are equal to the generated ones
-        for field in source.fields():
-            if str(field.name()) == str(self.CLIMBATTRIBUTE):
-                feedback.pushInfo("Warning: existing " +
-                                  str(self.CLIMBATTRIBUTE) +
-                                  " attribute found and removed")
-                climbindex = fieldnumber
-            elif str(field.name()) == str(self.DESCENTATTRIBUTE):
-                feedback.pushInfo("Warning: existing " +
-                                  str(self.DESCENTATTRIBUTE) +
-                                  " attribute found and removed")
-                descentindex = fieldnumber
+                if sampling != self.DRAPE:
+                    sampler = self.demSampler(parameters, context, demraster,
+                                              demband, sampling, source,
+                                              feedback)
+            drape = False
+            if sampler is not None:
+                feedback.pushInfo("Sampling Z values from DEM (" +
+                                  self.samplingMethods()[sampling] + ") at " +
+                                  sampler.levelDescription())
+                if sampler.method == TRAVERSE:
+                    # The climb is calculated from the crossed cells
+                    metrics.points = 'cells'
+                outputwkbtype = source.wkbType()
+            elif demraster:
+                # The Z values are added by Drape, one batch at a time
+                feedback.pushInfo("Adding Z values from DEM using " +
+                                  "Drape (setzfromraster) ...")
+                drape = True
+                outputwkbtype = QgsWkbTypes.addZ(source.wkbType())
             else:
-                thefields.append(field)
-            fieldnumber = fieldnumber + 1
-        # Create new fields for climb, descent, minimum elevation
-        # and maximum elevation
-        thefields.append(QgsField(self.CLIMBATTRIBUTE, QVariant.Double))
-        thefields.append(QgsField(self.DESCENTATTRIBUTE, QVariant.Double))
-        thefields.append(QgsField(self.MINELEVATTRIBUTE, QVariant.Double))
-        thefields.append(QgsField(self.MAXELEVATTRIBUTE, QVariant.Double))
-
-        # If a DEM is provided, use it to extract z values
-        if demraster:
-            # Get the raster band with the z value
-            demband = self.parameterAsString(parameters,
-                                             self.BANDDEM,
-                                             context)
-            feedback.pushInfo("Adding Z values from DEM using " +
-                              "Drape (setzfromraster) ...")
-            # Add the z values
-            withz = processing.run("native:setzfromraster",
-                                 {"INPUT": parameters[self.INPUT],
-                                  "RASTER": demraster,
-                                  "BAND": demband,
-                                  "OUTPUT": "memory:"},
-                                 context=context,
-                                 feedback=feedback,
-                                 is_child_algorithm=True)["OUTPUT"]
-            feedback.pushInfo("Z values added.")
-            layerwithz = context.temporaryLayerStore().mapLayer(withz)
-        else:
-            layerwithz = source
-        # Retrieve the feature sink. The 'dest_id' variable is used
-        # to uniquely identify the feature sink, and must be included
-        # in the dictionary returned by the processAlgorithm
-        # function.
-        (sink, dest_id) = self.parameterAsSink(parameters,
-                                               self.OUTPUT,
-                                               context, thefields,
-                                               layerwithz.wkbType(),
-                                               source.sourceCrs())
-        # get features from source (with z values)
-        features = layerwithz.getFeatures()
-        totalclimb = 0
-        totaldescent = 0
-        minelevation = float('Infinity')
-        maxelevation = float('-Infinity')
-        for current, feature in enumerate(features):
+                outputwkbtype = source.wkbType()
+            # Retrieve the feature sink. The 'dest_id' variable is used
+            # to uniquely identify the feature sink, and must be included
+            # in the dictionary returned by the processAlgorithm
+            # function.
+            (sink, dest_id) = self.parameterAsSink(parameters,
+                                                   self.OUTPUT,
+                                                   context,
+                                                   writer.outputFields(),
+                                                   outputwkbtype,
+                                                   source.sourceCrs())
+            # Totals per group, written to a table
+            groupindex = -1
+            groups = None
+            groupsink = None
+            groupdest = None
+            groupfield = self.parameterAsString(parameters, self.GROUPBY,
+                                                context)
+            if groupfield:
+                groupindex = source.fields().lookupField(groupfield)
+                groupfields = QgsFields()
+                groupfields.append(source.fields().at(groupindex))
+                groupfields.append(QgsField(self.FEATURESATTRIBUTE,
+                                            QVariant.Int))
+                for name in [self.CLIMBATTRIBUTE, self.DESCENTATTRIBUTE,
+                             self.MINELEVATTRIBUTE, self.MAXELEVATTRIBUTE]:
+                    groupfields.append(QgsField(name, QVariant.Double))
+                (groupsink, groupdest) = self.parameterAsSink(
+                    parameters, self.GROUPOUTPUT, context, groupfields,
+                    QgsWkbTypes.NoGeometry, QgsCoordinateReferenceSystem())
+                groups = GroupTotals()
+            # Features per chunk and worker processes
+            chunksize = self.parameterAsInt(parameters, self.CHUNKSIZE,
+                                            context)
+            workers = self.parameterAsInt(parameters, self.WORKERS, context)
+            if workers != 1:
+                pool = ChunkPool(workers, sampler.arguments
+                                 if sampler is not None else None, options)
+                feedback.pushInfo("Using " + str(pool.workers) +
+                                  " worker processes")
+            # Persistent cache of results from earlier runs
+            cache = None
+            cachefile = self.parameterAsFileOutput(parameters,
+                                                   self.RESULTCACHE, context)
+            if cachefile and options:
+                feedback.pushInfo("The result cache is not used with grade " +
+                                  "statistics or profiles")
+            elif cachefile:
+                if sampler is not None:
+                    zsource = sampler.identity()
+                elif drape:
+                    zsource = ('drape|' + file_identity(demraster.source()) +
+                               '|' + str(demband))
+                else:
+                    zsource = 'geometry'
+                maxentries = self.parameterAsInt(parameters,
+                                                 self.RESULTCACHEENTRIES,
+                                                 context)
+                cache = ResultCache(cachefile, zsource, maxentries)
+            # With the grid index, the statistics are calculated cell by
+            # cell before the features are written in their original order
+            precomputed = None
+            progressbase = 0
+            if sampler is not None and self.parameterAsBool(parameters,
+                                                            self.GRIDINDEX,
+                                                            context):
+                precomputed = self.gridStatistics(source, sampler, pool, cache,
+                                                  chunksize, feedback, options,
+                                                  metrics)
+                progressbase = 50
+            # Stream the features from the source, one batch at a time.
+            # Without an output layer, only the geometries (and the group
+            # field) are needed.
+            request = QgsFeatureRequest()
+            groupattributes = [groupindex] if groupindex >= 0 else []
+            if sink is None:
+                feedback.pushInfo("No output layer - calculating the " +
+                                  "totals only")
+                request.setSubsetOfAttributes(groupattributes)
+            elif not writer.copyall:
+                request.setSubsetOfAttributes(
+                    sorted(set(writer.requestAttributes() + groupattributes)))
+            batches = self.featureBatches(source.getFeatures(request),
+                                          chunksize, feedback, metrics)
+            drapewkbs = None
+            if drape and sink is None and cache is not None:
+                # The result cache is looked up with the input geometries,
+                # and only the features that are not found are draped
+                drapewkbs = (lambda wkbs: self.drapeWkbs(wkbs, source,
+                                                         demraster, demband,
+                                                         context, metrics))
+            elif drape:
+                # The output layer gets the draped geometries
+                if cache is not None:
+                    feedback.pushInfo("All the features are draped for the " +
+                                      "output layer - the result cache " +
+                                      "only saves the climb calculation")
+                batches = self.drapeBatches(batches, source, demraster,
+                                            demband, context, metrics)
+            if precomputed is not None:
+                results = self.precomputedResults(batches, precomputed,
+                                                  extras, metrics)
+            else:
+                results = self.batchResults(batches, sampler, pool, cache,
+                                            feedback, options, metrics,
+                                            drapewkbs, extras)
+            totals = ClimbTotals()
+            extratotals = [ClimbTotals() for extra in extras]
+            current = 0
+            progress = ProgressThrottle(feedback.setProgress)
+            for batch, stats, extrastats in results:
+                if groups is not None:
+                    with metrics.timer('groups'):
+                        keys = [self.groupKey(feature.attributes()[groupindex])
+                                for feature in batch]
+                        groups.add(keys, stats)
+                self.processBatch(batch, stats, sink, writer, totals,
+                                  feedback, extrastats, extratotals,
+                                  profilestore, metrics)
+                current = current + len(batch)
+                # Update the progress bar
+                if fcount > 0:
+                    progress.update(progressbase +
+                                    (100 - progressbase) * current / fcount)
+            if profilestore is not None:
+                feedback.pushInfo("Profile store: " +
+                                  str(profilestore.count) + " features, " +
+                                  str(profilestore.vertices) + " vertices")
+                profilestore.close()
+                profilestore = None
+            if groups is not None:
+                feedback.pushInfo("Group totals: " + str(groups.groupCount()) +
+                                  " groups")
+                if groupsink is not None:
+                    with metrics.timer('write'):
+                        self.writeGroups(groupsink, groupfields, groups)
+            # The missing Z values are reported once, with the other
+            # counters and the time used by each stage
+            feedback.pushInfo(metrics.summary())
+            metricsfile = self.parameterAsFileOutput(parameters, self.METRICS,
+                                                     context)
+            if metricsfile:
+                metrics.writeReport(metricsfile,
+                                    self.metricsReport(sampler, cache, pool))
+            if cache is not None:
+                feedback.pushInfo(cache.statistics())
+            if sampler is not None:
+                feedback.pushInfo(sampler.statistics(
+                    self.samplerCounters(sampler, pool)))
+            totalclimb = totals.climb
+            totaldescent = totals.descent
+            minelevation = totals.minelevation
+            maxelevation = totals.maxelevation
+            # Return the results
+            results = {self.OUTPUT: dest_id, self.GROUPOUTPUT: groupdest,
+                       self.PROFILES: profilefile,
+                       self.METRICS: metricsfile,
+                       self.TOTALCLIMB: totalclimb,
+                       self.TOTALDESCENT: totaldescent,
+                       self.MINELEVATION: minelevation,
+                       self.MAXELEVATION: maxelevation}
+            # The totals for each extra DEM, with the suffix of its fields
+            for (suffix, extrasampler), extratotal in zip(extras, extratotals):
+                feedback.pushInfo(suffix + ": total climb " +
+                                  str(extratotal.climb) + ", total descent " +
+                                  str(extratotal.descent) + ", elevation " +
+                                  str(extratotal.minelevation) + " - " +
+                                  str(extratotal.maxelevation))
+                results[self.TOTALCLIMB + '_' + suffix] = extratotal.climb
+                results[self.TOTALDESCENT + '_' + suffix] = extratotal.descent
+                results[self.MINELEVATION + '_' + suffix] = (
+                    extratotal.minelevation)
+                results[self.MAXELEVATION + '_' + suffix] = (
+                    extratotal.maxelevation)
+            return results
+        finally:
+            self.closeResources(pool, profilestore, cache, sampler,
+                                extras)
+
+    def closeResources(self, pool, profilestore, cache, sampler, extras):
+        """
+        Stops the worker processes and closes the result cache and
+        the DEM samplers.  A profile store that is still open (the
+        run did not complete) is discarded.
+        """
+        if pool is not None:
+            pool.close()
+        if profilestore is not None:
+            profilestore.discard()
+        if cache is not None:
+            cache.close()
+        if sampler is not None:
+            sampler.close()
+        for suffix, extrasampler in extras:
+            extrasampler.close()
+
+    def processBatch(self, features, stats, sink, writer, totals,
+                     feedback, extrastats=(), extratotals=(),
+                     profilestore=None, metrics=None):
+        """
+        Updates the layer totals with the climb, descent, minimum and
+        maximum elevation (ClimbStatistics) of a batch of features,
+        and writes the features with these values (and the grade
+        statistics, if calculated) to the sink (if any).  extrastats
+        and extratotals are the statistics and the totals for the
+        extra DEMs.  The profiles are added to the profile store (if
+        any).  The features, vertices and missing Z values are
+        counted in metrics (RunMetrics).
+        """
+        if metrics is None:
+            metrics = RunMetrics()
+        metrics.countStatistics(stats)
+        totals.add(stats)
+        columns = [stats.climb.tolist(), stats.descent.tolist(),
+                   stats.minelev.tolist(), stats.maxelev.tolist()]
+        if stats.grades is not None:
+            columns = columns + stats.grades.T.tolist()
+        if profilestore is not None:
+            with metrics.timer('profiles'):
+                profilestore.add([feature.id() for feature in features],
+                                 stats.profiles)
+        for extra, extratotal in zip(extrastats, extratotals):
+            extratotal.add(extra)
+            columns = columns + [extra.climb.tolist(),
+                                 extra.descent.tolist(),
+                                 extra.minelev.tolist(),
+                                 extra.maxelev.tolist()]
+        if sink is not None:
+            with metrics.timer('write'):
+                writer.write(sink, features, columns)
+
+    def samplerCounters(self, sampler, pool):
+        """
+        Returns the counters of the DEM sampling (see
+        DemSampler.counters).  With worker processes, the DEM is
+        sampled in the workers, and their totals are returned.
+        """
+        counters = sampler.counters()
+        if pool is not None:
+            for name in counters:
+                counters[name] = pool.counters[name]
+        return counters
+
+    def metricsReport(self, sampler, cache, pool):
+        """
+        Returns the DEM sampling, result cache and worker counters
+        for the run metrics report.
+        """
+        report = {}
+        if pool is not None:
+            report['workers'] = pool.workers
+        if sampler is not None:
+            report['dem'] = {'memmap': sampler.memmap is not None}
+            report['dem'].update(self.samplerCounters(sampler, pool))
+        if cache is not None:
+            report['resultcache'] = {'hits': cache.hits,
+                                     'misses': cache.misses}
+        return report
+
+    def gradeBounds(self, parameters, context, feedback):
+        """
+        Returns the (sorted) limits of the grade classes.
+        """
+        bounds = []
+        classes = self.parameterAsString(parameters, self.GRADECLASSES,
+                                         context)
+        for bound in (classes or '').split(','):
+            if not bound.strip():
+                continue
+            try:
+                bounds.append(float(bound))
+            except ValueError:
+                feedback.pushInfo("Invalid grade class limit: " + bound)
+        return sorted(set(bound for bound in bounds if bound > 0))
+
+    def gradeFields(self, bounds):
+        """
+        Returns the names of the grade statistics fields: maximum
+        grade, mean grade and the horizontal length in each grade
+        class (e.g. grade_3_6 for 3 - 6 %).
+        """
+        names = [('%g' % bound).replace('.', 'p') for bound in bounds]
+        lowers = ['0'] + names
+        uppers = names + ['plus']
+        return ([self.MAXGRADEATTRIBUTE, self.MEANGRADEATTRIBUTE] +
+                ['grade_' + lower + '_' + upper
+                 for lower, upper in zip(lowers, uppers)])
+
+    def extraBands(self, parameters, context):
+        """
+        Returns the bands of the extra DEMs (EXTRABANDS), as strings
+        (['1'] if none are given).  They are checked by
+        checkParameterValues.
+        """
+        bandstring = self.parameterAsString(parameters, self.EXTRABANDS,
+                                            context)
+        return [band.strip() for band in (bandstring or '1').split(',')
+                if band.strip()] or ['1']
+
+    def extraSamplers(self, parameters, context, source, feedback):
+        """
+        Returns (suffix, DemSampler) for each band (EXTRABANDS) of
+        each of the extra DEMs (EXTRADEMS).  The suffix is made from
+        the name of the DEM (and the band if there are several).
+        DEMs that can not be sampled directly are skipped.
+        """
+        demrasters = self.parameterAsLayerList(parameters, self.EXTRADEMS,
+                                               context)
+        if not demrasters:
+            return []
+        bands = self.extraBands(parameters, context)
+        sampling = self.parameterAsEnum(parameters, self.DEMSAMPLING,
+                                        context)
+        extras = []
+        suffixes = set()
+        for demraster in demrasters:
+            name = re.sub('[^0-9a-zA-Z_]', '_', demraster.name()).lower()
+            for band in bands:
+                suffix = name if len(bands) == 1 else name + '_' + band
+                while suffix in suffixes:
+                    suffix = suffix + '_'
+                sampler = self.demSampler(parameters, context, demraster,
+                                          band, sampling, source,
+                                          feedback, 'skipped')
+                if sampler is None:
+                    continue
+                suffixes.add(suffix)
+                feedback.pushInfo("Comparing with " + demraster.name() +
+                                  " (band " + str(sampler.bandnumber) +
+                                  "), fields with suffix _" + suffix)
+                extras.append((suffix, sampler))
+        return extras
+
+    def extraStatistics(self, vertices, extras, metrics=None):
+        """
+        Returns the statistics (ClimbStatistics) of a batch of
+        decoded features (VertexBatch) for each of the extra DEMs.
+        The DEMs sample copies of the coordinates, so vertices can
+        be used for the main DEM afterwards.
+        """
+        if not extras:
+            return []
+        if metrics is None:
+            metrics = RunMetrics()
+        # sampleBatch replaces the Z values of its batch
+        x = vertices.x.copy()
+        y = vertices.y.copy()
+        extrastats = []
+        for suffix, sampler in extras:
+            with metrics.timer('z'):
+                extravertices = sampler.sampleBatch(
+                    VertexBatch(x, y, vertices.z, vertices.part_offsets,
+                                vertices.feature_offsets))
+            with metrics.timer('climb'):
+                extrastats.append(climb_statistics(extravertices))
+        return extrastats
+
+    def groupKey(self, value):
+        """
+        Returns the group key for an attribute value (None for NULL).
+        """
+        if isinstance(value, QVariant):
+            return None
+        return value
+
+    def writeGroups(self, sink, fields, groups):
+        """
+        Writes the totals (GroupTotals) of the groups to the sink,
+        BATCHSIZE rows at a time.
+        """
+        batch = []
+        for row in groups.rows():
+            feature = QgsFeature(fields)
+            feature.setAttributes(list(row))
+            batch.append(feature)
+            if len(batch) >= self.BATCHSIZE:
+                sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+                batch = []
+        if batch:
+            sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+
+    def featureBatches(self, features, batchsize, feedback, metrics=None):
+        """
+        Yields lists of (at most) batchsize features.  Stops if the
+        algorithm is cancelled.
+        """
+        if metrics is None:
+            metrics = RunMetrics()
+        batch = []
+        for feature in metrics.timed('read', features):
             # Stop the algorithm if cancelled
             if feedback.isCanceled():
-                break
-            climb = 0
-            descent = 0
-            minelev = float('Infinity')
-            maxelev = float('-Infinity')
-            # In case of multigeometries we need to do the parts
-            for part in feature.geometry().constParts():
-                # Calculate the climb
-                first = True
-                zval = 0
-                for v in part.vertices():
-                    zval = v.z()
-                    # Check if we do not have a valid z value
-                    if math.isnan(zval):
-                        feedback.pushInfo("Missing Z value")
-                        continue
-                    if first:
-                        prevz = zval
-                        minelev = zval
-                        maxelev = zval
-                        first = False
-                    else:
-                        diff = zval - prevz
-                        if diff > 0:
-                            climb = climb + diff
-                        else:
-                            descent = descent - diff
-                        if minelev > zval:
-                            minelev = zval
-                        if maxelev < zval:
-                            maxelev = zval
-                    prevz = zval
-                totalclimb = totalclimb + climb
-                totaldescent = totaldescent + descent
-            # Set the attribute values
-            attrs = feature.attributes()
-            outattrs = []
-            attrindex = 0
-            for attr in attrs:
-                # Skip attributes from the input layer that had names
-                # that were equal to the generated ones
-                if not (attrindex == climbindex or
-                        attrindex == descentindex):
-                    outattrs.append(attr)
-                attrindex = attrindex + 1
-            # feature.setAttributes(outattrs + [climb, descent])
-            feature.setAttributes(outattrs +
-                                  [climb, descent, minelev, maxelev])
-            # Add a feature to the sink
-            sink.addFeature(feature, QgsFeatureSink.FastInsert)
-            if minelevation > minelev:
-                    minelevation = minelev
-            if maxelevation < maxelev:
-                    maxelevation = maxelev
-            # Update the progress bar
-            if fcount > 0:
-                feedback.setProgress(int(100 * current / fcount))
-        # Return the results
-        return {self.OUTPUT: dest_id, self.TOTALCLIMB: totalclimb,
-                self.TOTALDESCENT: totaldescent,
-                self.MINELEVATION: minelevation,
-                self.MAXELEVATION: maxelevation}
+                return
+            batch.append(feature)
+            if len(batch) >= batchsize:
+                yield batch
+                batch = []
+        if batch and not feedback.isCanceled():
+            yield batch
+
+    def drapeBatches(self, batches, source, demraster, demband, context,
+                     metrics=None):
+        """
+        Adds Z values from the DEM to batches of features using Drape
+        (native:setzfromraster), and yields the batches of features
+        with Z values.  The draped geometries are set on the input
+        features, so the feature ids (the features are draped in a
+        new memory layer) and the attributes are kept.  Only one
+        batch at a time is kept in memory.
+        """
+        if metrics is None:
+            metrics = RunMetrics()
+        for batch in batches:
+            with metrics.timer('drape'):
+                geometries = self.drapeGeometries(batch, source.fields(),
+                                                  source, demraster,
+                                                  demband, context)
+                for feature, geometry in zip(batch, geometries):
+                    feature.setGeometry(geometry)
+            yield batch
+
+    def drapeWkbs(self, wkbs, source, demraster, demband, context,
+                  metrics=None):
+        """
+        Returns the WKB geometries with Z values from the DEM added
+        by Drape (native:setzfromraster).
+        """
+        if metrics is None:
+            metrics = RunMetrics()
+        if not wkbs:
+            return []
+        with metrics.timer('drape'):
+            features = []
+            for wkb in wkbs:
+                geometry = QgsGeometry()
+                geometry.fromWkb(wkb)
+                feature = QgsFeature()
+                feature.setGeometry(geometry)
+                features.append(feature)
+            geometries = self.drapeGeometries(features, QgsFields(),
+                                              source, demraster, demband,
+                                              context)
+            return [bytes(geometry.asWkb()) for geometry in geometries]
+
+    def drapeGeometries(self, features, fields, source, demraster,
+                        demband, context):
+        """
+        Runs Drape (native:setzfromraster) on the features (with the
+        given fields), and returns the draped geometries in the
+        order of the features.  Raises QgsProcessingException if a
+        feature is lost on the way.
+        """
+        batchlayer = QgsMemoryProviderUtils.createMemoryLayer(
+            'batch', fields, source.wkbType(), source.sourceCrs())
+        added, addedfeatures = batchlayer.dataProvider().addFeatures(
+            features)
+        if not added:
+            raise QgsProcessingException(
+                'Unable to add the features to the layer for Drape: ' +
+                batchlayer.dataProvider().lastError())
+        withz = processing.run("native:setzfromraster",
+                               {"INPUT": batchlayer,
+                                "RASTER": demraster,
+                                "BAND": demband,
+                                "OUTPUT": "memory:"},
+                               context=context,
+                               feedback=QgsProcessingFeedback(),
+                               is_child_algorithm=True)["OUTPUT"]
+        store = context.temporaryLayerStore()
+        geometries = [feature.geometry() for feature
+                      in store.mapLayer(withz).getFeatures()]
+        store.removeMapLayer(withz)
+        if len(geometries) != len(features):
+            raise QgsProcessingException(
+                'Drape returned ' + str(len(geometries)) +
+                ' features for ' + str(len(features)))
+        return geometries
+
+    def batchResults(self, batches, sampler, pool, cache, feedback,
+                     options=None, metrics=None, drape=None, extras=()):
+        """
+        Calculates climb, descent, minimum and maximum elevation for
+        batches of features, and yields (batch, ClimbStatistics, extra
+        statistics) triples in the order of the batches.  If a DEM
+        sampler is given, the Z values are taken from the DEM, otherwise
+        from the geometries.  With a pool, the batches are handled by
+        the worker processes.  With a result cache, only the features
+        that are not found in the cache are calculated.  drape (optional)
+        is a function that adds Z values to a list of WKB geometries,
+        and is called after the cache lookup, so that only the features
+        that are not in the cache are draped.  options are keyword
+        arguments for climb_statistics.  The extra statistics are the
+        statistics for each of the extra DEMs (extras, see
+        extraSamplers), calculated in this process for all the features
+        of the batch.  The time used by each stage is added to metrics
+        (RunMetrics).
+        """
+        if metrics is None:
+            metrics = RunMetrics()
+        chunks = self.wkbChunks(batches, metrics)
+        if pool is None and cache is None and drape is None:
+            # The batch is decoded once for the DEM and the extra DEMs
+            for batch, wkbs in chunks:
+                with metrics.timer('decode'):
+                    vertices = decode_wkb_batch(wkbs)
+                extrastats = self.extraStatistics(vertices, extras, metrics)
+                yield (batch,
+                       self.vertexStatistics(vertices, sampler, options,
+                                             metrics),
+                       extrastats)
+            return
+        if extras:
+            # The geometries of all the features are kept for the extra
+            # DEMs
+            chunks = (((batch, wkbs), wkbs) for batch, wkbs in chunks)
+        if cache is not None:
+            chunks = metrics.timed('cache', cache.split(chunks))
+        if drape is not None:
+            chunks = ((payload, drape(wkbs)) for payload, wkbs in chunks)
+        if pool is not None:
+            # The Z values and the climb are calculated by the workers
+            results = metrics.timed('workers',
+                                    pool.map(chunks, feedback.isCanceled))
+        else:
+            results = ((payload, self.wkbStatistics(wkbs, sampler,
+                                                    options, metrics))
+                       for payload, wkbs in chunks)
+        if cache is not None:
+            results = metrics.timed('cache', cache.merge(results))
+        for payload, stats in results:
+            if not extras:
+                yield payload, stats, []
+                continue
+            batch, wkbs = payload
+            with metrics.timer('decode'):
+                vertices = decode_wkb_batch(wkbs)
+            yield batch, stats, self.extraStatistics(vertices, extras,
+                                                     metrics)
+
+    def precomputedResults(self, batches, precomputed, extras,
+                           metrics=None):
+        """
+        Yields (batch, ClimbStatistics, extra statistics) triples for
+        batches of features, with the statistics calculated by
+        gridStatistics (precomputed).  The extra statistics are
+        calculated as in batchResults.
+        """
+        if metrics is None:
+            metrics = RunMetrics()
+        allstats, rows = precomputed
+        for batch in batches:
+            stats = allstats.take([rows[feature.id()] for feature in batch])
+            extrastats = []
+            if extras:
+                with metrics.timer('decode'):
+                    vertices = decode_wkb_batch(
+                        [bytes(feature.geometry().asWkb())
+                         for feature in batch])
+                extrastats = self.extraStatistics(vertices, extras, metrics)
+            yield batch, stats, extrastats
+
+    def wkbChunks(self, batches, metrics):
+        """
+        Yields (batch, WKB geometries) pairs for batches of features.
+        """
+        for batch in batches:
+            with metrics.timer('decode'):
+                wkbs = [bytes(feature.geometry().asWkb())
+                        for feature in batch]
+            yield batch, wkbs
+
+    def wkbStatistics(self, wkbs, sampler, options=None, metrics=None):
+        """
+        Calculates the statistics (ClimbStatistics) for WKB
+        geometries, with Z values from the DEM sampler if given.
+        With metrics (RunMetrics), the decoding, the Z values and
+        the climb calculation are timed.
+        """
+        if metrics is None:
+            return wkb_statistics(wkbs, sampler, **(options or {}))
+        with metrics.timer('decode'):
+            vertices = decode_wkb_batch(wkbs)
+        return self.vertexStatistics(vertices, sampler, options, metrics)
+
+    def vertexStatistics(self, vertices, sampler, options=None,
+                         metrics=None):
+        """
+        Calculates the statistics (ClimbStatistics) for decoded
+        features (VertexBatch), with Z values from the DEM sampler
+        if given.
+        """
+        if metrics is None:
+            metrics = RunMetrics()
+        if sampler is not None:
+            with metrics.timer('z'):
+                vertices = sampler.sampleBatch(vertices)
+        with metrics.timer('climb'):
+            return climb_statistics(vertices, **(options or {}))
+
+    def gridStatistics(self, source, sampler, pool, cache, chunksize,
+                       feedback, options=None, metrics=None):
+        """
+        Calculates the statistics of all the features, grouped by
+        the cells of a coarse grid index with cells the size of the
+        DEM blocks, so that the DEM blocks of a cell are read once.
+        Returns the statistics and a dictionary that gives the index
+        into the statistics for each feature id.
+        """
+        if metrics is None:
+            metrics = RunMetrics()
+        cellwidth, cellheight = sampler.blockExtent()
+        # The cells are in the CRS of the DEM
+        index = GridIndex(cellwidth, cellheight,
+                          sampler.transformCoordinates)
+        nogeometry = []
+        # Only the bounding boxes are needed
+        request = QgsFeatureRequest().setSubsetOfAttributes([])
+        with metrics.timer('index'):
+            for feature in source.getFeatures(request):
+                if feedback.isCanceled():
+                    break
+                geometry = feature.geometry()
+                if geometry.isNull() or geometry.isEmpty():
+                    nogeometry.append(feature.id())
+                    continue
+                bbox = geometry.boundingBox()
+                index.insert(feature.id(), bbox.xMinimum(),
+                             bbox.yMinimum(), bbox.xMaximum(),
+                             bbox.yMaximum())
+            cells = index.cells()
+        if nogeometry:
+            cells.append(nogeometry)
+        feedback.pushInfo("Grid index: " + str(index.featureCount()) +
+                          " features in " + str(len(cells)) + " cells")
+        nfeatures = index.featureCount() + len(nogeometry)
+        statslist = []
+        rows = {}
+        current = 0
+        progress = ProgressThrottle(feedback.setProgress)
+        for batch, stats, extrastats in self.batchResults(
+                self.cellBatches(source, cells, chunksize, feedback,
+                                 metrics),
+                sampler, pool, cache, feedback, options, metrics):
+            statslist.append(stats)
+            for feature in batch:
+                rows[feature.id()] = current
+                current = current + 1
+            if nfeatures > 0:
+                progress.update(50 * current / nfeatures)
+        return concatenate_statistics(statslist), rows
+
+    def cellBatches(self, source, cells, batchsize, feedback,
+                    metrics=None):
+        """
+        Yields the features (geometries only) of the grid cells, in
+        batches of (at most) batchsize features.
+        """
+        if metrics is None:
+            metrics = RunMetrics()
+        for cell in cells:
+            for start in range(0, len(cell), batchsize):
+                if feedback.isCanceled():
+                    return
+                request = QgsFeatureRequest().setFilterFids(
+                    cell[start:start + batchsize])
+                request.setSubsetOfAttributes([])
+                with metrics.timer('read'):
+                    batch = list(source.getFeatures(request))
+                yield batch
+
+    def samplingMethods(self):
+        return [self.tr('Nearest neighbour'),
+                self.tr('Bilinear'),
+                self.tr('Drape (setzfromraster)'),
+                self.tr('Cells crossed by the lines')]
+
+    def demSampler(self, parameters, context, demraster, demband,
+                   sampling, source, feedback, fallback='using Drape'):
+        """
+        Returns a sampler for the built-in DEM sampling, or None if
+        the DEM can not be sampled directly (Drape will then be used,
+        fallback is reported).
+        """
+        if demraster.providerType() != 'gdal':
+            feedback.pushInfo("The DEM " + demraster.name() +
+                              " is not a GDAL raster - " + fallback)
+            return None
+        # The coordinates are transformed to the CRS of the DEM
+        sourcecrs = None
+        operation = None
+        if demraster.crs() != source.sourceCrs():
+            if not source.sourceCrs().isValid():
+                feedback.pushInfo("The line layer has no CRS - " +
+                                  fallback)
+                return None
+            sourcecrs = source.sourceCrs().toWkt()
+            operation = coordinate_operation(context.transformContext(),
+                                             source.sourceCrs(),
+                                             demraster.crs())
+            feedback.pushInfo("The DEM " + demraster.name() +
+                              " and the line layer have different " +
+                              "CRS - transforming the coordinates")
+        try:
+            band = int(demband)
+        except (TypeError, ValueError):
+            band = 1
+        method = NEAREST
+        if sampling == self.BILINEAR:
+            method = BILINEAR
+        elif sampling == self.TRAVERSE:
+            method = TRAVERSE
+        tilesize = self.parameterAsInt(parameters, self.DEMTILESIZE,
+                                       context)
+        cachesize = self.parameterAsInt(parameters, self.DEMCACHESIZE,
+                                        context)
+        usememmap = self.parameterAsBool(parameters, self.DEMMEMMAP,
+                                         context)
+        # Sample each unique vertex once?
+        deduplicate = self.parameterAsBool(parameters, self.DEMDEDUPLICATE,
+                                           context)
+        snap = self.parameterAsDouble(parameters, self.DEMSNAP, context)
+        # Sample an overview (pyramid level) of the DEM?
+        resolution = self.parameterAsEnum(parameters, self.DEMRESOLUTION,
+                                          context)
+        maxcellsize = None
+        if resolution == self.OVERVIEWTOLERANCE:
+            maxcellsize = self.parameterAsDouble(parameters,
+                                                 self.DEMTOLERANCE,
+                                                 context)
+        elif resolution == self.OVERVIEWSPACING:
+            maxcellsize = self.vertexSpacing(source, feedback, sourcecrs,
+                                             demraster.crs().toWkt(),
+                                             operation)
+        try:
+            # The CRS of the layer, that may differ from the CRS of
+            # the file
+            return DemSampler(demraster.source(), band, method,
+                              tilesize, cachesize, usememmap,
+                              maxcellsize, deduplicate, snap, sourcecrs,
+                              operation, demraster.crs().toWkt() or None)
+        except IOError as e:
+            feedback.pushInfo(str(e) + " - " + fallback)
+            return None
+
+    def resolutionOptions(self):
+        return [self.tr('Full resolution'),
+                self.tr('Coarsest overview within the tolerance'),
+                self.tr('Overview from the median vertex spacing')]
+
+    def vertexSpacing(self, source, feedback, sourcecrs=None,
+                      demcrs=None, operation=None):
+        """
+        Returns the median vertex spacing of (the first features of)
+        the line layer, in the CRS of the DEM if sourcecrs is given.
+        """
+        request = QgsFeatureRequest().setSubsetOfAttributes([])
+        request.setLimit(self.SPACINGSAMPLE)
+        vertices = decode_wkb_batch([bytes(feature.geometry().asWkb())
+                                     for feature in
+                                     source.getFeatures(request)])
+        if sourcecrs:
+            vertices.x, vertices.y = transform_coordinates(
+                coordinate_transform(sourcecrs, demcrs, operation),
+                vertices.x, vertices.y)
+        spacing = median_vertex_spacing(vertices)
+        feedback.pushInfo("Median vertex spacing: " + str(spacing))
+        return spacing
 
     def shortHelpString(self):
         return("The total climb and descent along the line "
@@ -319,11 +1358,29 @@ class ClimbAlgorithm(QgsProcessingAlgorithm):
                "using the Z values for the points making up "
                "the lines.<br> "
                "Z values can be provided by the line geometries or "
-               "a DEM (by using the <i>Drape (set z-value from "
-               "raster)</i> algorithm to assign Z values to the "
-               "points that make up the lines).<br> "
+               "a DEM.<br> "
                "If a DEM is specified, Z values will be taken from "
-               "the DEM and not the line layer.<br>"
+               "the DEM and not the line layer.  The DEM is sampled "
+               "directly at the points that make up the lines "
+               "(<i>Nearest neighbour</i> or <i>Bilinear</i>), or "
+               "in every DEM cell crossed by the lines (<i>Cells "
+               "crossed by the lines</i>, without densifying the "
+               "lines), "
+               "or the <i>Drape (set z-value from raster)</i> "
+               "algorithm can be used to assign Z values to the "
+               "points (<i>Drape</i>, applied to one chunk of "
+               "features at a time).  Drape is also used if the DEM "
+               "can not be read by GDAL.  If the DEM is in another CRS "
+               "than the line layer, the coordinates are transformed "
+               "to the CRS of the DEM for the sampling (the output "
+               "geometries are not changed), with the datum "
+               "transformation selected in the project (with GDAL "
+               "3.1 or later, otherwise the one PROJ picks).  With "
+               "direct sampling, points on DEM cells "
+               "with no data are ignored, and the geometries of the "
+               "output layer are the input geometries.  Points that "
+               "are shared by several lines (e.g. at junctions) are "
+               "sampled once.<br>"
                "The output layer (OUTPUT) has extra fields "
                "(<i>climb</i> and <i>descent</i>) "
                "that shall contain the total climb "
@@ -332,10 +1389,41 @@ class ClimbAlgorithm(QgsProcessingAlgorithm):
                "that shall contain the minimum and maximum elevation "
                "of each line geometry."
                "If these fields exist in the input layer, the "
-               "original fields will be removed.<br>"
+               "original fields will be removed.  Only the input "
+               "fields selected in <i>Fields to copy</i> (all by "
+               "default) are copied to the output layer.<br>"
                "The layer totals are returned in the TOTALCLIMB, "
                "TOTALDESCENT, MINELEVATION and MAXELEVATION output "
-               "parameters.")
+               "parameters.<br>"
+               "The output layer is optional.  If it is skipped, only "
+               "the geometries are read from the input layer, and "
+               "only the layer totals are calculated.<br>"
+               "If a <i>Group by field</i> is given, the number of "
+               "features, the total climb and descent and the minimum "
+               "and maximum elevation of each group (value of the "
+               "field) are calculated in the same pass, and written "
+               "to the <i>Group totals</i> table.<br>"
+               "<i>More DEMs to compare</i> (and their <i>Bands</i>) "
+               "are sampled directly in the same pass.  For each of "
+               "them, the output layer gets the climb, descent, "
+               "minelev and maxelev fields with the name of the DEM "
+               "(and the band) as a suffix, and the layer totals are "
+               "reported in the log and returned as TOTALCLIMB_suffix "
+               "etc.<br>"
+               "With <i>Calculate grade statistics</i>, the output "
+               "layer also gets the maximum grade (<i>maxgrade</i>), "
+               "the distance weighted mean grade (<i>meangrade</i>) "
+               "and the horizontal length in each grade class (e.g. "
+               "<i>grade_3_6</i>) of each line, in percent of the 2D "
+               "length.  A <i>Profile store</i> (.npz file) gets the "
+               "distance and elevation of each vertex of each line, "
+               "for drawing elevation profiles later.<br>"
+               "The number of vertices without a Z value and of "
+               "lines without a valid Z value are reported once, with "
+               "the time used by each stage (reading, Z values, "
+               "climb, writing, ...) in the log.  The same metrics "
+               "can be written to a <i>Run metrics report</i> (JSON "
+               "file).")
 
     def name(self):
         """
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Benchmarks with deterministic synthetic input: random walk line
+ layers and DEM rasters.  The climb kernel is timed by stage
+ (decoding, Z values, climb), and optionally the Climb along line
+ algorithm, with the time used by each of its stages (from the run
+ metrics report), if QGIS is available.  Each case runs in a process
+ of its own, so that its peak memory use is measured separately.
+ The results are written as JSON, so that runs can be compared.
+ From the folder that contains the plugin:
+
+     python -m Climb.Climb_benchmark --output results.json
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from osgeo import gdal, ogr, osr
+from .Climb_kernel import decode_wkb_batch, climb_statistics, ClimbTotals
+from .Climb_dem import DemSampler, NEAREST, BILINEAR, TRAVERSE
+
+# Version of the JSON result format
+RESULTVERSION = 2
+# The CRS of the synthetic data (UTM 32N)
+EPSG = 25832
+# The Z sources that are benchmarked: Z values of the geometries, or
+# a DEM sampling method
+CASES = (('geometry', None), ('nearest', NEAREST),
+         ('bilinear', BILINEAR), ('traverse', TRAVERSE))
+
+# The QGIS application and the Climb provider (algorithm benchmark)
+_application = None
+_provider = None
+
+
+def random_walk_lines(features, vertices, multipart=0.0, nanfraction=0.0,
+                      extent=(0.0, 0.0, 1000.0, 1000.0), step=10.0,
+                      seed=1):
+    """
+    Returns a list of WKB (ISO, with Z) geometries of random walk
+    lines inside extent (xmin, ymin, xmax, ymax).  Each feature has
+    (about) vertices vertices.  A fraction multipart of the features
+    are multi line strings with 2 or 3 parts, and a fraction
+    nanfraction of the Z values are NaN (missing).  The lines are
+    the same for the same arguments.
+    """
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = extent
+    wkbs = []
+    for f in range(features):
+        nparts = int(rng.integers(2, 4)) if rng.random() < multipart else 1
+        counts = [max(2, vertices // nparts)] * nparts
+        parts = []
+        for count in counts:
+            x = np.clip(rng.uniform(xmin, xmax) +
+                        np.cumsum(rng.normal(0, step, count)), xmin, xmax)
+            y = np.clip(rng.uniform(ymin, ymax) +
+                        np.cumsum(rng.normal(0, step, count)), ymin, ymax)
+            z = 100 + np.cumsum(rng.normal(0, 1, count))
+            z[rng.random(count) < nanfraction] = np.nan
+            parts.append(struct.pack('<BII', 1, 1002, count) +
+                         np.column_stack((x, y, z)).astype('<f8').tobytes())
+        if nparts == 1:
+            wkbs.append(parts[0])
+        else:
+            wkbs.append(struct.pack('<BII', 1, 1005, nparts) +
+                        b''.join(parts))
+    return wkbs
+
+
+def synthetic_dem(path, xsize, ysize, cellsize=1.0, tilesize=0, seed=1):
+    """
+    Writes a synthetic DEM (GeoTIFF, Float32) of xsize x ysize cells
+    with a smooth random surface plus noise, with the upper left
+    corner at (0, ysize * cellsize).  With tilesize > 0 the GeoTIFF
+    is tiled, otherwise it is stored in strips.  The DEM is the same
+    for the same arguments.
+    """
+    rng = np.random.default_rng(seed)
+    options = []
+    if tilesize > 0:
+        options = ['TILED=YES', 'BLOCKXSIZE=' + str(tilesize),
+                   'BLOCKYSIZE=' + str(tilesize)]
+    dataset = gdal.GetDriverByName('GTiff').Create(
+        path, xsize, ysize, 1, gdal.GDT_Float32, options)
+    dataset.SetGeoTransform((0.0, cellsize, 0.0, ysize * cellsize, 0.0,
+                             -cellsize))
+    reference = osr.SpatialReference()
+    reference.ImportFromEPSG(EPSG)
+    dataset.SetProjection(reference.ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(-9999)
+    # Coarse random grid, interpolated to the cells
+    coarse = rng.normal(0, 50, (17, 17)).cumsum(axis=0).cumsum(axis=1)
+    cols = np.arange(xsize) * 16.0 / max(xsize - 1, 1)
+    rows = 256
+    for yoff in range(0, ysize, rows):
+        nrows = min(rows, ysize - yoff)
+        fy = np.arange(yoff, yoff + nrows) * 16.0 / max(ysize - 1, 1)
+        byrow = np.array([np.interp(fy, np.arange(17), coarse[:, c])
+                          for c in range(17)]).T
+        surface = np.array([np.interp(cols, np.arange(17), line)
+                            for line in byrow])
+        noise = rng.normal(0, 0.5, (nrows, xsize))
+        band.WriteArray((500 + surface + noise).astype(np.float32),
+                        0, yoff)
+    band.FlushCache()
+    dataset = None
+    return path
+
+
+def write_lines(path, wkbs):
+    """
+    Writes the WKB line geometries to a GeoPackage (for the
+    algorithm benchmark).
+    """
+    datasource = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+    reference = osr.SpatialReference()
+    reference.ImportFromEPSG(EPSG)
+    layer = datasource.CreateLayer('lines', reference,
+                                   ogr.wkbMultiLineString25D)
+    layer.StartTransaction()
+    for wkb in wkbs:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.ForceToMultiLineString(
+            ogr.CreateGeometryFromWkb(wkb)))
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    datasource = None
+    return path
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of the process (MB), or None
+    if it is not available.  The peak never goes down, so each case
+    is run in a process of its own (see run).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return round(peak / 1048576.0, 1)
+    return round(peak / 1024.0, 1)
+
+
+def time_stages(wkbs, sampler, chunksize):
+    """
+    Runs the climb kernel (without QGIS) for the WKB geometries chunk
+    by chunk, and returns the time (seconds) used for decoding the
+    WKB, getting the Z values and calculating climb, the number of
+    vertices and the totals (ClimbTotals).
+    """
+    seconds = {'decode': 0.0, 'z': 0.0, 'climb': 0.0}
+    totals = ClimbTotals()
+    vertices = 0
+    for start in range(0, len(wkbs), chunksize):
+        t0 = time.perf_counter()
+        batch = decode_wkb_batch(wkbs[start:start + chunksize])
+        vertices = vertices + batch.vertexCount()
+        t1 = time.perf_counter()
+        if sampler is not None:
+            batch = sampler.sampleBatch(batch)
+        t2 = time.perf_counter()
+        stats = climb_statistics(batch)
+        totals.add(stats)
+        t3 = time.perf_counter()
+        seconds['decode'] = seconds['decode'] + t1 - t0
+        seconds['z'] = seconds['z'] + t2 - t1
+        seconds['climb'] = seconds['climb'] + t3 - t2
+    return seconds, vertices, totals
+
+
+def time_algorithm(linespath, dempath, sampling, chunksize, folder):
+    """
+    Runs the Climb along line algorithm (QGIS processing) with a run
+    metrics report, and returns the report (the time used by each
+    stage of the algorithm, the counters and the total time), or
+    None if QGIS is not available.  sampling is the DEMSAMPLING value
+    (None: Z values of the lines).
+    """
+    global _application, _provider
+    try:
+        from qgis.core import QgsApplication
+        from .Climb_provider import ClimbProvider
+    except ImportError:
+        return None
+    if QgsApplication.instance() is None:
+        _application = QgsApplication([], False)
+        _application.initQgis()
+    import processing
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    if QgsApplication.processingRegistry().providerById('climb') is None:
+        _provider = ClimbProvider()
+        QgsApplication.processingRegistry().addProvider(_provider)
+    reportpath = os.path.join(folder, 'metrics.json')
+    parameters = {'INPUT': linespath, 'OUTPUT': 'memory:',
+                  'CHUNKSIZE': chunksize, 'METRICS': reportpath}
+    if sampling is not None:
+        parameters['DEMFORZ'] = dempath
+        parameters['BANDDEM'] = 1
+        parameters['DEMSAMPLING'] = {NEAREST: 0, BILINEAR: 1,
+                                     TRAVERSE: 3}[sampling]
+    start = time.perf_counter()
+    processing.run('climb:climbalongline', parameters)
+    elapsed = time.perf_counter() - start
+    with open(reportpath) as reportfile:
+        report = json.load(reportfile)
+    os.remove(reportpath)
+    report['elapsed'] = elapsed
+    return report
+
+
+def run_case(name, method, wkbs, dempath, linespath, chunksize, folder):
+    """
+    Runs one case (in a process of its own), and returns its result.
+    """
+    baseline = peak_rss()
+    sampler = None
+    if method is not None:
+        sampler = DemSampler(dempath, 1, method)
+    start = time.perf_counter()
+    seconds, vertices, totals = time_stages(wkbs, sampler, chunksize)
+    total = time.perf_counter() - start
+    if sampler is not None:
+        sampler.close()
+    result = {'case': name, 'features': len(wkbs), 'vertices': vertices,
+              'seconds': dict(seconds, total=total),
+              'vertices_per_second': (vertices / total
+                                      if total > 0 else None),
+              'totalclimb': totals.climb,
+              'baseline_rss_mb': baseline}
+    if linespath is not None:
+        result['algorithm'] = time_algorithm(linespath, dempath, method,
+                                             chunksize, folder)
+    result['peak_rss_mb'] = peak_rss()
+    return result
+
+
+def run(arguments):
+    """
+    Generates the input and runs the benchmarks.  Each run of a case
+    is done in a new process, so that its peak memory use is
+    measured separately.  Returns the results (a dictionary that can
+    be written as JSON).
+    """
+    folder = tempfile.mkdtemp(prefix='climbbenchmark')
+    context = multiprocessing.get_context('spawn')
+    try:
+        dempath = synthetic_dem(os.path.join(folder, 'dem.tif'),
+                                arguments.dem_size, arguments.dem_size,
+                                tilesize=arguments.dem_tile,
+                                seed=arguments.seed)
+        size = float(arguments.dem_size)
+        wkbs = random_walk_lines(arguments.features, arguments.vertices,
+                                 arguments.multipart, arguments.nan,
+                                 (0.0, 0.0, size, size),
+                                 seed=arguments.seed)
+        linespath = None
+        if arguments.algorithm:
+            linespath = write_lines(os.path.join(folder, 'lines.gpkg'),
+                                    wkbs)
+        results = []
+        for name, method in CASES:
+            for repeat in range(arguments.repeat):
+                with ProcessPoolExecutor(1, mp_context=context) as pool:
+                    result = pool.submit(run_case, name, method, wkbs,
+                                         dempath, linespath,
+                                         arguments.chunk_size,
+                                         folder).result()
+                result['repeat'] = repeat
+                results.append(result)
+                sys.stderr.write(name + ': ' +
+                                 str(round(result['seconds']['total'],
+                                           3)) + ' s\n')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return {'version': RESULTVERSION,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'gdal': gdal.__version__,
+            'parameters': vars(arguments),
+            'results': results}
+
+
+def _arguments(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m Climb.Climb_benchmark',
+        description='Benchmark the climb calculation with synthetic '
+                    'lines and DEM.')
+    parser.add_argument('--features', type=int, default=10000,
+                        help='number of lines')
+    parser.add_argument('--vertices', type=int, default=100,
+                        help='vertices per line')
+    parser.add_argument('--multipart', type=float, default=0.1,
+                        help='fraction of multipart lines')
+    parser.add_argument('--nan', type=float, default=0.01,
+                        help='fraction of missing Z values')
+    parser.add_argument('--dem-size', type=int, default=4000,
+                        help='DEM columns and rows')
+    parser.add_argument('--dem-tile', type=int, default=256,
+                        help='DEM tile size (0: strips)')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='features per chunk')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of each case')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed for the synthetic data')
+    parser.add_argument('--algorithm', action='store_true',
+                        help='also time the stages of the algorithm '
+                        '(needs QGIS)')
+    parser.add_argument('--output', help='JSON file for the results '
+                        '(default: standard output)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    arguments = _arguments(argv)
+    results = run(arguments)
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Persistent (SQLite) cache of climb results, keyed by a hash of the
+ geometry (WKB) and the source of the Z values.  This module does not
+ depend on QGIS.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import hashlib
+import sqlite3
+import numpy as np
+from .Climb_kernel import ClimbStatistics, concatenate_statistics
+
+# Changing this invalidates existing cache entries
+CACHEVERSION = 'climb-2'
+# Default maximum number of cached features
+MAXENTRIES = 1000000
+# Maximum number of SQL variables in a statement
+_SQLVARIABLES = 500
+
+
+class ResultCache(object):
+    """
+    Climb statistics for single features, stored in an SQLite file.
+    zsource identifies the source of the Z values (e.g. the DEM
+    file, its modification time and the band), and is part of the
+    key together with the geometry.  When the cache is closed, the
+    least recently used entries beyond maxentries are removed.
+    """
+
+    def __init__(self, path, zsource, maxentries=MAXENTRIES):
+        self.path = path
+        self.maxentries = maxentries
+        self.prefix = (CACHEVERSION + '|' + zsource + '|').encode('utf-8')
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key BLOB PRIMARY KEY, climb REAL, descent REAL, '
+            'minelev REAL, maxelev REAL, missing INTEGER, '
+            'partclimb BLOB, partdescent BLOB, used INTEGER, '
+            'vertices INTEGER)')
+        # Caches from earlier versions have no vertex counts (their
+        # entries have another CACHEVERSION, and are not found)
+        columns = [row[1] for row in self.connection.execute(
+            'PRAGMA table_info(results)')]
+        if 'vertices' not in columns:
+            self.connection.execute(
+                'ALTER TABLE results ADD COLUMN vertices INTEGER')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS runs (run INTEGER)')
+        row = self.connection.execute('SELECT MAX(run) FROM runs')
+        self.run = (row.fetchone()[0] or 0) + 1
+        self.connection.execute('INSERT INTO runs VALUES (?)',
+                                (self.run,))
+
+    def key(self, wkb):
+        return hashlib.sha1(self.prefix + wkb).digest()
+
+    def lookup(self, keys):
+        """
+        Returns a dictionary with the cached rows for the keys that
+        are found, and marks them as used in this run.
+        """
+        found = {}
+        for start in range(0, len(keys), _SQLVARIABLES):
+            group = keys[start:start + _SQLVARIABLES]
+            cursor = self.connection.execute(
+                'SELECT key, climb, descent, minelev, maxelev, missing, '
+                'partclimb, partdescent, vertices FROM results '
+                'WHERE key IN (' +
+                ','.join('?' * len(group)) + ')', group)
+            for row in cursor:
+                found[bytes(row[0])] = row[1:]
+        if found:
+            self.connection.executemany(
+                'UPDATE results SET used = ? WHERE key = ?',
+                [(self.run, key) for key in found])
+        return found
+
+    def store(self, keys, stats):
+        """
+        Stores the statistics (ClimbStatistics) of the features with
+        the given keys.
+        """
+        offsets = stats.feature_offsets
+        rows = []
+        for i, key in enumerate(keys):
+            first = offsets[i]
+            last = offsets[i + 1]
+            rows.append((key, float(stats.climb[i]),
+                         float(stats.descent[i]),
+                         float(stats.minelev[i]), float(stats.maxelev[i]),
+                         int(stats.missing[i]),
+                         stats.partclimb[first:last].tobytes(),
+                         stats.partdescent[first:last].tobytes(),
+                         self.run, int(stats.vertices[i])))
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO results (key, climb, descent, '
+            'minelev, maxelev, missing, partclimb, partdescent, used, '
+            'vertices) VALUES (?,?,?,?,?,?,?,?,?,?)', rows)
+
+    def split(self, chunks):
+        """
+        Looks up the features of an iterable of (payload, wkbs)
+        chunks in the cache, and yields (payload, wkbs) chunks where
+        the payload also contains the cached results and wkbs only
+        the geometries that were not found.
+        """
+        for payload, wkbs in chunks:
+            keys = [self.key(wkb) for wkb in wkbs]
+            found = self.lookup(keys)
+            missing = [i for i, key in enumerate(keys) if key not in found]
+            self.hits = self.hits + len(keys) - len(missing)
+            self.misses = self.misses + len(missing)
+            yield ((payload, keys, found, missing),
+                   [wkbs[i] for i in missing])
+
+    def merge(self, results):
+        """
+        Takes the (payload, statistics) results for the chunks from
+        split, stores the new statistics and yields (payload,
+        statistics) for all the features of each chunk, in their
+        original order.
+        """
+        for (payload, keys, found, missing), stats in results:
+            self.store([keys[i] for i in missing], stats)
+            self.connection.commit()
+            missingset = set(missing)
+            cached = [i for i in range(len(keys)) if i not in missingset]
+            if not cached:
+                yield payload, stats
+                continue
+            cachedstats = self._statistics([found[keys[i]]
+                                            for i in cached])
+            order = np.argsort(np.array(cached + missing, dtype=np.int64),
+                               kind='stable')
+            yield payload, concatenate_statistics(
+                [cachedstats, stats]).take(order)
+
+    def _statistics(self, rows):
+        """
+        Creates ClimbStatistics from cached rows.
+        """
+        partclimb = [np.frombuffer(row[5], dtype=np.float64)
+                     for row in rows]
+        partdescent = [np.frombuffer(row[6], dtype=np.float64)
+                       for row in rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in partclimb], out=offsets[1:])
+        return ClimbStatistics(
+            np.array([row[0] for row in rows], dtype=np.float64),
+            np.array([row[1] for row in rows], dtype=np.float64),
+            np.array([row[2] for row in rows], dtype=np.float64),
+            np.array([row[3] for row in rows], dtype=np.float64),
+            np.concatenate(partclimb) if rows else np.zeros(0),
+            np.concatenate(partdescent) if rows else np.zeros(0),
+            np.array([row[4] for row in rows], dtype=np.int64),
+            offsets,
+            vertices=np.array([row[7] for row in rows], dtype=np.int64))
+
+    def statistics(self):
+        """
+        Returns a summary of the cache use.
+        """
+        return ('Result cache: ' + str(self.hits) +
+                ' features from the cache, ' + str(self.misses) +
+                ' calculated')
+
+    def close(self):
+        """
+        Removes the least recently used entries beyond maxentries and
+        closes the cache.
+        """
+        self.connection.execute(
+            'DELETE FROM results WHERE key IN (SELECT key FROM results '
+            'ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.maxentries,))
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Command line climb calculation for many line files (read with OGR)
+ against one DEM, without QGIS.  The DEM is opened once, and its
+ block cache is shared by all the input files.  Run from the folder
+ that contains the plugin:
+
+     python -m Climb.Climb_cli --dem dem.tif --output climb.csv lines/
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import argparse
+import csv
+import os
+import sys
+from osgeo import ogr, osr
+from .Climb_kernel import wkb_statistics, ClimbTotals
+from .Climb_dem import (DemSampler, NEAREST, BILINEAR, TRAVERSE,
+                        TILESIZE, CACHESIZE)
+
+# File name extensions of the line files in an input folder
+EXTENSIONS = ('.shp', '.gpkg', '.geojson', '.json', '.fgb', '.gml',
+              '.kml', '.tab', '.sqlite')
+# Default number of features that are handled together
+CHUNKSIZE = 1000
+# Sampling methods (--sampling)
+_METHODS = {'nearest': NEAREST, 'bilinear': BILINEAR,
+            'traverse': TRAVERSE}
+# Flat OGR geometry types that are lines
+_LINETYPES = (ogr.wkbUnknown, ogr.wkbLineString, ogr.wkbMultiLineString,
+              ogr.wkbCircularString, ogr.wkbCompoundCurve,
+              ogr.wkbMultiCurve)
+
+
+def input_files(paths):
+    """
+    Returns the line files of the given paths (files, and the files
+    with one of the EXTENSIONS in folders), in sorted order.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if os.path.splitext(name)[1].lower() in EXTENSIONS))
+        else:
+            files.append(path)
+    return files
+
+
+def _layercrs(layer, sampler):
+    """
+    Returns the CRS (WKT) of the layer if the coordinates must be
+    transformed to the CRS of the DEM, otherwise None.
+    """
+    layerreference = layer.GetSpatialRef()
+    demcrs = sampler.dataset.GetProjection()
+    if layerreference is None or not demcrs:
+        return None
+    demreference = osr.SpatialReference()
+    demreference.ImportFromWkt(demcrs)
+    if layerreference.IsSame(demreference):
+        return None
+    return layerreference.ExportToWkt()
+
+
+def layer_chunks(layer, chunksize, skipped=None):
+    """
+    Yields (feature ids, WKB geometries) for chunks of (at most)
+    chunksize features of an OGR layer.  Features with geometries
+    that are not lines (layers of unknown geometry type can mix
+    points, lines and polygons) are skipped, and their ids are
+    appended to skipped (a list), if given.
+    """
+    layer.ResetReading()
+    fids = []
+    wkbs = []
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if (geometry is not None and
+                ogr.GT_Flatten(geometry.GetGeometryType()) not in
+                _LINETYPES):
+            if skipped is not None:
+                skipped.append(feature.GetFID())
+            continue
+        fids.append(feature.GetFID())
+        wkbs.append(bytes(geometry.ExportToIsoWkb())
+                    if geometry is not None else b'')
+        if len(fids) >= chunksize:
+            yield fids, wkbs
+            fids = []
+            wkbs = []
+    if fids:
+        yield fids, wkbs
+
+
+def climb_layer(layer, sampler, chunksize, rows=None, skipped=None):
+    """
+    Calculates the climb of the features of an OGR line layer, with
+    Z values from the sampler (if any) or the geometries.  Returns
+    the layer totals (ClimbTotals).  If rows is given, the feature
+    id, climb, descent, minimum and maximum elevation of each
+    feature are passed to rows (a function).  The ids of features
+    that are not lines are appended to skipped (see layer_chunks).
+    """
+    if sampler is not None:
+        sampler.setSourceCrs(_layercrs(layer, sampler))
+    totals = ClimbTotals()
+    for fids, wkbs in layer_chunks(layer, chunksize, skipped):
+        stats = wkb_statistics(wkbs, sampler)
+        totals.add(stats)
+        if rows is not None:
+            rows(zip(fids, stats.climb.tolist(), stats.descent.tolist(),
+                     stats.minelev.tolist(), stats.maxelev.tolist()))
+    return totals
+
+
+def _arguments(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m Climb.Climb_cli',
+        description='Calculate the climb along the lines of line '
+                    'files (or the line files in folders).')
+    parser.add_argument('inputs', nargs='+',
+                        help='line files or folders with line files')
+    parser.add_argument('--dem', help='DEM to take the Z values from '
+                        '(default: the Z values of the lines)')
+    parser.add_argument('--band', type=int, default=1,
+                        help='band of the DEM (default 1)')
+    parser.add_argument('--sampling', choices=sorted(_METHODS),
+                        default='nearest',
+                        help='DEM sampling method (default nearest)')
+    parser.add_argument('--tile-size', type=int, default=TILESIZE,
+                        help='size of the blocks read from the DEM')
+    parser.add_argument('--cache-size', type=int, default=CACHESIZE,
+                        help='size of the DEM block cache (MB)')
+    parser.add_argument('--no-memmap', action='store_true',
+                        help='do not memory map the DEM')
+    parser.add_argument('--chunk-size', type=int, default=CHUNKSIZE,
+                        help='features per chunk')
+    parser.add_argument('--output',
+                        help='CSV file for the climb of each feature')
+    return parser.parse_args(argv)
+
+
+def climb_files(arguments, sampler, output=None):
+    """
+    Calculates the climb of the line layers of the input files
+    (arguments.inputs), and prints the totals of each layer and of
+    all the layers.  The climb of each feature is written to output
+    (a CSV file) if given.  Returns the exit status (1 if a file or
+    a layer failed).  The rows of a layer that fails are removed
+    from output.
+    """
+    writer = None
+    if output is not None:
+        writer = csv.writer(output)
+        writer.writerow(['file', 'layer', 'fid', 'climb', 'descent',
+                         'minelev', 'maxelev'])
+    alltotals = ClimbTotals()
+    status = 0
+    for path in input_files(arguments.inputs):
+        datasource = ogr.Open(path)
+        if datasource is None:
+            sys.stderr.write('Unable to open ' + path + '\n')
+            status = 1
+            continue
+        for layer in datasource:
+            if ogr.GT_Flatten(layer.GetGeomType()) not in _LINETYPES:
+                continue
+            name = layer.GetName()
+            rows = None
+            if writer is not None:
+                rows = (lambda values, path=path, name=name:
+                        writer.writerows([path, name] + list(row)
+                                         for row in values))
+                output.flush()
+                position = output.tell()
+            skipped = []
+            try:
+                totals = climb_layer(layer, sampler, arguments.chunk_size,
+                                     rows, skipped)
+            except (ValueError, IOError) as e:
+                # E.g. geometry types that can not be decoded, or a
+                # CRS that can not be transformed
+                sys.stderr.write(path + ' ' + name + ': ' + str(e) + '\n')
+                status = 1
+                if writer is not None:
+                    output.seek(position)
+                    output.truncate()
+                continue
+            if skipped:
+                sys.stderr.write(path + ' ' + name + ': ' +
+                                 str(len(skipped)) + ' features that ' +
+                                 'are not lines were skipped\n')
+            print('\t'.join([path, name, str(totals.climb),
+                             str(totals.descent),
+                             str(totals.minelevation),
+                             str(totals.maxelevation)]))
+            alltotals.climb = alltotals.climb + totals.climb
+            alltotals.descent = alltotals.descent + totals.descent
+            alltotals.minelevation = min(alltotals.minelevation,
+                                         totals.minelevation)
+            alltotals.maxelevation = max(alltotals.maxelevation,
+                                         totals.maxelevation)
+        datasource = None
+    print('\t'.join(['total', '', str(alltotals.climb),
+                     str(alltotals.descent), str(alltotals.minelevation),
+                     str(alltotals.maxelevation)]))
+    return status
+
+
+def main(argv=None):
+    arguments = _arguments(argv)
+    sampler = None
+    if arguments.dem:
+        try:
+            sampler = DemSampler(arguments.dem, arguments.band,
+                                 _METHODS[arguments.sampling],
+                                 arguments.tile_size,
+                                 arguments.cache_size,
+                                 not arguments.no_memmap)
+        except IOError as e:
+            # The DEM (or the band) does not exist
+            sys.stderr.write(str(e) + '\n')
+            return 1
+    try:
+        if not arguments.output:
+            return climb_files(arguments, sampler)
+        with open(arguments.output, 'w', newline='') as output:
+            return climb_files(arguments, sampler, output)
+    finally:
+        if sampler is not None:
+            sys.stderr.write(sampler.statistics() + '\n')
+            sampler.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
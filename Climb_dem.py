@@ -0,0 +1,884 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Sampling of DEM values for vertex coordinates, reading the raster
+ directly with GDAL.  This module does not depend on QGIS.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from osgeo import gdal, osr
+from .Climb_kernel import VertexBatch
+
+# Sampling methods
+NEAREST = 0
+BILINEAR = 1
+# The cells crossed by the segments
+TRAVERSE = 2
+
+# Default size (rows and columns) of the blocks read from the DEM
+TILESIZE = 256
+# Default size of the block cache (MB)
+CACHESIZE = 256
+
+# Coordinate transformations, by (source CRS, target CRS, operation),
+# for each thread (OGR coordinate transformations are not thread safe)
+_TRANSFORMS = threading.local()
+
+
+class BlockCache(object):
+    """
+    Least recently used cache of raster blocks, limited by the total
+    size of the blocks (in bytes).  Counts hits, misses and
+    evictions.
+    """
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, read):
+        """
+        Returns the block with the given key.  If the block is not in
+        the cache, it is read by calling read().
+        """
+        block = self.blocks.get(key)
+        if block is not None:
+            self.blocks.move_to_end(key)
+            self.hits = self.hits + 1
+            return block
+        self.misses = self.misses + 1
+        block = read()
+        self.blocks[key] = block
+        self.nbytes = self.nbytes + block.nbytes
+        # Keep at least the new block, even if it is too big
+        while self.nbytes > self.maxbytes and len(self.blocks) > 1:
+            oldkey, oldblock = self.blocks.popitem(last=False)
+            self.nbytes = self.nbytes - oldblock.nbytes
+            self.evictions = self.evictions + 1
+        return block
+
+    def clear(self):
+        self.blocks.clear()
+        self.nbytes = 0
+
+    def counters(self):
+        """
+        Returns the hits, misses and evictions, and the number and
+        size (bytes) of the cached blocks.
+        """
+        return {'blockhits': self.hits, 'blockmisses': self.misses,
+                'blockevictions': self.evictions,
+                'blocks': len(self.blocks), 'blockbytes': self.nbytes}
+
+    def statistics(self, counters=None):
+        """
+        Returns a summary of the cache use (counters, by default the
+        counters of this cache).
+        """
+        if counters is None:
+            counters = self.counters()
+        return ('DEM block cache: ' + str(counters['blockhits']) +
+                ' hits, ' + str(counters['blockmisses']) + ' misses, ' +
+                str(counters['blockevictions']) + ' evictions, ' +
+                str(counters['blocks']) + ' blocks (' +
+                str(round(counters['blockbytes'] / 1048576.0, 1)) +
+                ' MB) cached')
+
+
+# NumPy types for the GDAL data types that can be memory mapped
+_NUMPYTYPES = {'Byte': 'u1', 'Int8': 'i1', 'Int16': 'i2', 'UInt16': 'u2',
+               'Int32': 'i4', 'UInt32': 'u4', 'Int64': 'i8',
+               'UInt64': 'u8', 'Float32': 'f4', 'Float64': 'f8'}
+
+
+def file_identity(path):
+    """
+    Returns a string that identifies a file and its version (the
+    path, size and modification time).
+    """
+    try:
+        status = os.stat(path)
+    except OSError:
+        return str(path)
+    return (str(path) + '|' + str(status.st_size) + '|' +
+            repr(status.st_mtime))
+
+
+def select_overview(band, xsize, cellsize, maxcellsize):
+    """
+    Returns the index of the coarsest overview of the band with a
+    cell size that is not larger than maxcellsize, or -1 if there is
+    no such overview (full resolution).  cellsize is the cell size
+    of the full resolution band with xsize columns.  Internal and
+    external (.ovr) overviews are considered.
+    """
+    level = -1
+    levelcellsize = cellsize
+    for i in range(band.GetOverviewCount()):
+        overview = band.GetOverview(i)
+        if overview is None or overview.XSize == 0:
+            continue
+        ovcellsize = cellsize * float(xsize) / overview.XSize
+        if levelcellsize < ovcellsize <= maxcellsize:
+            level = i
+            levelcellsize = ovcellsize
+    return level
+
+
+def _readheader(path):
+    """
+    Reads a (ENVI or ESRI) .hdr file into a dictionary with lower
+    case keys.  Returns None if the file can not be read.
+    """
+    header = {}
+    try:
+        with open(path) as hdr:
+            for line in hdr:
+                if '=' in line:
+                    key, value = line.split('=', 1)
+                else:
+                    parts = line.split(None, 1)
+                    if len(parts) != 2:
+                        continue
+                    key, value = parts
+                header[key.strip().lower()] = value.strip()
+    except (IOError, UnicodeDecodeError):
+        return None
+    return header
+
+
+def _headerfile(dataset):
+    for filename in dataset.GetFileList() or []:
+        if filename.lower().endswith('.hdr'):
+            return filename
+    return None
+
+
+def _tifflayout(dataset, band, itemsize):
+    """
+    Layout of an uncompressed, stripped GeoTIFF band with contiguous
+    strips and whole bytes per cell.
+    """
+    compression = dataset.GetMetadataItem('COMPRESSION',
+                                          'IMAGE_STRUCTURE')
+    if compression not in (None, 'NONE'):
+        return None
+    nbits = band.GetMetadataItem('NBITS', 'IMAGE_STRUCTURE')
+    if nbits is not None and int(nbits) != 8 * itemsize:
+        # Bit packed (e.g. 12 bit values)
+        return None
+    if (dataset.RasterCount > 1 and
+            dataset.GetMetadataItem('INTERLEAVE',
+                                    'IMAGE_STRUCTURE') != 'BAND'):
+        return None
+    blockwidth, blockheight = band.GetBlockSize()
+    if blockwidth != dataset.RasterXSize:
+        # Tiled
+        return None
+    path = dataset.GetFileList()[0]
+    with open(path, 'rb') as tif:
+        byteorder = tif.read(2)
+    if byteorder not in (b'II', b'MM'):
+        return None
+    rowbytes = dataset.RasterXSize * itemsize
+    nstrips = (dataset.RasterYSize + blockheight - 1) // blockheight
+    first = None
+    for strip in range(nstrips):
+        offset = band.GetMetadataItem('BLOCK_OFFSET_0_' + str(strip),
+                                      'TIFF')
+        if offset is None:
+            return None
+        offset = int(offset)
+        if first is None:
+            first = offset
+        elif offset != first + strip * blockheight * rowbytes:
+            return None
+    if not first:
+        # Sparse file
+        return None
+    return (path, first, rowbytes, itemsize,
+            '<' if byteorder == b'II' else '>')
+
+
+def _envilayout(dataset, bandnumber, itemsize):
+    """
+    Layout of a band of an ENVI raster (BSQ, BIL or BIP).
+    """
+    hdrfile = _headerfile(dataset)
+    header = _readheader(hdrfile) if hdrfile else None
+    if header is None or header.get('file compression', '0') != '0':
+        return None
+    xsize = dataset.RasterXSize
+    ysize = dataset.RasterYSize
+    nbands = dataset.RasterCount
+    interleave = header.get('interleave', 'bsq').lower()
+    b = bandnumber - 1
+    if interleave == 'bsq':
+        lineoffset = itemsize * xsize
+        pixeloffset = itemsize
+        bandoffset = lineoffset * ysize
+    elif interleave == 'bil':
+        lineoffset = itemsize * xsize * nbands
+        pixeloffset = itemsize
+        bandoffset = itemsize * xsize
+    elif interleave == 'bip':
+        lineoffset = itemsize * xsize * nbands
+        pixeloffset = itemsize * nbands
+        bandoffset = itemsize
+    else:
+        return None
+    byteorder = '>' if header.get('byte order', '0') == '1' else '<'
+    offset = int(header.get('header offset', '0')) + b * bandoffset
+    return (dataset.GetFileList()[0], offset, lineoffset, pixeloffset,
+            byteorder)
+
+
+def _ehdrlayout(dataset, bandnumber, itemsize):
+    """
+    Layout of a band of an ESRI .hdr labelled raster (BIL, BIP or
+    BSQ).  The byte order has to be given in the header.
+    """
+    hdrfile = _headerfile(dataset)
+    header = _readheader(hdrfile) if hdrfile else None
+    if header is None or 'byteorder' not in header:
+        return None
+    if int(header.get('nbits', itemsize * 8)) != itemsize * 8:
+        return None
+    xsize = dataset.RasterXSize
+    ysize = dataset.RasterYSize
+    nbands = dataset.RasterCount
+    layout = header.get('layout', 'bil').lower()
+    b = bandnumber - 1
+    bandrowbytes = int(header.get('bandrowbytes', itemsize * xsize))
+    if layout == 'bil':
+        pixeloffset = itemsize
+        lineoffset = int(header.get('totalrowbytes',
+                                    bandrowbytes * nbands))
+        bandoffset = bandrowbytes
+    elif layout == 'bip':
+        pixeloffset = itemsize * nbands
+        lineoffset = int(header.get('totalrowbytes',
+                                    itemsize * xsize * nbands))
+        bandoffset = itemsize
+    elif layout == 'bsq':
+        pixeloffset = itemsize
+        lineoffset = bandrowbytes
+        bandoffset = (bandrowbytes * ysize +
+                      int(header.get('bandgapbytes', '0')))
+    else:
+        return None
+    byteorder = '>' if header['byteorder'].upper() in ('M', 'MSBFIRST') \
+        else '<'
+    offset = int(header.get('skipbytes', '0')) + b * bandoffset
+    return (dataset.GetFileList()[0], offset, lineoffset, pixeloffset,
+            byteorder)
+
+
+def memory_map(dataset, bandnumber):
+    """
+    Returns a read-only NumPy view (rows x columns) of the cells of a
+    band, memory mapped directly from the raster file, or None if the
+    raster does not qualify.  Uncompressed, untiled GeoTIFF (strips
+    or single rows, band interleaved if there are several bands) and
+    ENVI / ESRI BIL, BIP and BSQ rasters of the basic data types can
+    be memory mapped.
+    """
+    band = dataset.GetRasterBand(bandnumber)
+    typename = gdal.GetDataTypeName(band.DataType)
+    if (typename == 'Byte' and
+            band.GetMetadataItem('PIXELTYPE',
+                                 'IMAGE_STRUCTURE') == 'SIGNEDBYTE'):
+        typename = 'Int8'
+    if typename not in _NUMPYTYPES:
+        return None
+    filelist = dataset.GetFileList()
+    if not filelist or not os.path.isfile(filelist[0]):
+        # Not a plain file (e.g. a VRT or /vsi file)
+        return None
+    itemsize = int(_NUMPYTYPES[typename][1])
+    driver = dataset.GetDriver().ShortName
+    try:
+        if driver == 'GTiff':
+            layout = _tifflayout(dataset, band, itemsize)
+        elif driver == 'ENVI':
+            layout = _envilayout(dataset, bandnumber, itemsize)
+        elif driver == 'EHdr':
+            layout = _ehdrlayout(dataset, bandnumber, itemsize)
+        else:
+            layout = None
+    except (IOError, ValueError):
+        return None
+    if layout is None:
+        return None
+    path, offset, lineoffset, pixeloffset, byteorder = layout
+    xsize = dataset.RasterXSize
+    ysize = dataset.RasterYSize
+    lastbyte = (offset + (ysize - 1) * lineoffset +
+                (xsize - 1) * pixeloffset + itemsize)
+    if lastbyte > os.path.getsize(path):
+        return None
+    filemap = np.memmap(path, dtype=np.uint8, mode='r')
+    return np.ndarray((ysize, xsize),
+                      dtype=byteorder + _NUMPYTYPES[typename],
+                      buffer=filemap, offset=offset,
+                      strides=(lineoffset, pixeloffset))
+
+
+def coordinate_transform(sourcecrs, targetcrs, operation=None):
+    """
+    Returns a coordinate transformation (osr) from sourcecrs to
+    targetcrs (WKT or any other definition understood by GDAL).
+    operation (optional) is the coordinate operation (PROJ string)
+    to use, e.g. the datum transformation selected in the project,
+    otherwise PROJ picks the operation.  The transformations are
+    kept for reuse by the same thread, also by later runs in the
+    same process.  Coordinates are in x (easting, longitude), y
+    (northing, latitude) order.
+    """
+    transforms = getattr(_TRANSFORMS, 'transforms', None)
+    if transforms is None:
+        transforms = {}
+        _TRANSFORMS.transforms = transforms
+    key = (sourcecrs, targetcrs, operation or None)
+    transform = transforms.get(key)
+    if transform is None:
+        references = []
+        for crs in (sourcecrs, targetcrs):
+            reference = osr.SpatialReference()
+            if reference.SetFromUserInput(crs) != 0:
+                raise IOError('Unknown CRS: ' + str(crs))
+            # GDAL 3 uses the axis order of the CRS by default
+            if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+                reference.SetAxisMappingStrategy(
+                    osr.OAMS_TRADITIONAL_GIS_ORDER)
+            references.append(reference)
+        options = None
+        if operation and hasattr(osr, 'CoordinateTransformationOptions'):
+            options = osr.CoordinateTransformationOptions()
+            # GDAL 3.1 and later
+            if not hasattr(options, 'SetOperation'):
+                options = None
+            elif not options.SetOperation(operation):
+                raise IOError('Unknown coordinate operation: ' +
+                              str(operation))
+        if options is not None:
+            transform = osr.CoordinateTransformation(references[0],
+                                                     references[1],
+                                                     options)
+        else:
+            transform = osr.CoordinateTransformation(*references)
+        transforms[key] = transform
+    return transform
+
+
+def coordinate_operation(transformcontext, sourcecrs, targetcrs):
+    """
+    Returns the coordinate operation (PROJ string) for a
+    transformation from sourcecrs to targetcrs that is selected in a
+    QGIS transform context (QgsCoordinateTransformContext), or None
+    if PROJ shall pick it (no operation selected, or QGIS before
+    3.8).
+    """
+    if not hasattr(transformcontext, 'calculateCoordinateOperation'):
+        return None
+    return transformcontext.calculateCoordinateOperation(
+        sourcecrs, targetcrs) or None
+
+
+def transform_coordinates(transform, x, y):
+    """
+    Transforms the coordinate arrays x and y (all the points in one
+    call).  Points that can not be transformed get NaN.
+    """
+    if len(x) == 0:
+        return x, y
+    points = np.array(transform.TransformPoints(np.column_stack((x, y))),
+                      dtype=np.float64).reshape(len(x), -1)
+    points[~np.isfinite(points)] = np.nan
+    return points[:, 0].copy(), points[:, 1].copy()
+
+
+def _crossings(start, delta, counts):
+    """
+    Returns the segment index and the position (0 - 1) along the
+    segment of the grid line crossings of segments that start at
+    start (pixel coordinate), change by delta and cross counts grid
+    lines.
+    """
+    segments = np.repeat(np.arange(len(counts)), counts)
+    firsts = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=firsts[1:])
+    steps = np.arange(len(segments)) - np.repeat(firsts, counts)
+    cell = np.floor(start[segments])
+    lines = np.where(delta[segments] > 0, cell + 1 + steps, cell - steps)
+    return segments, (lines - start[segments]) / delta[segments]
+
+
+def traverse_cells(px, py, part_offsets):
+    """
+    Traverses the segments of the parts (given by the pixel
+    coordinates px and py, and the part offsets) through the cells
+    of the raster.  Returns the pixel coordinates of a point in each
+    of the cells that are crossed (the middle of the piece of the
+    segment inside the cell), in the order they are crossed, and the
+    offsets of the parts in these arrays.  A part with one vertex
+    gives the cell of the vertex.
+    """
+    nparts = len(part_offsets) - 1
+    partids = np.repeat(np.arange(nparts), np.diff(part_offsets))
+    # The segments (vertex i to i + 1 of the same part)
+    starts = np.flatnonzero(partids[1:] == partids[:-1])
+    x0 = px[starts]
+    y0 = py[starts]
+    dx = px[starts + 1] - x0
+    dy = py[starts + 1] - y0
+    finite = (np.isfinite(x0) & np.isfinite(y0) &
+              np.isfinite(dx) & np.isfinite(dy))
+    ncx = np.zeros(len(starts), dtype=np.int64)
+    ncy = np.zeros(len(starts), dtype=np.int64)
+    ncx[finite] = np.abs(np.floor(x0[finite] + dx[finite]) -
+                         np.floor(x0[finite])).astype(np.int64)
+    ncy[finite] = np.abs(np.floor(y0[finite] + dy[finite]) -
+                         np.floor(y0[finite])).astype(np.int64)
+    xsegments, xt = _crossings(x0, dx, ncx)
+    ysegments, yt = _crossings(y0, dy, ncy)
+    # The start of each segment and the crossings, ordered along
+    # the segments
+    segments = np.concatenate((np.arange(len(starts)), xsegments,
+                               ysegments))
+    t = np.clip(np.concatenate((np.zeros(len(starts)), xt, yt)), 0, 1)
+    order = np.lexsort((t, segments))
+    segments = segments[order]
+    t = t[order]
+    tnext = np.append(t[1:], 1.0)
+    tnext[np.flatnonzero(segments[1:] != segments[:-1])] = 1.0
+    # Skip empty pieces (at corners and segment ends)
+    keep = tnext > t
+    segments = segments[keep]
+    middle = (t[keep] + tnext[keep]) / 2
+    cx = x0[segments] + middle * dx[segments]
+    cy = y0[segments] + middle * dy[segments]
+    # Parts with one vertex
+    counts = np.diff(part_offsets)
+    singles = np.flatnonzero(counts == 1)
+    cellparts = np.concatenate((partids[starts][segments], singles))
+    order = np.argsort(cellparts, kind='stable')
+    offsets = np.zeros(nparts + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cellparts, minlength=nparts), out=offsets[1:])
+    return (np.concatenate((cx, px[part_offsets[singles]]))[order],
+            np.concatenate((cy, py[part_offsets[singles]]))[order],
+            offsets)
+
+
+class DemSampler(object):
+    """
+    Samples a band of a GDAL raster (DEM) at vertex coordinates.
+    The coordinates must be in the CRS of the raster, or in sourcecrs
+    if it is given.  The coordinates are then transformed to the CRS
+    of the raster (batch by batch, with the coordinate operation
+    operation if given) before the lookup.  demcrs (WKT) is the CRS
+    of the raster if it is not the CRS of the file (e.g. a CRS that
+    is set for the layer in QGIS).  Cells with
+    the band's nodata value and points outside the raster give NaN.
+    The band's scale and offset are applied to the cell values.
+    If usememmap is set and the raster qualifies (see memory_map),
+    the cells are read from a memory mapped view of the raster file.
+    Otherwise the raster is read in blocks of tilesize x tilesize
+    cells that are kept in a block cache of (at most) cachesize MB.
+    With the TRAVERSE method, sampleBatch returns the values of the
+    cells crossed by the segments of the lines instead of the
+    values at the vertices (nearest neighbour).
+    If deduplicate is set, each unique vertex coordinate (after
+    snapping to a grid of size snap, if snap > 0) is sampled once.
+    If maxcellsize is given, the coarsest overview (pyramid level)
+    with a cell size not larger than maxcellsize is sampled instead
+    of the full resolution band (overviews are not memory mapped).
+    """
+
+    def __init__(self, path, band=1, method=NEAREST, tilesize=TILESIZE,
+                 cachesize=CACHESIZE, usememmap=True, maxcellsize=None,
+                 deduplicate=False, snap=0.0, sourcecrs=None,
+                 operation=None, demcrs=None):
+        # The arguments, for opening the DEM in other processes
+        self.arguments = (path, band, method, tilesize, cachesize,
+                          usememmap, maxcellsize, deduplicate, snap,
+                          sourcecrs, operation, demcrs)
+        self.path = path
+        self.demcrs = demcrs
+        self.method = method
+        self.deduplicate = deduplicate
+        self.snap = snap
+        # Number of vertices and unique vertices that were sampled
+        self.vertices = 0
+        self.uniquevertices = 0
+        # Number of cells crossed (TRAVERSE)
+        self.cells = 0
+        # Number of transformed points and the time used (seconds)
+        self.transformed = 0
+        self.transformtime = 0.0
+        self.tilesize = max(int(tilesize), 1)
+        self.cache = BlockCache(int(cachesize * 1048576))
+        self.dataset = gdal.Open(path, gdal.GA_ReadOnly)
+        if self.dataset is None:
+            raise IOError('Unable to open DEM: ' + str(path))
+        self.bandnumber = band
+        self.band = self.dataset.GetRasterBand(band)
+        if self.band is None:
+            raise IOError('DEM ' + str(path) + ' has no band ' +
+                          str(band))
+        self.xsize = self.dataset.RasterXSize
+        self.ysize = self.dataset.RasterYSize
+        self.geotransform = self.dataset.GetGeoTransform()
+        self.setSourceCrs(sourcecrs, operation)
+        # The band that is read (the band itself or an overview)
+        self.readband = self.band
+        self.level = -1
+        if maxcellsize:
+            self.level = select_overview(self.band, self.xsize,
+                                         self.cellSize(), maxcellsize)
+        if self.level >= 0:
+            self.readband = self.band.GetOverview(self.level)
+            fx = float(self.xsize) / self.readband.XSize
+            fy = float(self.ysize) / self.readband.YSize
+            gt = self.geotransform
+            self.geotransform = (gt[0], gt[1] * fx, gt[2] * fy,
+                                 gt[3], gt[4] * fx, gt[5] * fy)
+            self.xsize = self.readband.XSize
+            self.ysize = self.readband.YSize
+        invgt = gdal.InvGeoTransform(self.geotransform)
+        # GDAL 2 returns (success, geotransform)
+        if len(invgt) == 2:
+            invgt = invgt[1]
+        self.invgeotransform = invgt
+        self.nodata = self.band.GetNoDataValue()
+        self.scale = self.band.GetScale()
+        self.offset = self.band.GetOffset()
+        self.memmap = None
+        if usememmap and self.level < 0:
+            self.memmap = memory_map(self.dataset, band)
+
+    def close(self):
+        self.memmap = None
+        self.cache.clear()
+        self.readband = None
+        self.band = None
+        self.dataset = None
+
+    def cellSize(self):
+        """
+        Returns the cell size of the level that is sampled.
+        """
+        gt = self.geotransform
+        return float(np.hypot(gt[1], gt[4]))
+
+    def levelDescription(self):
+        """
+        Returns a description of the resolution level that is
+        sampled.
+        """
+        if self.level < 0:
+            return ('full resolution (cell size ' +
+                    str(round(self.cellSize(), 3)) + ')')
+        return ('overview level ' + str(self.level + 1) + ' of ' +
+                str(self.band.GetOverviewCount()) + ' (cell size ' +
+                str(round(self.cellSize(), 3)) + ')')
+
+    def blockExtent(self):
+        """
+        Returns the width and height of a block (tilesize x tilesize
+        cells) in georeferenced units.
+        """
+        gt = self.geotransform
+        return (self.tilesize * float(np.hypot(gt[1], gt[4])),
+                self.tilesize * float(np.hypot(gt[2], gt[5])))
+
+    def setSourceCrs(self, sourcecrs, operation=None):
+        """
+        Sets the CRS of the coordinates that are sampled (None: the
+        CRS of the DEM), and the coordinate operation (see
+        coordinate_transform).  The DEM stays open, and the block
+        cache is kept.
+        """
+        self.sourcecrs = sourcecrs
+        self.operation = operation
+        self.transform = None
+        if sourcecrs:
+            demcrs = self.demcrs or self.dataset.GetProjection()
+            if not demcrs:
+                raise IOError('DEM ' + str(self.path) + ' has no CRS')
+            self.transform = coordinate_transform(sourcecrs, demcrs,
+                                                  operation)
+        self.arguments = (self.arguments[:9] + (sourcecrs, operation) +
+                          self.arguments[11:])
+
+    def transformCoordinates(self, x, y):
+        """
+        Returns the points transformed to the CRS of the DEM (the
+        points themselves if no transformation is needed).
+        """
+        if self.transform is None:
+            return x, y
+        start = time.perf_counter()
+        x, y = transform_coordinates(self.transform, x, y)
+        self.transformtime = self.transformtime + time.perf_counter() - start
+        self.transformed = self.transformed + len(x)
+        return x, y
+
+    def pixelCoordinates(self, x, y):
+        """
+        Returns the (fractional) column and row coordinates of the
+        points.
+        """
+        igt = self.invgeotransform
+        return (igt[0] + igt[1] * x + igt[2] * y,
+                igt[3] + igt[4] * x + igt[5] * y)
+
+    def identity(self):
+        """
+        Returns a string that identifies the DEM file (and its
+        version), the band, the sampling method and the level.
+        """
+        return (file_identity(self.path) + '|' + str(self.bandnumber) +
+                '|' + str(self.method) + '|' + str(self.level) + '|' +
+                str(self.snap if self.deduplicate else 0.0) + '|' +
+                str(self.sourcecrs or '') + '|' +
+                str(self.operation or '') + '|' + str(self.demcrs or ''))
+
+    def counters(self):
+        """
+        Returns the counters of the sampler: the block cache counters
+        (see BlockCache.counters), the sampled (and unique) vertices,
+        the cells crossed and the transformed points (and seconds).
+        """
+        counters = self.cache.counters()
+        counters.update({'vertices': self.vertices,
+                         'uniquevertices': self.uniquevertices,
+                         'cells': self.cells,
+                         'transformed': self.transformed,
+                         'transformseconds': self.transformtime})
+        return counters
+
+    def statistics(self, counters=None):
+        """
+        Returns a summary of how the DEM was read, from counters (see
+        counters), by default the counters of this sampler (e.g. the
+        totals of the samplers of the worker processes).
+        """
+        if counters is None:
+            counters = self.counters()
+        if self.memmap is not None:
+            summary = 'DEM memory mapped from ' + str(self.path)
+        else:
+            summary = self.cache.statistics(counters)
+        vertices = counters['vertices']
+        if (self.deduplicate and self.method != TRAVERSE and
+                vertices > 0):
+            summary = (summary + '\nDEM sampling: ' + str(vertices) +
+                       ' vertices, ' + str(counters['uniquevertices']) +
+                       ' unique (deduplication ratio ' +
+                       str(round(counters['uniquevertices'] /
+                                 float(vertices), 3)) + ')')
+        if self.method == TRAVERSE and vertices > 0:
+            summary = (summary + '\nCell traversal: ' +
+                       str(vertices) + ' vertices, ' +
+                       str(counters['cells']) + ' cells crossed')
+        if self.transform is not None:
+            summary = (summary + '\nCoordinate transformation: ' +
+                       str(counters['transformed']) + ' points in ' +
+                       str(round(counters['transformseconds'], 3)) + ' s')
+        return summary
+
+    def cellValues(self, values):
+        """
+        Converts raw cell values to elevations (float64), with NaN
+        for nodata.
+        """
+        values = values.astype(np.float64)
+        if self.nodata is not None:
+            values[values == self.nodata] = np.nan
+        if self.scale not in (None, 1.0):
+            values = values * self.scale
+        if self.offset not in (None, 0.0):
+            values = values + self.offset
+        return values
+
+    def readWindow(self, xoff, yoff, xsize, ysize):
+        """
+        Returns the raw cell values of a window of the raster.
+        """
+        return self.readband.ReadAsArray(int(xoff), int(yoff),
+                                         int(xsize), int(ysize))
+
+    def block(self, bx, by):
+        """
+        Returns the raw cell values of block (bx, by), using the
+        block cache.
+        """
+        ts = self.tilesize
+        xoff = bx * ts
+        yoff = by * ts
+        return self.cache.get((bx, by), lambda: self.readWindow(
+            xoff, yoff, min(ts, self.xsize - xoff),
+            min(ts, self.ysize - yoff)))
+
+    def lookup(self, cols, rows):
+        """
+        Returns the elevations of the cells (integer column and row
+        arrays, all inside the raster).  Without a memory map, the
+        cells are grouped by block, so that each block is fetched
+        once per call.
+        """
+        if len(cols) == 0:
+            return np.empty(0)
+        if self.memmap is not None:
+            return self.cellValues(self.memmap[rows, cols])
+        raw = None
+        ts = self.tilesize
+        nbx = (self.xsize + ts - 1) // ts
+        keys = (rows // ts) * nbx + cols // ts
+        order = np.argsort(keys, kind='stable')
+        sortedkeys = keys[order]
+        starts = np.flatnonzero(np.concatenate(
+            ([True], sortedkeys[1:] != sortedkeys[:-1])))
+        ends = np.append(starts[1:], len(order))
+        for start, end in zip(starts, ends):
+            key = int(sortedkeys[start])
+            bx = key % nbx
+            by = key // nbx
+            block = self.block(bx, by)
+            if raw is None:
+                raw = np.empty(len(cols), dtype=block.dtype)
+            idx = order[start:end]
+            raw[idx] = block[rows[idx] - by * ts, cols[idx] - bx * ts]
+        return self.cellValues(raw)
+
+    def sample(self, x, y):
+        """
+        Returns the elevation at the points given by the coordinate
+        arrays x and y.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.vertices = self.vertices + len(x)
+        if not self.deduplicate or len(x) == 0:
+            self.uniquevertices = self.uniquevertices + len(x)
+            return self._sample(x, y)
+        # Sample each unique (snapped) coordinate once, and scatter
+        # the values back to the vertices
+        if self.snap > 0:
+            keys = (np.round(x / self.snap) +
+                    1j * np.round(y / self.snap))
+        else:
+            keys = x + 1j * y
+        unique, first, inverse = np.unique(keys, return_index=True,
+                                           return_inverse=True)
+        self.uniquevertices = self.uniquevertices + len(unique)
+        return self._sample(x[first], y[first])[inverse.ravel()]
+
+    def _sample(self, x, y):
+        """
+        Returns the elevation at the points given by the coordinate
+        arrays x and y (all of them sampled).
+        """
+        px, py = self.pixelCoordinates(*self.transformCoordinates(x, y))
+        return self._samplePixels(px, py)
+
+    def sampleBatch(self, batch):
+        """
+        Returns the VertexBatch with Z values from the DEM.  With the
+        TRAVERSE method, a new VertexBatch is returned, with a vertex
+        for each cell crossed by the lines.
+        """
+        if self.method != TRAVERSE:
+            batch.z = self.sample(batch.x, batch.y)
+            return batch
+        px, py = self.pixelCoordinates(
+            *self.transformCoordinates(batch.x, batch.y))
+        cx, cy, offsets = traverse_cells(px, py, batch.part_offsets)
+        self.vertices = self.vertices + len(px)
+        self.cells = self.cells + len(cx)
+        gt = self.geotransform
+        return VertexBatch(gt[0] + gt[1] * cx + gt[2] * cy,
+                           gt[3] + gt[4] * cx + gt[5] * cy,
+                           self._samplePixels(cx, cy), offsets,
+                           batch.feature_offsets)
+
+    def _samplePixels(self, px, py):
+        """
+        Returns the elevation at the points given by the pixel
+        coordinate arrays px and py.
+        """
+        z = np.full(len(px), np.nan)
+        inside = ((px >= 0) & (px < self.xsize) &
+                  (py >= 0) & (py < self.ysize))
+        cols = np.floor(px[inside]).astype(np.int64)
+        rows = np.floor(py[inside]).astype(np.int64)
+        if self.method == BILINEAR:
+            z[inside] = self._bilinear(px[inside], py[inside], cols, rows)
+        else:
+            z[inside] = self.lookup(cols, rows)
+        return z
+
+    def _bilinear(self, px, py, cols, rows):
+        """
+        Bilinear interpolation between the centres of the four
+        surrounding cells.  At the edges of the raster the edge cells
+        are used, and if one of the four cells has no data the
+        value of the cell containing the point is used.
+        """
+        fx = px - 0.5
+        fy = py - 0.5
+        c0 = np.floor(fx).astype(np.int64)
+        r0 = np.floor(fy).astype(np.int64)
+        wx = fx - c0
+        wy = fy - r0
+        c1 = np.minimum(c0 + 1, self.xsize - 1)
+        r1 = np.minimum(r0 + 1, self.ysize - 1)
+        c0 = np.maximum(c0, 0)
+        r0 = np.maximum(r0, 0)
+        n = len(px)
+        values = self.lookup(np.concatenate((c0, c1, c0, c1, cols)),
+                             np.concatenate((r0, r0, r1, r1, rows)))
+        z00 = values[0:n]
+        z10 = values[n:2 * n]
+        z01 = values[2 * n:3 * n]
+        z11 = values[3 * n:4 * n]
+        z = ((z00 * (1 - wx) + z10 * wx) * (1 - wy) +
+             (z01 * (1 - wx) + z11 * wx) * wy)
+        holes = np.isnan(z)
+        z[holes] = values[4 * n:][holes]
+        return z
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Expression functions (climb, descent, min_elevation and
+ max_elevation) for attribute tables, labels and virtual fields.
+ The results are calculated when the expressions are evaluated, and
+ kept in a bounded cache keyed by the geometry and the DEM.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import hashlib
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from qgis.core import (QgsExpression,
+                       QgsProject,
+                       QgsRasterLayer,
+                       QgsCoordinateReferenceSystem,
+                       qgsfunction)
+from .Climb_kernel import wkb_statistics
+from .Climb_dem import DemSampler, coordinate_operation, file_identity
+
+# Maximum number of cached results
+CACHEENTRIES = 10000
+# Minimum time between checks of a DEM file for changes (seconds)
+CHECKINTERVAL = 2.0
+
+# (geometry hash, DEM identity) -> (climb, descent, minimum elevation,
+#                                   maximum elevation)
+_results = OrderedDict()
+# The raster layers of the project, by id and by name -> (name,
+# provider, source, CRS, CRS as WKT).  Labels and symbols are
+# evaluated in other threads, where the project can not be used, so
+# this is updated in the main thread when the project changes.
+_layers = {}
+# The coordinate transformation context of the project
+_transformcontext = None
+# (CRS of the geometries, CRS of the DEM (WKT)) -> (CRS of the
+# geometries (WKT), coordinate operation)
+_operations = {}
+# DEM source -> (time of the last check, file identity)
+_identities = {}
+# The samplers of each thread: (DEM source, band, CRS of the
+# geometries, coordinate operation, CRS of the DEM) -> (file
+# identity, DemSampler, DEM identity)
+_local = threading.local()
+# All the samplers, closed when the functions are unregistered
+_allsamplers = weakref.WeakSet()
+# Changed when the samplers are closed
+_generation = 0
+# Protects the dictionaries above (not the samplers, which are only
+# used by their thread)
+_lock = threading.Lock()
+
+
+def _updatelayers(*args):
+    """
+    Takes a snapshot of the raster layers and the transformation
+    context of the project (in the main thread).
+    """
+    global _transformcontext
+    project = QgsProject.instance()
+    rasters = [layer for layer in project.mapLayers().values()
+               if isinstance(layer, QgsRasterLayer)]
+    layers = {}
+    for layer in rasters:
+        layers[layer.id()] = (layer.name(), layer.providerType(),
+                              layer.source(),
+                              QgsCoordinateReferenceSystem(layer.crs()),
+                              layer.crs().toWkt())
+    # By name, the first layer with the name
+    for layer in rasters:
+        layers.setdefault(layer.name(), layers[layer.id()])
+    with _lock:
+        _layers.clear()
+        _layers.update(layers)
+        _transformcontext = project.transformContext()
+        _operations.clear()
+
+
+def _watchlayers(layers):
+    """
+    Updates the snapshot when the name or the CRS of a raster layer
+    changes.
+    """
+    for layer in layers:
+        if isinstance(layer, QgsRasterLayer):
+            layer.nameChanged.connect(_updatelayers)
+            layer.crsChanged.connect(_updatelayers)
+    _updatelayers()
+
+
+def _demlayer(dem):
+    """
+    Returns (name, provider, source, CRS, CRS as WKT) for a DEM
+    (raster layer, layer id or layer name).
+    """
+    if isinstance(dem, QgsRasterLayer):
+        key = dem.id()
+    else:
+        key = str(dem)
+    with _lock:
+        layer = _layers.get(key)
+    if layer is None and isinstance(dem, QgsRasterLayer):
+        # A layer that is not in the project
+        layer = (dem.name(), dem.providerType(), dem.source(),
+                 QgsCoordinateReferenceSystem(dem.crs()),
+                 dem.crs().toWkt())
+    if layer is None:
+        raise ValueError('Unknown DEM layer: ' + str(dem))
+    return layer
+
+
+def _fileidentity(source):
+    """
+    Returns the identity (see file_identity) of a DEM file.  The file
+    is checked for changes at most every CHECKINTERVAL seconds.
+    """
+    now = time.monotonic()
+    with _lock:
+        checked = _identities.get(source)
+    if checked is not None and now - checked[0] < CHECKINTERVAL:
+        return checked[1]
+    identity = file_identity(source)
+    with _lock:
+        _identities[source] = (now, identity)
+    return identity
+
+
+def _demsampler(dem, band, context):
+    """
+    Returns the sampler of the current thread for a DEM (raster
+    layer, layer id or layer name), for geometries in the CRS of the
+    layer of the context, and the identity of the DEM.  A new sampler
+    is opened when the DEM file has changed.
+    """
+    name, provider, source, demcrs, demwkt = _demlayer(dem)
+    if provider != 'gdal':
+        raise ValueError('The DEM ' + name + ' is not a GDAL raster')
+    sourcecrs = None
+    operation = None
+    if context is not None and context.hasVariable('layer_crs'):
+        layercrs = str(context.variable('layer_crs'))
+        with _lock:
+            transform = _operations.get((layercrs, demwkt))
+            transformcontext = _transformcontext
+        if transform is None:
+            crs = QgsCoordinateReferenceSystem(layercrs)
+            transform = (None, None)
+            if crs.isValid() and crs != demcrs:
+                transform = (crs.toWkt(),
+                             coordinate_operation(transformcontext, crs,
+                                                  demcrs))
+            with _lock:
+                _operations[(layercrs, demwkt)] = transform
+        sourcecrs, operation = transform
+    identity = _fileidentity(source)
+    samplers = getattr(_local, 'samplers', None)
+    if samplers is None or _local.generation != _generation:
+        samplers = _local.samplers = {}
+        _local.generation = _generation
+    key = (source, band, sourcecrs, operation, demwkt)
+    entry = samplers.get(key)
+    if entry is not None and entry[0] != identity:
+        # The DEM file has changed
+        entry[1].close()
+        entry = None
+    if entry is None:
+        sampler = DemSampler(source, band, sourcecrs=sourcecrs,
+                             operation=operation, demcrs=demwkt or None)
+        entry = (identity, sampler, sampler.identity())
+        samplers[key] = entry
+        with _lock:
+            _allsamplers.add(sampler)
+    return entry[1], entry[2]
+
+
+def _statistics(values, context):
+    """
+    Returns the climb, descent, minimum and maximum elevation of the
+    geometry of values (geometry, optional DEM, optional band), or
+    None if there is no geometry.
+    """
+    geometry = values[0]
+    if geometry is None or geometry.isNull():
+        return None
+    wkb = bytes(geometry.asWkb())
+    sampler = None
+    demidentity = ''
+    if len(values) > 1 and values[1]:
+        band = 1
+        if len(values) > 2 and values[2]:
+            band = int(values[2])
+        sampler, demidentity = _demsampler(values[1], band, context)
+    key = (hashlib.sha1(wkb).digest(), demidentity)
+    with _lock:
+        result = _results.get(key)
+        if result is not None:
+            _results.move_to_end(key)
+    if result is not None:
+        return result
+    # The DEM is sampled without the lock
+    stats = wkb_statistics([wkb], sampler)
+    minelev = float(stats.minelev[0])
+    maxelev = float(stats.maxelev[0])
+    if minelev > maxelev:
+        # No Z values
+        minelev = None
+        maxelev = None
+    result = (float(stats.climb[0]), float(stats.descent[0]),
+              minelev, maxelev)
+    with _lock:
+        _results[key] = result
+        if len(_results) > CACHEENTRIES:
+            _results.popitem(last=False)
+    return result
+
+
+def _value(values, context, index):
+    result = _statistics(values, context)
+    return None if result is None else result[index]
+
+
+@qgsfunction(args=-1, group='Climb', register=False)
+def climb(values, feature, parent, context):
+    """
+    Returns the total climb along a line geometry.
+    <h4>Syntax</h4>
+    <p>climb(<i>geometry</i>[, <i>dem</i>[, <i>band</i>]])</p>
+    <h4>Arguments</h4>
+    <p><i>geometry</i>: a line geometry.  Without a DEM, the Z values
+    of the geometry are used.<br>
+    <i>dem</i>: a DEM raster layer (name or id) to take the Z
+    values from.<br>
+    <i>band</i>: the band of the DEM (default 1).</p>
+    <h4>Example</h4>
+    <p>climb($geometry, 'dem') &rarr; 123.4</p>
+    """
+    return _value(values, context, 0)
+
+
+@qgsfunction(args=-1, group='Climb', register=False)
+def descent(values, feature, parent, context):
+    """
+    Returns the total descent along a line geometry.
+    <h4>Syntax</h4>
+    <p>descent(<i>geometry</i>[, <i>dem</i>[, <i>band</i>]])</p>
+    <h4>Arguments</h4>
+    <p>As for climb.</p>
+    <h4>Example</h4>
+    <p>descent($geometry, 'dem') &rarr; 98.7</p>
+    """
+    return _value(values, context, 1)
+
+
+@qgsfunction(args=-1, group='Climb', register=False)
+def min_elevation(values, feature, parent, context):
+    """
+    Returns the minimum elevation along a line geometry (NULL
+    without Z values).
+    <h4>Syntax</h4>
+    <p>min_elevation(<i>geometry</i>[, <i>dem</i>[, <i>band</i>]])</p>
+    <h4>Arguments</h4>
+    <p>As for climb.</p>
+    <h4>Example</h4>
+    <p>min_elevation($geometry, 'dem') &rarr; 212.0</p>
+    """
+    return _value(values, context, 2)
+
+
+@qgsfunction(args=-1, group='Climb', register=False)
+def max_elevation(values, feature, parent, context):
+    """
+    Returns the maximum elevation along a line geometry (NULL
+    without Z values).
+    <h4>Syntax</h4>
+    <p>max_elevation(<i>geometry</i>[, <i>dem</i>[, <i>band</i>]])</p>
+    <h4>Arguments</h4>
+    <p>As for climb.</p>
+    <h4>Example</h4>
+    <p>max_elevation($geometry, 'dem') &rarr; 431.5</p>
+    """
+    return _value(values, context, 3)
+
+
+_FUNCTIONS = [climb, descent, min_elevation, max_elevation]
+
+
+def register_functions():
+    """
+    Registers the functions, and follows the raster layers of the
+    project (in the main thread).
+    """
+    project = QgsProject.instance()
+    project.layersAdded.connect(_watchlayers)
+    project.layersRemoved.connect(_updatelayers)
+    project.transformContextChanged.connect(_updatelayers)
+    _watchlayers(project.mapLayers().values())
+    for function in _FUNCTIONS:
+        QgsExpression.registerFunction(function)
+
+
+def unregister_functions():
+    """
+    Removes the functions and clears the cache.
+    """
+    global _generation
+    for function in _FUNCTIONS:
+        QgsExpression.unregisterFunction(function.name())
+    project = QgsProject.instance()
+    project.layersAdded.disconnect(_watchlayers)
+    project.layersRemoved.disconnect(_updatelayers)
+    project.transformContextChanged.disconnect(_updatelayers)
+    for layer in project.mapLayers().values():
+        if isinstance(layer, QgsRasterLayer):
+            layer.nameChanged.disconnect(_updatelayers)
+            layer.crsChanged.disconnect(_updatelayers)
+    with _lock:
+        _results.clear()
+        _layers.clear()
+        _operations.clear()
+        _identities.clear()
+        for sampler in list(_allsamplers):
+            sampler.close()
+        _allsamplers.clear()
+        _generation = _generation + 1
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Coarse spatial grid index used to process the features cell by
+ cell, so that the DEM blocks of a cell are read once.  This module
+ does not depend on QGIS.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import numpy as np
+
+
+class GridIndex(object):
+    """
+    Regular grid (cellwidth x cellheight) over the bounding boxes of
+    the features.  A feature is assigned to the cell that contains
+    the centre of its bounding box.  If transform is given, it is
+    called with the arrays of the x and y coordinates of the centres
+    and returns them in the CRS of the grid.
+    """
+
+    def __init__(self, cellwidth, cellheight, transform=None):
+        self.cellwidth = float(cellwidth)
+        self.cellheight = float(cellheight)
+        self.transform = transform
+        self.fids = []
+        self.centrex = []
+        self.centrey = []
+
+    def insert(self, fid, xmin, ymin, xmax, ymax):
+        self.fids.append(fid)
+        self.centrex.append((xmin + xmax) / 2.0)
+        self.centrey.append((ymin + ymax) / 2.0)
+
+    def featureCount(self):
+        return len(self.fids)
+
+    def cells(self):
+        """
+        Returns the feature ids of the non-empty cells as a list of
+        lists.  The cells are ordered row by row, alternating the
+        direction of the rows so that consecutive cells are
+        neighbours.  Within a cell, the feature ids keep their
+        insertion order.  Features with centres that can not be
+        transformed are put in a last cell.
+        """
+        if not self.fids:
+            return []
+        cx = np.array(self.centrex)
+        cy = np.array(self.centrey)
+        if self.transform is not None:
+            cx, cy = self.transform(cx, cy)
+            valid = np.isfinite(cx) & np.isfinite(cy)
+            if not valid.all():
+                fids = np.array(self.fids)
+                invalid = fids[~valid].tolist()
+                index = GridIndex(self.cellwidth, self.cellheight)
+                index.fids = fids[valid].tolist()
+                index.centrex = cx[valid]
+                index.centrey = cy[valid]
+                return index.cells() + [invalid]
+        cols = np.floor((cx - cx.min()) / self.cellwidth).astype(np.int64)
+        rows = np.floor((cy - cy.min()) / self.cellheight).astype(np.int64)
+        # Serpentine order
+        cols = np.where(rows % 2 == 1, cols.max() - cols, cols)
+        order = np.lexsort((np.arange(len(cols)), cols, rows))
+        keys = rows[order] * (cols.max() + 1) + cols[order]
+        starts = np.flatnonzero(np.concatenate(([True],
+                                                keys[1:] != keys[:-1])))
+        fids = np.array(self.fids)[order]
+        return [fids[start:end].tolist() for start, end in
+                zip(starts, np.append(starts[1:], len(order)))]
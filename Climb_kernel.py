@@ -0,0 +1,607 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Vectorised climb calculation.  The vertices of a batch of line
+ geometries are decoded from WKB into contiguous NumPy arrays, and
+ climb, descent, minimum and maximum elevation are calculated using
+ array operations.  This module does not depend on QGIS.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import struct
+import numpy as np
+
+# WKB geometry type codes (without dimension information)
+WKBLINESTRING = 2
+WKBMULTILINESTRING = 5
+WKBCIRCULARSTRING = 8
+WKBCOMPOUNDCURVE = 9
+WKBMULTICURVE = 11
+
+
+def _geometrytype(code):
+    """
+    Splits a (ISO or extended) WKB geometry type code into the
+    base type and the Z and M flags.
+    """
+    hasz = bool(code & 0x80000000)
+    hasm = bool(code & 0x40000000)
+    code = code & 0x0fffffff
+    dims = code // 1000
+    if dims in (1, 3):
+        hasz = True
+    if dims in (2, 3):
+        hasm = True
+    return code % 1000, hasz, hasm
+
+
+def _readcurves(wkb, offset, curves):
+    """
+    Reads the WKB geometry starting at offset, appending the
+    vertex coordinates (an (n, 3) array of X, Y and Z) of each
+    part to curves.  Returns the offset following the geometry.
+    """
+    endian = '<' if wkb[offset] == 1 else '>'
+    code = struct.unpack_from(endian + 'I', wkb, offset + 1)[0]
+    offset = offset + 5
+    basetype, hasz, hasm = _geometrytype(code)
+    if code & 0x20000000:
+        # EWKB with SRID - skip the SRID
+        offset = offset + 4
+    if basetype in (WKBLINESTRING, WKBCIRCULARSTRING):
+        npoints = struct.unpack_from(endian + 'I', wkb, offset)[0]
+        offset = offset + 4
+        ndims = 2 + hasz + hasm
+        coords = np.frombuffer(wkb, dtype=endian + 'f8',
+                               count=npoints * ndims,
+                               offset=offset).reshape(npoints, ndims)
+        offset = offset + 8 * npoints * ndims
+        xyz = np.empty((npoints, 3))
+        xyz[:, 0:2] = coords[:, 0:2]
+        if hasz:
+            xyz[:, 2] = coords[:, 2]
+        else:
+            xyz[:, 2] = np.nan
+        curves.append(xyz)
+    elif basetype == WKBCOMPOUNDCURVE:
+        ncurves = struct.unpack_from(endian + 'I', wkb, offset)[0]
+        offset = offset + 4
+        segments = []
+        for i in range(ncurves):
+            offset = _readcurves(wkb, offset, segments)
+        # The segments of a compound curve share their end points,
+        # and a shared vertex is only visited once
+        if segments:
+            segments = [segments[0]] + [s[1:] for s in segments[1:]]
+            curves.append(np.concatenate(segments))
+        else:
+            curves.append(np.empty((0, 3)))
+    elif basetype in (WKBMULTILINESTRING, WKBMULTICURVE):
+        ngeoms = struct.unpack_from(endian + 'I', wkb, offset)[0]
+        offset = offset + 4
+        for i in range(ngeoms):
+            offset = _readcurves(wkb, offset, curves)
+    else:
+        raise ValueError('Unsupported WKB geometry type: ' + str(code))
+    return offset
+
+
+class VertexBatch(object):
+    """
+    The vertices of a batch of line geometries, stored as contiguous
+    coordinate arrays.  The vertices of part p are found at
+    part_offsets[p]:part_offsets[p + 1], and the parts of feature f
+    are feature_offsets[f]:feature_offsets[f + 1].
+    """
+
+    def __init__(self, x, y, z, part_offsets, feature_offsets):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.part_offsets = part_offsets
+        self.feature_offsets = feature_offsets
+
+    def featureCount(self):
+        return len(self.feature_offsets) - 1
+
+    def partCount(self):
+        return len(self.part_offsets) - 1
+
+    def vertexCount(self):
+        return len(self.z)
+
+
+def decode_wkb_batch(wkbs):
+    """
+    Decodes a sequence of WKB line geometries (bytes) into a
+    VertexBatch.  Empty (null) geometries give features with no
+    parts.  Missing Z values are represented by NaN.
+    """
+    curves = []
+    featureoffsets = [0]
+    for wkb in wkbs:
+        if wkb:
+            _readcurves(wkb, 0, curves)
+        featureoffsets.append(len(curves))
+    partoffsets = np.zeros(len(curves) + 1, dtype=np.int64)
+    if curves:
+        np.cumsum([len(c) for c in curves], out=partoffsets[1:])
+        xyz = np.concatenate(curves)
+    else:
+        xyz = np.empty((0, 3))
+    return VertexBatch(xyz[:, 0], xyz[:, 1], xyz[:, 2], partoffsets,
+                       np.array(featureoffsets, dtype=np.int64))
+
+
+def segment_lengths(batch):
+    """
+    Returns the 2D lengths of the segments (between consecutive
+    vertices of the same part) of a VertexBatch.
+    """
+    partids = np.repeat(np.arange(batch.partCount()),
+                        np.diff(batch.part_offsets))
+    samepart = partids[1:] == partids[:-1]
+    return np.hypot(np.diff(batch.x), np.diff(batch.y))[samepart]
+
+
+def median_vertex_spacing(batch):
+    """
+    Returns the median distance between consecutive vertices of the
+    lines of a VertexBatch (0 if there are no segments).
+    """
+    lengths = segment_lengths(batch)
+    lengths = lengths[np.isfinite(lengths)]
+    if len(lengths) == 0:
+        return 0.0
+    return float(np.median(lengths))
+
+
+class ClimbStatistics(object):
+    """
+    Climb, descent, minimum and maximum elevation for each feature
+    of a batch.  partclimb and partdescent hold the (accumulated)
+    climb and descent of the feature after each of its parts, and
+    are used for the layer totals (the parts of feature f are
+    feature_offsets[f]:feature_offsets[f + 1]).  missing is the
+    number of vertices without a Z value for each feature, and
+    vertices (optional) the number of vertices of each feature.
+    grades (optional) holds the grade statistics of each feature
+    (see grade_statistics), and profiles (optional) the distance and
+    Z profiles (see feature_profiles).
+    """
+
+    def __init__(self, climb, descent, minelev, maxelev,
+                 partclimb, partdescent, missing, feature_offsets,
+                 grades=None, profiles=None, vertices=None):
+        self.climb = climb
+        self.descent = descent
+        self.minelev = minelev
+        self.maxelev = maxelev
+        self.partclimb = partclimb
+        self.partdescent = partdescent
+        self.missing = missing
+        self.feature_offsets = feature_offsets
+        self.grades = grades
+        self.profiles = profiles
+        self.vertices = vertices
+
+    def featureCount(self):
+        return len(self.climb)
+
+    def take(self, indices):
+        """
+        Returns the statistics of the features with the given
+        indices, in the order of the indices.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        parts, offsets = _ragged_take(self.feature_offsets, indices)
+        grades = None
+        if self.grades is not None:
+            grades = self.grades[indices]
+        profiles = None
+        if self.profiles is not None:
+            distance, z, profileoffsets = self.profiles
+            rows, profileoffsets = _ragged_take(profileoffsets, indices)
+            profiles = (distance[rows], z[rows], profileoffsets)
+        vertices = None
+        if self.vertices is not None:
+            vertices = self.vertices[indices]
+        return ClimbStatistics(self.climb[indices], self.descent[indices],
+                               self.minelev[indices],
+                               self.maxelev[indices],
+                               self.partclimb[parts],
+                               self.partdescent[parts],
+                               self.missing[indices], offsets,
+                               grades, profiles, vertices)
+
+
+def _ragged_take(offsets, indices):
+    """
+    Returns the indexes of the items of the groups with the given
+    indices (group i is offsets[i]:offsets[i + 1]), and the offsets
+    of the groups in the result.
+    """
+    starts = offsets[indices]
+    counts = offsets[indices + 1] - starts
+    newoffsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(counts, out=newoffsets[1:])
+    items = (np.arange(newoffsets[-1]) -
+             np.repeat(newoffsets[:-1] - starts, counts))
+    return items, newoffsets
+
+
+def _concatenate_offsets(offsetslist):
+    """
+    Combines the offsets of several groupings into one.
+    """
+    counts = [np.diff(offsets) for offsets in offsetslist]
+    offsets = np.zeros(sum(len(c) for c in counts) + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(counts), out=offsets[1:])
+    return offsets
+
+
+def concatenate_statistics(statslist):
+    """
+    Combines the ClimbStatistics of several batches into one.
+    """
+    if not statslist:
+        return climb_statistics(decode_wkb_batch([]))
+    offsets = _concatenate_offsets([s.feature_offsets for s in statslist])
+    grades = None
+    if all(s.grades is not None for s in statslist):
+        grades = np.concatenate([s.grades for s in statslist])
+    profiles = None
+    if all(s.profiles is not None for s in statslist):
+        profiles = (np.concatenate([s.profiles[0] for s in statslist]),
+                    np.concatenate([s.profiles[1] for s in statslist]),
+                    _concatenate_offsets([s.profiles[2]
+                                          for s in statslist]))
+    vertices = None
+    if all(s.vertices is not None for s in statslist):
+        vertices = np.concatenate([s.vertices for s in statslist])
+    return ClimbStatistics(
+        np.concatenate([s.climb for s in statslist]),
+        np.concatenate([s.descent for s in statslist]),
+        np.concatenate([s.minelev for s in statslist]),
+        np.concatenate([s.maxelev for s in statslist]),
+        np.concatenate([s.partclimb for s in statslist]),
+        np.concatenate([s.partdescent for s in statslist]),
+        np.concatenate([s.missing for s in statslist]),
+        offsets, grades, profiles, vertices)
+
+
+def _vertex_distances(batch):
+    """
+    Returns the 2D distance along the line to each vertex of a
+    VertexBatch, accumulated over all the parts of the batch (the
+    gaps between parts are not included).
+    """
+    steps = np.zeros(len(batch.x))
+    steps[1:] = np.hypot(np.diff(batch.x), np.diff(batch.y))
+    steps[batch.part_offsets[:-1][batch.part_offsets[:-1] <
+                                  len(steps)]] = 0.0
+    steps[~np.isfinite(steps)] = 0.0
+    return np.cumsum(steps)
+
+
+def grade_statistics(batch, bounds):
+    """
+    Calculates the grade statistics of each feature of a VertexBatch
+    from the 2D distances and the Z differences between consecutive
+    vertices with valid Z values of the same part.  bounds are the
+    (increasing) limits of the grade classes (percent).  Returns an
+    array with a row for each feature: the maximum grade, the
+    distance weighted mean grade (both absolute, percent, 0 without
+    segments), and the horizontal length in each of the
+    len(bounds) + 1 grade classes.
+    """
+    nfeatures = batch.featureCount()
+    distances = _vertex_distances(batch)
+    partids = np.repeat(np.arange(batch.partCount()),
+                        np.diff(batch.part_offsets))
+    partfeatures = np.repeat(np.arange(nfeatures),
+                             np.diff(batch.feature_offsets))
+    valid = np.flatnonzero(~np.isnan(batch.z))
+    validparts = partids[valid]
+    samepart = validparts[1:] == validparts[:-1]
+    rises = np.abs(np.diff(batch.z[valid]))[samepart]
+    runs = np.diff(distances[valid])[samepart]
+    features = partfeatures[validparts[1:][samepart]]
+    horizontal = runs > 0
+    rises = rises[horizontal]
+    runs = runs[horizontal]
+    features = features[horizontal]
+    grades = 100.0 * rises / runs
+    result = np.zeros((nfeatures, len(bounds) + 3))
+    np.maximum.at(result[:, 0], features, grades)
+    totalrun = np.bincount(features, weights=runs, minlength=nfeatures)
+    totalrise = np.bincount(features, weights=rises, minlength=nfeatures)
+    withrun = totalrun > 0
+    result[withrun, 1] = 100.0 * totalrise[withrun] / totalrun[withrun]
+    classes = np.searchsorted(np.asarray(bounds, dtype=np.float64),
+                              grades, side='right')
+    np.add.at(result, (features, classes + 2), runs)
+    return result
+
+
+def feature_profiles(batch):
+    """
+    Returns the elevation profiles of the features of a VertexBatch:
+    the distance along the feature (over its parts) and the Z value
+    (NaN if missing) of each vertex (float32), and the offsets of
+    the features in these arrays.
+    """
+    distances = _vertex_distances(batch)
+    offsets = batch.part_offsets[batch.feature_offsets]
+    counts = np.diff(offsets)
+    starts = np.minimum(offsets[:-1], max(len(distances) - 1, 0))
+    if len(distances) > 0:
+        distances = distances - np.repeat(distances[starts], counts)
+    return (distances.astype(np.float32), batch.z.astype(np.float32),
+            offsets - offsets[0])
+
+
+def _part_sums(ups, downs, diffoffsets, featureoffsets, partfeatures):
+    """
+    Returns the accumulated climb and descent of each feature after
+    each of its parts.  The differences (ups and downs) of each
+    feature are put in the rows of a zero padded 2D array, and
+    summed sequentially along the rows (cumsum with axis=1).  To
+    limit the padding, the features are grouped by the number of
+    differences (rounded up to a power of two).
+    """
+    nparts = len(partfeatures)
+    partclimb = np.zeros(nparts)
+    partdescent = np.zeros(nparts)
+    featurestarts = diffoffsets[featureoffsets[:-1]]
+    featurelengths = diffoffsets[featureoffsets[1:]] - featurestarts
+    # Index of the accumulated value after each part, relative to
+    # the first difference of the feature (-1 if none yet)
+    partends = (diffoffsets[1:] - featurestarts[partfeatures] - 1)
+    buckets = np.zeros(len(featurelengths), dtype=np.int64)
+    haslength = featurelengths > 0
+    buckets[haslength] = np.ceil(
+        np.log2(featurelengths[haslength])).astype(np.int64) + 1
+    rows = np.zeros(len(featurelengths), dtype=np.int64)
+    for bucket in np.unique(buckets[haslength]):
+        features = np.flatnonzero(buckets == bucket)
+        rows[features] = np.arange(len(features))
+        lengths = featurelengths[features]
+        width = int(lengths.max())
+        columns = np.arange(width)
+        inside = columns[np.newaxis, :] < lengths[:, np.newaxis]
+        items = (featurestarts[features][:, np.newaxis] +
+                 columns[np.newaxis, :])[inside]
+        parts = np.flatnonzero((buckets[partfeatures] == bucket) &
+                               (partends >= 0))
+        partrows = rows[partfeatures[parts]]
+        for values, sums in ((ups, partclimb), (downs, partdescent)):
+            padded = np.zeros((len(features), width))
+            padded[inside] = values[items]
+            np.cumsum(padded, axis=1, out=padded)
+            sums[parts] = padded[partrows, partends[parts]]
+    return partclimb, partdescent
+
+
+def climb_statistics(batch, gradebounds=None, profiles=False):
+    """
+    Calculates the climb, descent, minimum and maximum elevation for
+    each feature of a VertexBatch.  The results are identical to
+    the vertex by vertex calculation:
+    - vertices without a valid Z value (NaN) are skipped
+    - climb and descent are accumulated over the parts of a feature
+      in vertex order
+    - the minimum and maximum elevation are restarted for each part
+      that has a valid Z value, so they are taken from the last such
+      part of the feature
+    If gradebounds is given, the grade statistics are included, and
+    if profiles is set, the elevation profiles.
+    Returns a ClimbStatistics object.
+    """
+    nparts = batch.partCount()
+    nfeatures = batch.featureCount()
+    featureoffsets = batch.feature_offsets
+    partids = np.repeat(np.arange(nparts),
+                        np.diff(batch.part_offsets))
+    valid = ~np.isnan(batch.z)
+    zvalid = batch.z[valid]
+    validparts = partids[valid]
+    validcount = np.bincount(validparts, minlength=nparts)
+    partfeatures = np.repeat(np.arange(nfeatures),
+                             np.diff(featureoffsets))
+    vertices = np.bincount(partfeatures,
+                           weights=np.diff(batch.part_offsets),
+                           minlength=nfeatures).astype(np.int64)
+    missing = np.bincount(partfeatures,
+                          weights=np.diff(batch.part_offsets) - validcount,
+                          minlength=nfeatures).astype(np.int64)
+
+    # Differences between consecutive valid Z values of a part
+    samepart = validparts[1:] == validparts[:-1]
+    diffs = np.diff(zvalid)[samepart]
+    diffparts = validparts[1:][samepart]
+    ups = np.clip(diffs, 0, None)
+    downs = np.clip(-diffs, 0, None)
+    diffoffsets = np.zeros(nparts + 1, dtype=np.int64)
+    np.cumsum(np.bincount(diffparts, minlength=nparts),
+              out=diffoffsets[1:])
+
+    # Accumulated climb and descent after each part.  The sums are
+    # sequential (cumsum) to get exactly the same rounding as the
+    # vertex by vertex calculation.
+    partclimb, partdescent = _part_sums(ups, downs, diffoffsets,
+                                        featureoffsets, partfeatures)
+    hasparts = featureoffsets[1:] > featureoffsets[:-1]
+    lastparts = featureoffsets[1:][hasparts] - 1
+    climb = np.zeros(nfeatures)
+    descent = np.zeros(nfeatures)
+    climb[hasparts] = partclimb[lastparts]
+    descent[hasparts] = partdescent[lastparts]
+
+    # Minimum and maximum elevation of the parts with valid Z values
+    validpartids = np.flatnonzero(validcount)
+    partmin = np.full(nparts, np.inf)
+    partmax = np.full(nparts, -np.inf)
+    if len(validpartids) > 0:
+        starts = np.concatenate(([0], np.cumsum(validcount)))[
+            validpartids]
+        partmin[validpartids] = np.minimum.reduceat(zvalid, starts)
+        partmax[validpartids] = np.maximum.reduceat(zvalid, starts)
+    # The last part with valid Z values of each feature
+    minelev = np.full(nfeatures, np.inf)
+    maxelev = np.full(nfeatures, -np.inf)
+    if len(validpartids) > 0:
+        last = np.searchsorted(validpartids, featureoffsets[1:]) - 1
+        lastpart = validpartids[np.maximum(last, 0)]
+        found = (last >= 0) & (lastpart >= featureoffsets[:-1])
+        minelev[found] = partmin[lastpart[found]]
+        maxelev[found] = partmax[lastpart[found]]
+    return ClimbStatistics(climb, descent, minelev, maxelev,
+                           partclimb, partdescent, missing,
+                           featureoffsets,
+                           grade_statistics(batch, gradebounds)
+                           if gradebounds is not None else None,
+                           feature_profiles(batch) if profiles else None,
+                           vertices)
+
+
+def wkb_statistics(wkbs, sampler=None, gradebounds=None, profiles=False):
+    """
+    Calculates the statistics (ClimbStatistics) for a list of WKB
+    geometries, with Z values from the DEM sampler (see
+    Climb_dem.DemSampler) if given, otherwise from the geometries.
+    """
+    vertices = decode_wkb_batch(wkbs)
+    if sampler is not None:
+        vertices = sampler.sampleBatch(vertices)
+    return climb_statistics(vertices, gradebounds, profiles)
+
+
+class ClimbTotals(object):
+    """
+    Layer totals, accumulated batch by batch.  The totals are
+    increased by the accumulated feature climb and descent after
+    each part, in the same order as the vertex by vertex
+    calculation.
+    """
+
+    def __init__(self):
+        self.climb = 0.0
+        self.descent = 0.0
+        self.minelevation = float('Infinity')
+        self.maxelevation = float('-Infinity')
+
+    def add(self, stats):
+        """
+        Adds the statistics (ClimbStatistics) of a batch.
+        """
+        if len(stats.partclimb) > 0:
+            self.climb = float(np.cumsum(np.concatenate(
+                ([self.climb], stats.partclimb)))[-1])
+            self.descent = float(np.cumsum(np.concatenate(
+                ([self.descent], stats.partdescent)))[-1])
+        if len(stats.minelev) > 0:
+            self.minelevation = min(self.minelevation,
+                                    float(np.min(stats.minelev)))
+            self.maxelevation = max(self.maxelevation,
+                                    float(np.max(stats.maxelev)))
+
+
+class GroupTotals(object):
+    """
+    Climb totals per group (hash aggregation), accumulated batch by
+    batch.  Each group gets an index the first time it is seen, and
+    the totals of the groups are kept in arrays that grow as needed.
+    The totals of a group are accumulated in the same order as the
+    layer totals (ClimbTotals).
+    """
+
+    def __init__(self):
+        self.indexes = {}
+        self.keys = []
+        self.features = np.zeros(0, dtype=np.int64)
+        self.climb = np.zeros(0)
+        self.descent = np.zeros(0)
+        self.minelevation = np.zeros(0)
+        self.maxelevation = np.zeros(0)
+
+    def groupCount(self):
+        return len(self.keys)
+
+    def add(self, keys, stats):
+        """
+        Adds the statistics (ClimbStatistics) of a batch, where keys
+        gives the group of each feature.
+        """
+        indexes = self.indexes
+        groups = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            index = indexes.get(key)
+            if index is None:
+                index = len(self.keys)
+                indexes[key] = index
+                self.keys.append(key)
+            groups[i] = index
+        self._grow(len(self.keys))
+        np.add.at(self.features, groups, 1)
+        # The groups of the parts
+        partgroups = np.repeat(groups, np.diff(stats.feature_offsets))
+        np.add.at(self.climb, partgroups, stats.partclimb)
+        np.add.at(self.descent, partgroups, stats.partdescent)
+        np.minimum.at(self.minelevation, groups, stats.minelev)
+        np.maximum.at(self.maxelevation, groups, stats.maxelev)
+
+    def _grow(self, size):
+        """
+        Makes room for size groups (doubling the capacity).
+        """
+        capacity = len(self.climb)
+        if size <= capacity:
+            return
+        extra = max(size, 2 * capacity, 1024) - capacity
+        self.features = np.concatenate(
+            (self.features, np.zeros(extra, dtype=np.int64)))
+        self.climb = np.concatenate((self.climb, np.zeros(extra)))
+        self.descent = np.concatenate((self.descent, np.zeros(extra)))
+        self.minelevation = np.concatenate(
+            (self.minelevation, np.full(extra, np.inf)))
+        self.maxelevation = np.concatenate(
+            (self.maxelevation, np.full(extra, -np.inf)))
+
+    def rows(self):
+        """
+        Yields (key, number of features, climb, descent, minimum
+        elevation, maximum elevation) for each group, in the order
+        the groups were first seen.
+        """
+        count = len(self.keys)
+        return zip(self.keys, self.features[:count].tolist(),
+                   self.climb[:count].tolist(),
+                   self.descent[:count].tolist(),
+                   self.minelevation[:count].tolist(),
+                   self.maxelevation[:count].tolist())
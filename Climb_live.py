@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Live climb totals for a line layer that is being edited.  The
+ statistics of each feature are calculated once, and then updated
+ for the features that are added, changed or deleted.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import heapq
+from PyQt5.QtCore import QObject, pyqtSignal
+from qgis.core import QgsFeatureRequest
+from .Climb_kernel import decode_wkb_batch, climb_statistics
+
+
+class MinMaxTracker(object):
+    """
+    Minimum and maximum of a multiset of values that supports
+    removal of values.  Uses a min heap and a max heap with lazy
+    deletion (the number of occurrences of each value is counted).
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.minheap = []
+        self.maxheap = []
+
+    def add(self, value):
+        count = self.counts.get(value, 0)
+        if count == 0:
+            heapq.heappush(self.minheap, value)
+            heapq.heappush(self.maxheap, -value)
+        self.counts[value] = count + 1
+
+    def remove(self, value):
+        count = self.counts.get(value, 0)
+        if count <= 1:
+            self.counts.pop(value, None)
+        else:
+            self.counts[value] = count - 1
+
+    def minimum(self):
+        while self.minheap and self.minheap[0] not in self.counts:
+            heapq.heappop(self.minheap)
+        return self.minheap[0] if self.minheap else float('Infinity')
+
+    def maximum(self):
+        while self.maxheap and -self.maxheap[0] not in self.counts:
+            heapq.heappop(self.maxheap)
+        return -self.maxheap[0] if self.maxheap else float('-Infinity')
+
+
+class LiveClimb(QObject):
+    """
+    Keeps the climb totals of a line layer (with Z values) up to date
+    while it is edited.  The totals are the same as the ones returned
+    by the Climb along line algorithm.  totalsChanged is emitted with
+    the total climb, total descent, minimum and maximum elevation
+    when they change.
+    """
+
+    totalsChanged = pyqtSignal(float, float, float, float)
+
+    # Number of features handled together initially
+    BATCHSIZE = 1000
+
+    def __init__(self, layer, parent=None):
+        super().__init__(parent)
+        self.layer = layer
+        # feature id -> (climb contribution, descent contribution,
+        #                minimum elevation, maximum elevation)
+        self.features = {}
+        self.climb = 0.0
+        self.descent = 0.0
+        self.minmax = MinMaxTracker()
+        self.recalculate()
+        layer.geometryChanged.connect(self.geometryChanged)
+        layer.featureAdded.connect(self.featureAdded)
+        layer.featureDeleted.connect(self.featureDeleted)
+        # Feature ids of added features change on commit
+        layer.afterCommitChanges.connect(self.recalculate)
+        layer.afterRollBack.connect(self.recalculate)
+
+    def stop(self):
+        """
+        Disconnects from the layer.
+        """
+        layer = self.layer
+        layer.geometryChanged.disconnect(self.geometryChanged)
+        layer.featureAdded.disconnect(self.featureAdded)
+        layer.featureDeleted.disconnect(self.featureDeleted)
+        layer.afterCommitChanges.disconnect(self.recalculate)
+        layer.afterRollBack.disconnect(self.recalculate)
+
+    def recalculate(self):
+        """
+        Calculates the statistics for all the features of the layer.
+        """
+        self.features = {}
+        self.climb = 0.0
+        self.descent = 0.0
+        self.minmax = MinMaxTracker()
+        request = QgsFeatureRequest().setSubsetOfAttributes([])
+        fids = []
+        wkbs = []
+        for feature in self.layer.getFeatures(request):
+            fids.append(feature.id())
+            wkbs.append(bytes(feature.geometry().asWkb()))
+            if len(fids) >= self.BATCHSIZE:
+                self._add(fids, wkbs)
+                fids = []
+                wkbs = []
+        self._add(fids, wkbs)
+        self._emit()
+
+    def totals(self):
+        return (self.climb, self.descent, self.minmax.minimum(),
+                self.minmax.maximum())
+
+    def geometryChanged(self, fid, geometry):
+        self._remove(fid)
+        self._add([fid], [bytes(geometry.asWkb())])
+        self._emit()
+
+    def featureAdded(self, fid):
+        feature = self.layer.getFeature(fid)
+        self._remove(fid)
+        self._add([fid], [bytes(feature.geometry().asWkb())])
+        self._emit()
+
+    def featureDeleted(self, fid):
+        self._remove(fid)
+        self._emit()
+
+    def _add(self, fids, wkbs):
+        if not fids:
+            return
+        stats = climb_statistics(decode_wkb_batch(wkbs))
+        offsets = stats.feature_offsets
+        for i, fid in enumerate(fids):
+            # The layer totals get the accumulated climb and descent
+            # after each part of the feature
+            climb = float(stats.partclimb[offsets[i]:offsets[i + 1]].sum())
+            descent = float(
+                stats.partdescent[offsets[i]:offsets[i + 1]].sum())
+            minelev = float(stats.minelev[i])
+            maxelev = float(stats.maxelev[i])
+            self.features[fid] = (climb, descent, minelev, maxelev)
+            self.climb = self.climb + climb
+            self.descent = self.descent + descent
+            if minelev <= maxelev:
+                self.minmax.add(minelev)
+                self.minmax.add(maxelev)
+
+    def _remove(self, fid):
+        values = self.features.pop(fid, None)
+        if values is None:
+            return
+        climb, descent, minelev, maxelev = values
+        self.climb = self.climb - climb
+        self.descent = self.descent - descent
+        if minelev <= maxelev:
+            self.minmax.remove(minelev)
+            self.minmax.remove(maxelev)
+
+    def _emit(self):
+        self.totalsChanged.emit(*self.totals())
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Timers for the stages of a climb run (reading, Z values, climb,
+ writing, ...) and counters (features, parts, vertices and missing Z
+ values), with a summary for the log and a JSON report.  This module
+ does not depend on QGIS.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+
+# Changing this tells readers of the report that the format changed
+REPORTVERSION = 2
+# The counters, in the order they are reported
+COUNTERS = ('features', 'parts', 'vertices', 'missingz',
+            'nozfeatures')
+# Minimum time between progress updates (seconds)
+PROGRESSINTERVAL = 0.5
+
+
+class RunMetrics(object):
+    """
+    Time used by each stage of a run (seconds) and counters.  The
+    stage timers are exclusive: while a stage is timed inside
+    another (e.g. reading features while waiting for the worker
+    processes), the time is only counted for the inner stage, so
+    the stage times add up to the timed part of the run.
+    points is what the vertices counter counts: 'vertices', or
+    'cells' when the DEM cells crossed by the lines are sampled
+    instead of the vertices (TRAVERSE).
+    """
+
+    def __init__(self, points='vertices'):
+        self.timers = OrderedDict()
+        self.counters = OrderedDict((name, 0) for name in COUNTERS)
+        self.points = points
+        self.started = time.perf_counter()
+        self.stack = []
+
+    def _start(self, stage):
+        now = time.perf_counter()
+        if self.stack:
+            self._charge(self.stack[-1], now)
+        self.stack.append([stage, now])
+
+    def _stop(self):
+        now = time.perf_counter()
+        self._charge(self.stack.pop(), now)
+        if self.stack:
+            self.stack[-1][1] = now
+
+    def _charge(self, entry, now):
+        stage, start = entry
+        self.timers[stage] = self.timers.get(stage, 0.0) + now - start
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Times a block of code (with metrics.timer('write'): ...).
+        """
+        self._start(stage)
+        try:
+            yield
+        finally:
+            self._stop()
+
+    def timed(self, stage, iterable):
+        """
+        Yields the items of iterable, timing the work done to produce
+        each of them.
+        """
+        iterator = iter(iterable)
+        while True:
+            self._start(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._stop()
+            yield item
+
+    def count(self, name, value):
+        self.counters[name] = self.counters[name] + int(value)
+
+    def countStatistics(self, stats):
+        """
+        Adds the features, parts, vertices and missing Z values of
+        a batch (ClimbStatistics) to the counters.
+        """
+        self.count('features', stats.featureCount())
+        self.count('parts', stats.feature_offsets[-1])
+        if stats.vertices is not None:
+            self.count('vertices', stats.vertices.sum())
+        self.count('missingz', stats.missing.sum())
+        # Features without parts, or with no valid Z value
+        self.count('nozfeatures',
+                   np.count_nonzero(stats.minelev > stats.maxelev))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        """
+        Returns a summary of the counters and the stage times.
+        """
+        counters = self.counters
+        lines = ['Features: ' + str(counters['features']) + ', parts: ' +
+                 str(counters['parts']) + ', ' + self.points + ': ' +
+                 str(counters['vertices'])]
+        if counters['missingz'] > 0 or counters['nozfeatures'] > 0:
+            lines.append('Missing Z values: ' +
+                         str(counters['missingz']) + ' ' + self.points +
+                         ', ' +
+                         str(counters['nozfeatures']) +
+                         ' features without a valid Z value')
+        elapsed = self.elapsed()
+        lines.append('Time: ' + str(round(elapsed, 3)) + ' s (' +
+                     ', '.join(stage + ' ' + str(round(seconds, 3)) +
+                               ' s' for stage, seconds
+                               in self.timers.items()) + ')')
+        return '\n'.join(lines)
+
+    def report(self, extra=None):
+        """
+        Returns the metrics as a dictionary (for JSON), with the
+        (JSON compatible) values of extra added.  The vertices
+        counter is reported with the name in points.
+        """
+        elapsed = self.elapsed()
+        result = OrderedDict()
+        result['version'] = REPORTVERSION
+        result['seconds'] = OrderedDict(self.timers)
+        result['seconds']['total'] = elapsed
+        result['points'] = self.points
+        result['counters'] = OrderedDict(
+            (self.points if name == 'vertices' else name, value)
+            for name, value in self.counters.items())
+        if elapsed > 0:
+            result[self.points + '_per_second'] = (
+                self.counters['vertices'] / elapsed)
+        if extra:
+            result.update(extra)
+        return result
+
+    def writeReport(self, path, extra=None):
+        """
+        Writes the report (see report) to a JSON file.
+        """
+        with open(path, 'w') as reportfile:
+            json.dump(self.report(extra), reportfile, indent=2)
+
+
+class ProgressThrottle(object):
+    """
+    Passes progress (percent) on to setprogress (e.g.
+    feedback.setProgress) only when the whole percent changes and
+    at most every interval seconds (and always at 100 %), so that
+    the cost of the reporting does not grow with the number of
+    features.
+    """
+
+    def __init__(self, setprogress, interval=PROGRESSINTERVAL):
+        self.setprogress = setprogress
+        self.interval = interval
+        self.percent = -1
+        self.last = None
+
+    def update(self, percent):
+        percent = int(percent)
+        if percent == self.percent:
+            return
+        now = time.perf_counter()
+        if (percent < 100 and self.last is not None and
+                now - self.last < self.interval):
+            return
+        self.percent = percent
+        self.last = now
+        self.setprogress(percent)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Parallel climb calculation.  Chunks of WKB geometries are sent to a
+ pool of worker processes that sample the DEM (if any) and calculate
+ the climb statistics.  The workers only import the QGIS independent
+ modules.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import multiprocessing
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from .Climb_kernel import wkb_statistics
+
+# The DEM sampler of a worker process
+_sampler = None
+# Keyword arguments for climb_statistics in a worker process
+_options = {}
+# The counters of the sampler when the previous chunk was returned
+_reported = {}
+
+
+def _initworker(samplerarguments, options, workers):
+    """
+    Opens the DEM in a worker process.  The workers share the size
+    of the block cache.
+    """
+    global _sampler, _options
+    _options = options or {}
+    if samplerarguments is not None:
+        from .Climb_dem import DemSampler
+        _sampler = DemSampler(*samplerarguments)
+        _sampler.cache.maxbytes = _sampler.cache.maxbytes // workers
+
+
+def chunk_statistics(wkbs):
+    """
+    Calculates the climb statistics (ClimbStatistics) for a chunk of
+    WKB geometries, with Z values from the DEM of the worker process
+    if there is one.  Returns the statistics and the change of the
+    counters of the DEM sampler (see DemSampler.counters) since the
+    previous chunk of the worker (None without a DEM).
+    """
+    global _reported
+    stats = wkb_statistics(wkbs, _sampler, **_options)
+    if _sampler is None:
+        return stats, None
+    counters = _sampler.counters()
+    changes = dict((name, value - _reported.get(name, 0))
+                   for name, value in counters.items())
+    _reported = counters
+    return stats, changes
+
+
+def _pythonexecutable():
+    """
+    Returns the Python interpreter to use for the worker processes.
+    Inside QGIS, sys.executable may be the QGIS application.
+    """
+    executable = sys.executable
+    if os.path.basename(executable).lower().startswith('python'):
+        return executable
+    for name in ('python3', 'python', 'python3.exe', 'python.exe'):
+        for folder in (sys.exec_prefix,
+                       os.path.join(sys.exec_prefix, 'bin')):
+            candidate = os.path.join(folder, name)
+            if os.path.isfile(candidate):
+                return candidate
+    return executable
+
+
+class ChunkPool(object):
+    """
+    A pool of worker processes that calculate climb statistics for
+    chunks of geometries.  samplerarguments are the arguments used
+    to create a DemSampler in each worker (None if the Z values are
+    taken from the geometries), and options are keyword arguments
+    for climb_statistics.  The block cache size of the sampler is
+    the total for all the workers.  counters are the totals of the
+    counters of the samplers of the workers (see
+    DemSampler.counters).
+    """
+
+    # Time (seconds) between checks for cancellation
+    POLLINTERVAL = 0.1
+
+    def __init__(self, workers, samplerarguments=None, options=None):
+        if workers < 1:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        # Limit the number of chunks in the pipeline (memory)
+        self.maxpending = 2 * workers
+        # The chunks submitted by map and not yet yielded
+        self.pending = deque()
+        self.counters = Counter()
+        context = multiprocessing.get_context('spawn')
+        context.set_executable(_pythonexecutable())
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=context,
+            initializer=_initworker,
+            initargs=(samplerarguments, options, workers))
+
+    def map(self, chunks, iscanceled):
+        """
+        Calculates the statistics for an iterable of (payload, wkbs)
+        pairs, and yields (payload, statistics) pairs in the order of
+        the chunks.  Stops (without yielding the rest) when
+        iscanceled() returns True.
+        """
+        pending = deque()
+        self.pending = pending
+        for payload, wkbs in chunks:
+            if iscanceled():
+                break
+            pending.append((payload,
+                            self.executor.submit(chunk_statistics, wkbs)))
+            if len(pending) >= self.maxpending:
+                result = self._wait(pending.popleft(), iscanceled)
+                if result is None:
+                    break
+                yield result
+        while pending and not iscanceled():
+            result = self._wait(pending.popleft(), iscanceled)
+            if result is None:
+                break
+            yield result
+        for payload, future in pending:
+            future.cancel()
+
+    def _wait(self, pendingchunk, iscanceled):
+        payload, future = pendingchunk
+        while True:
+            if iscanceled():
+                future.cancel()
+                return None
+            try:
+                stats, counters = future.result(self.POLLINTERVAL)
+            except TimeoutError:
+                continue
+            if counters:
+                self.counters.update(counters)
+            return payload, stats
+
+    def close(self):
+        """
+        Stops the worker processes without waiting for the chunks
+        that have not been started.
+        """
+        try:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        except TypeError:
+            # Python < 3.9
+            for payload, future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Compact store of the elevation profiles (distance and Z for each
+ vertex) of the features, in one uncompressed NumPy .npz file that
+ can be memory mapped.  This module does not depend on QGIS.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import shutil
+import struct
+import zipfile
+import numpy as np
+
+# The arrays of the store, and their types
+_ARRAYS = (('fid', '<i8'), ('offsets', '<i8'), ('distance', '<f4'),
+           ('z', '<f4'))
+# Size of the blocks copied into the store (bytes)
+_COPYSIZE = 1048576
+
+
+class ProfileStore(object):
+    """
+    Writes the profiles of the features to an .npz file with the
+    arrays fid (feature ids), offsets (the profile of feature i is
+    offsets[i]:offsets[i + 1]), distance and z.  The profiles are
+    written to temporary files next to the store as they are added,
+    and the store is put together when it is closed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.vertices = 0
+        self.files = {}
+        for name, dtype in _ARRAYS:
+            self.files[name] = open(path + '.' + name + '.tmp', 'wb')
+        self.files['offsets'].write(np.zeros(1, dtype='<i8').tobytes())
+
+    def add(self, fids, profiles):
+        """
+        Adds the profiles (distance, z, offsets) of the features with
+        the given ids.
+        """
+        distance, z, offsets = profiles
+        self.files['fid'].write(np.asarray(fids, dtype='<i8').tobytes())
+        self.files['offsets'].write(
+            (np.asarray(offsets[1:], dtype='<i8') +
+             self.vertices).tobytes())
+        self.files['distance'].write(distance.astype('<f4').tobytes())
+        self.files['z'].write(z.astype('<f4').tobytes())
+        self.count = self.count + len(fids)
+        self.vertices = self.vertices + int(offsets[-1])
+
+    def close(self):
+        """
+        Writes the .npz file and removes the temporary files.
+        """
+        lengths = {'fid': self.count, 'offsets': self.count + 1,
+                   'distance': self.vertices, 'z': self.vertices}
+        with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED,
+                             allowZip64=True) as store:
+            for name, dtype in _ARRAYS:
+                tmpfile = self.files[name]
+                tmpfile.close()
+                header = {'descr': dtype, 'fortran_order': False,
+                          'shape': (lengths[name],)}
+                with store.open(name + '.npy', 'w',
+                                force_zip64=True) as member:
+                    np.lib.format.write_array_header_1_0(member, header)
+                    with open(tmpfile.name, 'rb') as data:
+                        shutil.copyfileobj(data, member, _COPYSIZE)
+                os.remove(tmpfile.name)
+
+    def discard(self):
+        """
+        Closes and removes the temporary files without writing the
+        .npz file (the run did not complete).
+        """
+        for tmpfile in self.files.values():
+            tmpfile.close()
+            if os.path.exists(tmpfile.name):
+                os.remove(tmpfile.name)
+
+
+class ProfileReader(object):
+    """
+    Memory maps the arrays (fid, offsets, distance and z) of a
+    profile store (.npz file written by ProfileStore).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with zipfile.ZipFile(path) as store, open(path, 'rb') as npz:
+            for info in store.infolist():
+                name = info.filename[:-len('.npy')]
+                # The data follows the local file header and the
+                # .npy header
+                npz.seek(info.header_offset + 26)
+                namelength, extralength = struct.unpack('<HH', npz.read(4))
+                npz.seek(info.header_offset + 30 + namelength +
+                         extralength)
+                np.lib.format.read_magic(npz)
+                shape, fortran, dtype = (
+                    np.lib.format.read_array_header_1_0(npz))
+                if shape[0] == 0:
+                    array = np.zeros(shape, dtype=dtype)
+                else:
+                    array = np.memmap(path, dtype=dtype, mode='r',
+                                      offset=npz.tell(), shape=shape)
+                setattr(self, name, array)
+        self.index = None
+
+    def profile(self, fid):
+        """
+        Returns the distance and z arrays of the profile of the
+        feature with the given id.
+        """
+        if self.index is None:
+            self.index = dict(zip(self.fid.tolist(),
+                                  range(len(self.fid))))
+        i = self.index[fid]
+        start = self.offsets[i]
+        end = self.offsets[i + 1]
+        return self.distance[start:end], self.z[start:end]
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Writing of the climb features to the output sink.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+from operator import itemgetter
+from PyQt5.QtCore import QVariant
+from qgis.core import (QgsFeatureSink,
+                       QgsFields,
+                       QgsField)
+
+
+class ClimbWriter(object):
+    """
+    Writes batches of features with the calculated values to a
+    feature sink.  The projection of the input attributes (the input
+    fields to copy, without fields that have the names of the
+    calculated fields) is worked out once.  The calculated fields
+    (newfields, all of type double) are appended.
+    """
+
+    def __init__(self, sourcefields, newfields, copyfields=None,
+                 feedback=None):
+        """
+        copyfields is a list of the names of the input fields to
+        copy (None: all fields).
+        """
+        self.fields = QgsFields()
+        self.indexes = []
+        for index, field in enumerate(sourcefields):
+            name = str(field.name())
+            if name in newfields:
+                # Skip fields with names that are equal to the
+                # generated ones
+                if feedback is not None:
+                    feedback.pushInfo("Warning: existing " + name +
+                                      " attribute found and removed")
+                continue
+            if copyfields is not None and name not in copyfields:
+                continue
+            self.fields.append(field)
+            self.indexes.append(index)
+        for name in newfields:
+            self.fields.append(QgsField(name, QVariant.Double))
+        # All the input attributes, in order?
+        self.copyall = self.indexes == list(range(len(sourcefields)))
+        if len(self.indexes) > 1:
+            self.project = itemgetter(*self.indexes)
+        elif len(self.indexes) == 1:
+            index = self.indexes[0]
+            self.project = lambda attrs: (attrs[index],)
+        else:
+            self.project = lambda attrs: ()
+
+    def outputFields(self):
+        return self.fields
+
+    def requestAttributes(self):
+        """
+        Returns the indexes of the input attributes that are needed.
+        """
+        return list(self.indexes)
+
+    def write(self, sink, features, columns):
+        """
+        Sets the attributes of a batch of features (the projected
+        input attributes followed by the values of columns, one list
+        of values per calculated field) and adds the features to the
+        sink.
+        """
+        rows = zip(*columns)
+        if self.copyall:
+            for feature, values in zip(features, rows):
+                feature.setAttributes(feature.attributes() + list(values))
+        else:
+            project = self.project
+            for feature, values in zip(features, rows):
+                feature.setAttributes(list(project(feature.attributes())) +
+                                      list(values))
+        sink.addFeatures(features, QgsFeatureSink.FastInsert)
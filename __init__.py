@@ -35,4 +35,4 @@ def classFactory(iface):  # pylint: disable=invalid-name
     :type iface: QgsInterface
     """
     from .Climb import Climb
-    return Climb()
+    return Climb(iface)
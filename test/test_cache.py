@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Tests of the persistent result cache.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from ..Climb_kernel import wkb_statistics, concatenate_statistics
+from ..Climb_cache import ResultCache
+from .test_kernel import random_features, features_wkb
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'cache.sqlite')
+        rng = random.Random(5)
+        # Features without vertices can have the same WKB
+        features = [parts for parts in random_features(rng, 100)
+                    if any(parts)]
+        self.wkbs = features_wkb(features[:60])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def run_chunks(self, cache, chunks):
+        return list(cache.merge(
+            (payload, wkb_statistics(wkbs))
+            for payload, wkbs in cache.split(chunks)))
+
+    def assertSameStatistics(self, stats, expected):
+        for name in ('climb', 'descent', 'minelev', 'maxelev',
+                     'partclimb', 'partdescent', 'missing',
+                     'feature_offsets', 'vertices'):
+            self.assertEqual(getattr(stats, name).tolist(),
+                             getattr(expected, name).tolist(), name)
+
+    def test_hits_keep_results_and_order(self):
+        expected = wkb_statistics(self.wkbs)
+        cache = ResultCache(self.path, 'geometry')
+        # Cache the even features first
+        self.run_chunks(cache, [('even', self.wkbs[::2])])
+        cache.close()
+        cache = ResultCache(self.path, 'geometry')
+        results = self.run_chunks(cache, [('a', self.wkbs[:25]),
+                                          ('b', self.wkbs[25:])])
+        self.assertEqual([payload for payload, stats in results],
+                         ['a', 'b'])
+        self.assertEqual(cache.hits, 30)
+        self.assertEqual(cache.misses, 30)
+        self.assertSameStatistics(
+            concatenate_statistics([stats for payload, stats in results]),
+            expected)
+        cache.close()
+
+    def test_zsource_is_part_of_the_key(self):
+        cache = ResultCache(self.path, 'dem-a')
+        self.run_chunks(cache, [(None, self.wkbs)])
+        cache.close()
+        cache = ResultCache(self.path, 'dem-b')
+        self.run_chunks(cache, [(None, self.wkbs)])
+        self.assertEqual(cache.hits, 0)
+        cache.close()
+
+    def test_maxentries(self):
+        cache = ResultCache(self.path, 'geometry', 10)
+        self.run_chunks(cache, [(None, self.wkbs)])
+        cache.close()
+        cache = ResultCache(self.path, 'geometry', 10)
+        self.run_chunks(cache, [(None, self.wkbs)])
+        self.assertLessEqual(cache.hits, 10)
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Tests of the DEM sampler (needs GDAL).
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+from ..Climb_kernel import VertexBatch
+if gdal is not None:
+    from ..Climb_dem import (DemSampler, NEAREST, BILINEAR, TRAVERSE,
+                             traverse_cells)
+
+NODATA = -9999
+
+
+def write_dem(path, values, tilesize=0, datatype=None, options=(),
+              nodata=NODATA):
+    """
+    Writes values (rows x columns) to a GeoTIFF (Float32 by default)
+    with 1 m cells and the upper left corner at (0, rows).  With
+    tilesize > 0 the GeoTIFF is tiled (not memory mappable).
+    options are more creation options.  nodata None: no nodata
+    value.
+    """
+    if datatype is None:
+        datatype = gdal.GDT_Float32
+    options = list(options)
+    if tilesize > 0:
+        options = options + ['TILED=YES', 'BLOCKXSIZE=' + str(tilesize),
+                             'BLOCKYSIZE=' + str(tilesize)]
+    rows, columns = values.shape
+    dataset = gdal.GetDriverByName('GTiff').Create(
+        path, columns, rows, 1, datatype, options)
+    dataset.SetGeoTransform((0.0, 1.0, 0.0, float(rows), 0.0, -1.0))
+    band = dataset.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    band.WriteArray(values)
+    band.FlushCache()
+    dataset = None
+    return path
+
+
+@unittest.skipIf(gdal is None, 'GDAL is not available')
+class DemSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(7)
+        self.values = rng.uniform(0, 1000, (70, 90)).astype(np.float32)
+        self.values[3, 4] = NODATA
+        self.strips = write_dem(os.path.join(self.folder, 'strips.tif'),
+                                self.values)
+        self.tiled = write_dem(os.path.join(self.folder, 'tiled.tif'),
+                               self.values, 32)
+        self.x = rng.uniform(-5, 95, 2000)
+        self.y = rng.uniform(-5, 75, 2000)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def expected_nearest(self, x, y):
+        cols = np.floor(x).astype(np.int64)
+        rows = np.floor(70 - y).astype(np.int64)
+        inside = (cols >= 0) & (cols < 90) & (rows >= 0) & (rows < 70)
+        z = np.full(len(x), np.nan)
+        z[inside] = self.values[rows[inside], cols[inside]]
+        z[z == NODATA] = np.nan
+        return z
+
+    def test_nearest(self):
+        expected = self.expected_nearest(self.x, self.y)
+        for path, usememmap in ((self.strips, True), (self.strips, False),
+                                (self.tiled, True)):
+            sampler = DemSampler(path, 1, NEAREST, tilesize=16,
+                                 cachesize=1, usememmap=usememmap)
+            np.testing.assert_array_equal(sampler.sample(self.x, self.y),
+                                          expected)
+            sampler.close()
+
+    def test_memmap(self):
+        sampler = DemSampler(self.strips, usememmap=True)
+        self.assertIsNotNone(sampler.memmap)
+        sampler.close()
+        sampler = DemSampler(self.tiled, usememmap=True)
+        self.assertIsNone(sampler.memmap)
+        sampler.close()
+
+    def test_nbits_not_memory_mapped(self):
+        # 12 bit values are bit packed in the file
+        values = np.arange(70 * 90, dtype=np.uint16).reshape(70, 90) % 4000
+        path = write_dem(os.path.join(self.folder, 'nbits.tif'), values,
+                         datatype=gdal.GDT_UInt16, options=['NBITS=12'],
+                         nodata=None)
+        sampler = DemSampler(path, usememmap=True)
+        self.assertIsNone(sampler.memmap)
+        np.testing.assert_array_equal(sampler.sample([4.5], [70 - 3.5]),
+                                      [values[3, 4]])
+        sampler.close()
+
+    def test_nodata_cell(self):
+        sampler = DemSampler(self.strips)
+        self.assertTrue(np.isnan(sampler.sample([4.5], [70 - 3.5])[0]))
+        sampler.close()
+
+    def test_bilinear_cell_centres(self):
+        # At the cell centres, bilinear gives the cell values
+        rows, cols = np.mgrid[10:20, 10:20]
+        x = cols.ravel() + 0.5
+        y = 70 - (rows.ravel() + 0.5)
+        sampler = DemSampler(self.tiled, 1, BILINEAR)
+        np.testing.assert_allclose(sampler.sample(x, y),
+                                   self.expected_nearest(x, y),
+                                   rtol=1e-6)
+        sampler.close()
+
+    def test_deduplicate(self):
+        x = np.concatenate((self.x, self.x[::3]))
+        y = np.concatenate((self.y, self.y[::3]))
+        sampler = DemSampler(self.tiled, 1, BILINEAR, deduplicate=True)
+        deduplicated = sampler.sample(x, y)
+        self.assertEqual(sampler.uniquevertices, len(self.x))
+        sampler.close()
+        sampler = DemSampler(self.tiled, 1, BILINEAR)
+        np.testing.assert_array_equal(deduplicated, sampler.sample(x, y))
+        sampler.close()
+
+    def test_traverse(self):
+        # A line along a row crosses one cell per column
+        batch = VertexBatch(np.array([0.5, 89.5]), np.array([60.5, 60.5]),
+                            np.full(2, np.nan), np.array([0, 2]),
+                            np.array([0, 1]))
+        sampler = DemSampler(self.strips, 1, TRAVERSE)
+        cells = sampler.sampleBatch(batch)
+        self.assertEqual(cells.vertexCount(), 90)
+        np.testing.assert_array_equal(cells.z, self.values[9, :])
+        sampler.close()
+
+    def test_traverse_cells(self):
+        # Every cell that a segment passes through is found once, in
+        # order along the segment
+        rng = np.random.default_rng(8)
+        for trial in range(50):
+            px = rng.uniform(0, 20, 5)
+            py = rng.uniform(0, 20, 5)
+            cx, cy, offsets = traverse_cells(px, py, np.array([0, 5]))
+            cells = list(zip(np.floor(cx).astype(int).tolist(),
+                             np.floor(cy).astype(int).tolist()))
+            expected = []
+            for i in range(4):
+                t = np.linspace(0, 1, 20001)[1:-1]
+                for cell in zip(np.floor(px[i] + t * (px[i + 1] - px[i])),
+                                np.floor(py[i] + t * (py[i + 1] - py[i]))):
+                    cell = (int(cell[0]), int(cell[1]))
+                    if not expected or expected[-1] != cell:
+                        expected.append(cell)
+            self.assertEqual(offsets.tolist(), [0, len(cx)])
+            self.assertEqual(set(cells), set(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Tests of the grid index.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import random
+import unittest
+import numpy as np
+from ..Climb_index import GridIndex
+
+
+def random_boxes(rng, count, size=1000.0):
+    """
+    Returns count random bounding boxes (fid, xmin, ymin, xmax, ymax)
+    with fids that are not in order.
+    """
+    fids = rng.sample(range(10 * count), count)
+    boxes = []
+    for fid in fids:
+        x = rng.uniform(0, size)
+        y = rng.uniform(0, size)
+        boxes.append((fid, x, y, x + rng.uniform(0, 50),
+                      y + rng.uniform(0, 50)))
+    return boxes
+
+
+class GridIndexTest(unittest.TestCase):
+
+    def index(self, boxes, transform=None):
+        index = GridIndex(100, 80, transform)
+        for box in boxes:
+            index.insert(*box)
+        return index
+
+    def test_each_feature_once(self):
+        rng = random.Random(1)
+        boxes = random_boxes(rng, 2000)
+        index = self.index(boxes)
+        self.assertEqual(index.featureCount(), len(boxes))
+        cells = index.cells()
+        fids = [fid for cell in cells for fid in cell]
+        self.assertEqual(sorted(fids), sorted(box[0] for box in boxes))
+        self.assertTrue(all(cells))
+
+    def test_cells(self):
+        # The features of a cell have their centres in the cell, and
+        # keep their insertion order
+        rng = random.Random(2)
+        boxes = random_boxes(rng, 500)
+        centres = dict((fid, ((xmin + xmax) / 2.0, (ymin + ymax) / 2.0))
+                       for fid, xmin, ymin, xmax, ymax in boxes)
+        order = dict((box[0], i) for i, box in enumerate(boxes))
+        minx = min(centre[0] for centre in centres.values())
+        miny = min(centre[1] for centre in centres.values())
+        seen = set()
+        for cell in self.index(boxes).cells():
+            keys = set((int((centres[fid][0] - minx) // 100),
+                        int((centres[fid][1] - miny) // 80))
+                       for fid in cell)
+            self.assertEqual(len(keys), 1)
+            # A cell is not split
+            key = keys.pop()
+            self.assertNotIn(key, seen)
+            seen.add(key)
+            self.assertEqual([order[fid] for fid in cell],
+                             sorted(order[fid] for fid in cell))
+
+    def test_serpentine(self):
+        # One feature per cell in a 3 x 3 grid
+        boxes = []
+        for row in range(3):
+            for col in range(3):
+                fid = row * 3 + col
+                x = col * 100 + 50
+                y = row * 80 + 40
+                boxes.append((fid, x, y, x, y))
+        cells = self.index(boxes).cells()
+        self.assertEqual(cells, [[0], [1], [2], [5], [4], [3],
+                                 [6], [7], [8]])
+
+    def test_transform(self):
+        # Centres that can not be transformed end up in a last cell
+        rng = random.Random(3)
+        boxes = random_boxes(rng, 300)
+        badfids = set(box[0] for box in boxes[::7])
+        badx = np.array([(box[1] + box[3]) / 2.0 for box in boxes[::7]])
+
+        def transform(x, y):
+            x = 2.0 * x
+            x[np.isin(x, 2.0 * badx)] = np.inf
+            return x, y + 1000.0
+
+        cells = self.index(boxes, transform).cells()
+        self.assertEqual(set(cells[-1]), badfids)
+        fids = [fid for cell in cells for fid in cell]
+        self.assertEqual(sorted(fids), sorted(box[0] for box in boxes))
+
+    def test_empty(self):
+        self.assertEqual(GridIndex(10, 10).cells(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
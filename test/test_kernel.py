@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Tests of the vectorised climb kernel against the vertex by vertex
+ calculation of the original algorithm.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import bisect
+import math
+import random
+import struct
+import unittest
+import numpy as np
+from ..Climb_kernel import (decode_wkb_batch, climb_statistics,
+                            wkb_statistics, concatenate_statistics,
+                            grade_statistics, ClimbTotals, GroupTotals)
+
+# WKB geometry types
+LINESTRINGZ = 1002
+MULTILINESTRINGZ = 1005
+
+
+def linestring_wkb(points):
+    """
+    Returns the WKB of a LineString Z with the given (x, y, z)
+    points.
+    """
+    return (struct.pack('<BII', 1, LINESTRINGZ, len(points)) +
+            b''.join(struct.pack('<ddd', *point) for point in points))
+
+
+def multilinestring_wkb(parts):
+    return (struct.pack('<BII', 1, MULTILINESTRINGZ, len(parts)) +
+            b''.join(linestring_wkb(part) for part in parts))
+
+
+def vertex_loop(features, totals):
+    """
+    The vertex by vertex calculation of the original algorithm.
+    features is a list of lists of parts (lists of Z values).
+    Returns (climb, descent, minelev, maxelev) for each feature, and
+    updates totals (a list with the total climb and descent).
+    """
+    results = []
+    for parts in features:
+        climb = 0
+        descent = 0
+        minelev = float('Infinity')
+        maxelev = float('-Infinity')
+        for part in parts:
+            first = True
+            for zval in part:
+                if math.isnan(zval):
+                    continue
+                if first:
+                    prevz = zval
+                    minelev = zval
+                    maxelev = zval
+                    first = False
+                else:
+                    diff = zval - prevz
+                    if diff > 0:
+                        climb = climb + diff
+                    else:
+                        descent = descent - diff
+                    if minelev > zval:
+                        minelev = zval
+                    if maxelev < zval:
+                        maxelev = zval
+                prevz = zval
+            totals[0] = totals[0] + climb
+            totals[1] = totals[1] + descent
+        results.append((climb, descent, minelev, maxelev))
+    return results
+
+
+def grade_loop(features, bounds):
+    """
+    Vertex by vertex calculation of the grade statistics (see
+    grade_statistics).  features is a list of lists of parts (lists
+    of (x, y, z) points).
+    """
+    results = []
+    for parts in features:
+        maxgrade = 0.0
+        rise = 0.0
+        run = 0.0
+        classes = [0.0] * (len(bounds) + 1)
+        for part in parts:
+            distance = 0.0
+            previous = None
+            for i, (x, y, z) in enumerate(part):
+                if i > 0:
+                    distance = distance + math.hypot(x - part[i - 1][0],
+                                                     y - part[i - 1][1])
+                if math.isnan(z):
+                    continue
+                if previous is not None:
+                    segmentrun = distance - previous[0]
+                    segmentrise = abs(z - previous[1])
+                    if segmentrun > 0:
+                        grade = 100.0 * segmentrise / segmentrun
+                        maxgrade = max(maxgrade, grade)
+                        rise = rise + segmentrise
+                        run = run + segmentrun
+                        classes[bisect.bisect_right(bounds, grade)] += (
+                            segmentrun)
+                previous = (distance, z)
+        meangrade = 100.0 * rise / run if run > 0 else 0.0
+        results.append([maxgrade, meangrade] + classes)
+    return results
+
+
+def random_features(rng, count, maxparts=4, maxvertices=40,
+                    nanfraction=0.2):
+    """
+    Returns count random features (lists of parts with Z values),
+    with empty parts, single vertex parts and missing Z values.
+    """
+    features = []
+    for i in range(count):
+        parts = []
+        for j in range(rng.randint(0, maxparts)):
+            parts.append([float('nan') if rng.random() < nanfraction
+                          else rng.uniform(-50, 2000) * rng.random()
+                          for k in range(rng.randint(0, maxvertices))])
+        features.append(parts)
+    return features
+
+
+def features_wkb(features):
+    wkbs = []
+    for f, parts in enumerate(features):
+        parts = [[(float(i), float(f), z) for i, z in enumerate(part)]
+                 for part in parts]
+        if len(parts) == 1:
+            wkbs.append(linestring_wkb(parts[0]))
+        else:
+            wkbs.append(multilinestring_wkb(parts))
+    return wkbs
+
+
+class ClimbKernelTest(unittest.TestCase):
+
+    def assertSameResults(self, features, stats, totals=None):
+        expectedtotals = [0, 0]
+        expected = vertex_loop(features, expectedtotals)
+        self.assertEqual(stats.climb.tolist(),
+                         [result[0] for result in expected])
+        self.assertEqual(stats.descent.tolist(),
+                         [result[1] for result in expected])
+        self.assertEqual(stats.minelev.tolist(),
+                         [result[2] for result in expected])
+        self.assertEqual(stats.maxelev.tolist(),
+                         [result[3] for result in expected])
+        if totals is not None:
+            self.assertEqual([totals.climb, totals.descent],
+                             expectedtotals)
+
+    def test_random_features(self):
+        rng = random.Random(1)
+        for trial in range(300):
+            features = random_features(rng, rng.randint(0, 30))
+            stats = wkb_statistics(features_wkb(features))
+            totals = ClimbTotals()
+            totals.add(stats)
+            self.assertSameResults(features, stats, totals)
+            missing = [sum(1 for part in parts for z in part
+                           if math.isnan(z)) for parts in features]
+            self.assertEqual(stats.missing.tolist(), missing)
+            self.assertEqual(stats.vertices.tolist(),
+                             [sum(len(part) for part in parts)
+                              for parts in features])
+
+    def test_mixed_lengths(self):
+        # Features of very different lengths end up in different
+        # (padded) groups
+        rng = random.Random(2)
+        features = (random_features(rng, 50, 1, 3, 0.0) +
+                    random_features(rng, 5, 3, 3000, 0.1) +
+                    random_features(rng, 50, 5, 20, 0.5))
+        rng.shuffle(features)
+        self.assertSameResults(features,
+                               wkb_statistics(features_wkb(features)))
+
+    def test_batches(self):
+        # The totals do not depend on how the features are batched,
+        # and take/concatenate_statistics keep the results
+        rng = random.Random(3)
+        features = random_features(rng, 200)
+        wkbs = features_wkb(features)
+        totals = ClimbTotals()
+        statslist = []
+        for start in range(0, len(wkbs), 17):
+            stats = wkb_statistics(wkbs[start:start + 17])
+            totals.add(stats)
+            statslist.append(stats)
+        self.assertSameResults(features, concatenate_statistics(statslist),
+                               totals)
+        order = list(range(len(features)))
+        rng.shuffle(order)
+        taken = concatenate_statistics(statslist).take(order)
+        self.assertSameResults([features[i] for i in order], taken)
+
+    def test_grades(self):
+        # Steps of 0 (repeated vertices), 1, 2 and 5 (3, 4) m
+        rng = random.Random(5)
+        bounds = [2.0, 5.0, 10.0, 50.0]
+        steps = [(0, 0), (1, 0), (0, 2), (3, 4)]
+        features = []
+        for parts in random_features(rng, 300):
+            pointparts = []
+            for part in parts:
+                x = 0.0
+                y = 0.0
+                points = []
+                for z in part:
+                    step = rng.choice(steps)
+                    x = x + step[0]
+                    y = y + step[1]
+                    points.append((x, y, z))
+                pointparts.append(points)
+            features.append(pointparts)
+        wkbs = [linestring_wkb(parts[0]) if len(parts) == 1
+                else multilinestring_wkb(parts) for parts in features]
+        grades = grade_statistics(decode_wkb_batch(wkbs), bounds)
+        np.testing.assert_allclose(grades, grade_loop(features, bounds),
+                                   rtol=1e-9, atol=1e-9)
+        self.assertEqual(grades.shape, (len(features), len(bounds) + 3))
+
+    def test_empty(self):
+        stats = climb_statistics(decode_wkb_batch([]))
+        self.assertEqual(stats.featureCount(), 0)
+        stats = wkb_statistics([linestring_wkb([])])
+        self.assertEqual(stats.climb.tolist(), [0.0])
+        self.assertGreater(stats.minelev[0], stats.maxelev[0])
+
+    def test_group_totals(self):
+        rng = random.Random(4)
+        features = random_features(rng, 100)
+        keys = [rng.choice(['a', 'b', None]) for feature in features]
+        groups = GroupTotals()
+        groups.add(keys, wkb_statistics(features_wkb(features)))
+        for key, count, climb, descent, minelev, maxelev in groups.rows():
+            members = [feature for feature, featurekey
+                       in zip(features, keys) if featurekey == key]
+            totals = [0, 0]
+            expected = vertex_loop(members, totals)
+            self.assertEqual(count, len(members))
+            self.assertEqual([climb, descent], totals)
+            self.assertEqual(minelev, min(result[2]
+                                          for result in expected))
+            self.assertEqual(maxelev, max(result[3]
+                                          for result in expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
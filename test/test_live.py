@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Tests of the live climb totals (needs QGIS).
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import random
+import unittest
+try:
+    from ..Climb_live import MinMaxTracker
+except ImportError:
+    MinMaxTracker = None
+
+
+@unittest.skipIf(MinMaxTracker is None, 'QGIS is not available')
+class MinMaxTrackerTest(unittest.TestCase):
+
+    def test_empty(self):
+        tracker = MinMaxTracker()
+        self.assertEqual(tracker.minimum(), float('Infinity'))
+        self.assertEqual(tracker.maximum(), float('-Infinity'))
+
+    def test_equal_values(self):
+        tracker = MinMaxTracker()
+        for value in (5.0, 5.0, 7.0):
+            tracker.add(value)
+        tracker.remove(5.0)
+        self.assertEqual((tracker.minimum(), tracker.maximum()),
+                         (5.0, 7.0))
+        tracker.remove(5.0)
+        self.assertEqual((tracker.minimum(), tracker.maximum()),
+                         (7.0, 7.0))
+        # Added again after it was removed
+        tracker.add(5.0)
+        self.assertEqual((tracker.minimum(), tracker.maximum()),
+                         (5.0, 7.0))
+        tracker.remove(7.0)
+        tracker.add(7.0)
+        tracker.add(7.0)
+        tracker.remove(7.0)
+        self.assertEqual((tracker.minimum(), tracker.maximum()),
+                         (5.0, 7.0))
+        tracker.remove(7.0)
+        tracker.remove(5.0)
+        self.assertEqual(tracker.minimum(), float('Infinity'))
+        self.assertEqual(tracker.maximum(), float('-Infinity'))
+
+    def test_random(self):
+        # Compare with the minimum and maximum of a list
+        rng = random.Random(5)
+        tracker = MinMaxTracker()
+        values = []
+        for step in range(5000):
+            if values and rng.random() < 0.45:
+                value = values.pop(rng.randrange(len(values)))
+                tracker.remove(value)
+            else:
+                # Few distinct values, so that equal values are common
+                value = float(rng.randint(0, 20))
+                values.append(value)
+                tracker.add(value)
+            if values:
+                self.assertEqual(tracker.minimum(), min(values))
+                self.assertEqual(tracker.maximum(), max(values))
+            else:
+                self.assertEqual(tracker.minimum(), float('Infinity'))
+
+
+if __name__ == '__main__':
+    unittest.main()
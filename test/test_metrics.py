@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Tests of the run metrics.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import unittest
+from unittest import mock
+from ..Climb_metrics import RunMetrics, ProgressThrottle
+from ..Climb_kernel import wkb_statistics
+from .test_kernel import linestring_wkb
+
+
+class Clock(object):
+    """
+    A clock (perf_counter) that only moves when it is told to.
+    """
+
+    def __init__(self):
+        self.now = 100.0
+
+    def perf_counter(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now = self.now + seconds
+
+
+class RunMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('time.perf_counter', self.clock.perf_counter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_nested_timers(self):
+        # The time of an inner stage is not counted for the outer one
+        metrics = RunMetrics()
+        with metrics.timer('workers'):
+            self.clock.advance(1.0)
+            with metrics.timer('read'):
+                self.clock.advance(2.0)
+                with metrics.timer('decode'):
+                    self.clock.advance(4.0)
+            self.clock.advance(8.0)
+        self.clock.advance(16.0)
+        self.assertEqual(dict(metrics.timers),
+                         {'workers': 9.0, 'read': 2.0, 'decode': 4.0})
+        self.assertEqual(metrics.elapsed(), 31.0)
+        report = metrics.report()
+        self.assertEqual(report['seconds']['total'], 31.0)
+
+    def test_same_stage_nested(self):
+        metrics = RunMetrics()
+        with metrics.timer('z'):
+            self.clock.advance(1.0)
+            with metrics.timer('z'):
+                self.clock.advance(2.0)
+            self.clock.advance(4.0)
+        self.assertEqual(dict(metrics.timers), {'z': 7.0})
+
+    def test_timed(self):
+        # The work done by the iterable is timed, not the work done
+        # with the items
+        metrics = RunMetrics()
+
+        def items():
+            for i in range(3):
+                self.clock.advance(1.0)
+                with metrics.timer('decode'):
+                    self.clock.advance(2.0)
+                yield i
+
+        for item in metrics.timed('read', items()):
+            with metrics.timer('climb'):
+                self.clock.advance(10.0)
+        self.assertEqual(dict(metrics.timers),
+                         {'read': 3.0, 'decode': 6.0, 'climb': 30.0})
+        self.assertEqual(sum(metrics.timers.values()), metrics.elapsed())
+
+    def test_timer_exception(self):
+        metrics = RunMetrics()
+        with self.assertRaises(ValueError):
+            with metrics.timer('write'):
+                self.clock.advance(1.0)
+                raise ValueError('failed')
+        with metrics.timer('read'):
+            self.clock.advance(2.0)
+        self.assertEqual(dict(metrics.timers), {'write': 1.0, 'read': 2.0})
+
+    def test_counters(self):
+        metrics = RunMetrics()
+        nan = float('nan')
+        metrics.countStatistics(wkb_statistics(
+            [linestring_wkb([(0, 0, 1), (1, 0, nan), (2, 0, 3)]),
+             linestring_wkb([(0, 1, nan)])]))
+        counters = metrics.counters
+        self.assertEqual([counters['features'], counters['parts'],
+                          counters['vertices'], counters['missingz'],
+                          counters['nozfeatures']], [2, 2, 4, 2, 1])
+        metrics.points = 'cells'
+        self.assertEqual(metrics.report()['counters']['cells'], 4)
+        self.assertIn('cells: 4', metrics.summary())
+
+
+class ProgressThrottleTest(unittest.TestCase):
+
+    def test_update(self):
+        clock = Clock()
+        reported = []
+        with mock.patch('time.perf_counter', clock.perf_counter):
+            progress = ProgressThrottle(reported.append, 0.5)
+            progress.update(1.2)
+            progress.update(1.9)
+            clock.advance(0.1)
+            progress.update(2.0)
+            clock.advance(0.5)
+            progress.update(3.0)
+            progress.update(100.0)
+        self.assertEqual(reported, [1, 3, 100])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Tests of the profile store.
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from ..Climb_kernel import wkb_statistics
+from ..Climb_profile import ProfileStore, ProfileReader
+from .test_kernel import random_features, features_wkb
+
+
+class ProfileStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'profiles.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_round_trip(self):
+        rng = random.Random(6)
+        store = ProfileStore(self.path)
+        expected = {}
+        fid = 100
+        for batch in range(4):
+            features = random_features(rng, 25)
+            stats = wkb_statistics(features_wkb(features), profiles=True)
+            distance, z, offsets = stats.profiles
+            fids = list(range(fid, fid + len(features)))
+            store.add(fids, stats.profiles)
+            for i, featurefid in enumerate(fids):
+                expected[featurefid] = (distance[offsets[i]:offsets[i + 1]],
+                                        z[offsets[i]:offsets[i + 1]])
+            fid = fid + len(features)
+        store.close()
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         ['profiles.npz'])
+        reader = ProfileReader(self.path)
+        self.assertEqual(reader.fid.tolist(), sorted(expected))
+        for featurefid, (distance, z) in expected.items():
+            readdistance, readz = reader.profile(featurefid)
+            np.testing.assert_array_equal(readdistance, distance)
+            np.testing.assert_array_equal(readz, z)
+        # The store is a plain .npz file
+        with np.load(self.path) as npz:
+            np.testing.assert_array_equal(npz['offsets'], reader.offsets)
+
+    def test_empty(self):
+        ProfileStore(self.path).close()
+        reader = ProfileReader(self.path)
+        self.assertEqual(len(reader.fid), 0)
+        self.assertEqual(reader.offsets.tolist(), [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ Climb
+                                 A QGIS plugin
+
+                              -------------------
+        begin                : 2019-03-01
+        copyright            : (C) 2019 by Håvard Tveite
+        email                : havard.tveite@nmbu.no
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Tests of the output writer (needs QGIS).
+"""
+
+__author__ = 'Håvard Tveite'
+__date__ = '2019-03-01'
+__copyright__ = '(C) 2019 by Håvard Tveite'
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = '$Format:%H$'
+
+import unittest
+try:
+    from PyQt5.QtCore import QVariant
+    from qgis.core import QgsFeature, QgsField, QgsFields
+except ImportError:
+    QgsFeature = None
+if QgsFeature is not None:
+    from ..Climb_writer import ClimbWriter
+
+NEWFIELDS = ['climb', 'descent', 'minelev', 'maxelev']
+
+
+class Sink(object):
+    """
+    Collects the features that are added.
+    """
+
+    def __init__(self):
+        self.features = []
+
+    def addFeatures(self, features, flags=None):
+        self.features.extend(features)
+        return True
+
+
+@unittest.skipIf(QgsFeature is None, 'QGIS is not available')
+class ClimbWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fields = QgsFields()
+        for name in ['name', 'climb', 'length', 'id']:
+            self.fields.append(QgsField(name, QVariant.String))
+
+    def features(self):
+        features = []
+        for i in range(3):
+            feature = QgsFeature(self.fields, i)
+            feature.setAttributes(['n' + str(i), 'old', i * 10, i])
+            features.append(feature)
+        return features
+
+    def columns(self):
+        return [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0], [7.0, 8.0, 9.0],
+                [10.0, 11.0, 12.0]]
+
+    def test_projection_order(self):
+        # The copied fields keep the order of the input fields
+        writer = ClimbWriter(self.fields, NEWFIELDS, ['id', 'name'])
+        self.assertFalse(writer.copyall)
+        self.assertEqual(writer.requestAttributes(), [0, 3])
+        self.assertEqual(writer.outputFields().names(),
+                         ['name', 'id'] + NEWFIELDS)
+        sink = Sink()
+        writer.write(sink, self.features(), self.columns())
+        self.assertEqual([feature.attributes() for feature
+                          in sink.features],
+                         [['n0', 0, 1.0, 4.0, 7.0, 10.0],
+                          ['n1', 1, 2.0, 5.0, 8.0, 11.0],
+                          ['n2', 2, 3.0, 6.0, 9.0, 12.0]])
+
+    def test_existing_new_field(self):
+        # An input field with the name of a new field is dropped
+        writer = ClimbWriter(self.fields, NEWFIELDS)
+        self.assertFalse(writer.copyall)
+        self.assertEqual(writer.outputFields().names(),
+                         ['name', 'length', 'id'] + NEWFIELDS)
+        sink = Sink()
+        writer.write(sink, self.features(), self.columns())
+        self.assertEqual(sink.features[1].attributes(),
+                         ['n1', 10, 1, 2.0, 5.0, 8.0, 11.0])
+
+    def test_single_field(self):
+        writer = ClimbWriter(self.fields, NEWFIELDS, ['length'])
+        sink = Sink()
+        writer.write(sink, self.features(), self.columns())
+        self.assertEqual(sink.features[2].attributes(),
+                         [20, 3.0, 6.0, 9.0, 12.0])
+
+    def test_no_fields(self):
+        writer = ClimbWriter(self.fields, NEWFIELDS, [])
+        self.assertEqual(writer.requestAttributes(), [])
+        sink = Sink()
+        writer.write(sink, self.features(), self.columns())
+        self.assertEqual(sink.features[0].attributes(),
+                         [1.0, 4.0, 7.0, 10.0])
+
+    def test_copy_all(self):
+        fields = QgsFields()
+        for name in ['name', 'length']:
+            fields.append(QgsField(name, QVariant.String))
+        writer = ClimbWriter(fields, NEWFIELDS)
+        self.assertTrue(writer.copyall)
+        feature = QgsFeature(fields, 1)
+        feature.setAttributes(['a', 5])
+        sink = Sink()
+        writer.write(sink, [feature], [[1.0], [2.0], [3.0], [4.0]])
+        self.assertEqual(sink.features[0].attributes(),
+                         ['a', 5, 1.0, 2.0, 3.0, 4.0])
+
+
+if __name__ == '__main__':
+    unittest.main()